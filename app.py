@@ -3,20 +3,41 @@ import torch
 import clip
 import faiss
 import numpy as np
-from PIL import Image
 from ultralytics import YOLO
 YOLO_AVAILABLE = True
 import pandas as pd
-import io, base64, os, zipfile, json, shutil
+import io, base64, os, zipfile, json, shutil, threading, uuid, csv, tempfile, time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future
+from collections import OrderedDict, Counter, deque
 try:
-    from pymongo import MongoClient, ASCENDING
+    from pymongo import MongoClient, ASCENDING, DESCENDING, ReplaceOne, UpdateOne
+    import gridfs
     PYMONGO_AVAILABLE = True
 except ImportError:
     MongoClient = None
     ASCENDING = None
+    DESCENDING = None
+    ReplaceOne = None
+    UpdateOne = None
+    gridfs = None
     PYMONGO_AVAILABLE = False
 from datetime import datetime
 import sys
+from cattle_core import (
+    CLIP_MODEL_NAME, EMBEDDING_DTYPE, ROI_MODEL_PATH, CLS_MODEL_PATH, PROCESSING_MAX_SIDE,
+    FAISS_MAX_DELTAS, FAISS_MAX_TOMBSTONE_RATIO, HERD_STATS_ID, SEARCH_FIELDS,
+    content_hash, decode_image, make_thumbnail, model_file_version,
+    image_blob_update, image_entry, search_fields, cattle_doc,
+    cattle_filter, search_cattle_filter,
+    yolo_result_doc, classification_fields, embedding_cache_key, embedding_cache_doc,
+    pack_vector, unpack_vector, embedding_fields, embedding_doc, averaged_embedding_doc, vector_change,
+    stats_key, stats_name, herd_stats_update,
+    default_faiss_config, faiss_id, encode_faiss_index, decode_faiss_index,
+    faiss_pointer_update, faiss_pointer_query, faiss_deltas_projection, faiss_delta,
+    apply_search_params, apply_faiss_delta, live_vectors, search_index,
+    REEMBED_CHUNK_SIZE, REEMBED_MODES, ReembedJob, reembed_active, reembed_resumable
+)
 
 # Set environment variable to avoid OpenMP conflicts
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
@@ -24,6 +45,49 @@ os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
 # -----------------------------------------------------------------------------
 # MongoDB Database Connection (REQUIRED)
 # -----------------------------------------------------------------------------
+# Every index the app's queries rely on: {collection: [(name, keys, options)]}.
+# Applied idempotently at startup; audit_queries checks the query shapes against them.
+INDEXES = {
+    "cattle_images": [
+        ("12_digit_id_1", [("12_digit_id", ASCENDING)], {"unique": True}),
+        # Keyset pagination order (newest first)
+        ("created_at_-1__id_-1", [("created_at", DESCENDING), ("_id", DESCENDING)], {}),
+        # Lowercased name/class for anchored (index range) prefix search
+        ("name_lc_1", [("name_lc", ASCENDING)], {}),
+        ("class_lc_1", [("class_lc", ASCENDING)], {}),
+    ],
+    "yolo_results": [
+        ("image_id_1", [("image_id", ASCENDING)], {"unique": True}),
+    ],
+    "cattle_embeddings": [
+        # FAISS rebuilds read the current model's vectors in ID order
+        ("model_1__id_1", [("model", ASCENDING), ("_id", ASCENDING)], {}),
+    ],
+}
+
+def ensure_indexes(db):
+    """Create missing declared indexes; returns {"created", "extra", "errors"} lists of "collection.index" names.
+    
+    Existing indexes are never dropped: undeclared ones are only reported as ``extra``.
+    """
+    report = {"created": [], "extra": [], "errors": []}
+    for collection_name, indexes in INDEXES.items():
+        collection = db[collection_name]
+        existing = collection.index_information()
+        for name, keys, options in indexes:
+            if name in existing or any(info.get("key") == keys for info in existing.values()):
+                continue
+            try:
+                collection.create_index(keys, name=name, **options)
+                report["created"].append(f"{collection_name}.{name}")
+            except Exception as e:
+                report["errors"].append(f"{collection_name}.{name}: {e}")
+        declared = {name for name, _, _ in indexes} | {"_id_"}
+        declared_keys = [keys for _, keys, _ in indexes]
+        report["extra"] += [f"{collection_name}.{name}" for name, info in existing.items()
+                            if name not in declared and info.get("key") not in declared_keys]
+    return report
+
 @st.cache_resource
 def get_db():
     """Connect to MongoDB - Required for application functionality"""
@@ -44,10 +108,10 @@ def get_db():
         client = MongoClient(mongodb_uri, connectTimeoutMS=20000, serverSelectionTimeoutMS=20000)
         db = client["cattle_db"]
         
-        # Create indexes for better performance
-        if ASCENDING is not None:
-            db["cattle_images"].create_index([("12_digit_id", ASCENDING)], unique=True)
-            db["yolo_results"].create_index([("image_id", ASCENDING)], unique=True)
+        # Create declared indexes for better performance
+        index_report = ensure_indexes(db)
+        for error in index_report["errors"]:
+            st.warning(f"⚠️ Could not create index {error}")
         
         # Test connection
         client.admin.command('ping')
@@ -61,6 +125,18 @@ db = get_db()
 cattle_collection = db["cattle_images"]
 yolo_collection = db["yolo_results"]
 faiss_index_collection = db["faiss_index"]
+# Packed per-animal and per-image CLIP embeddings, kept out of the image-heavy cattle documents
+embedding_collection = db["cattle_embeddings"]
+# Serialized FAISS index versions, stored in chunks (faiss_blobs.files / faiss_blobs.chunks)
+faiss_blobs = gridfs.GridFS(db, collection="faiss_blobs")
+# Checkpoints of long-running maintenance jobs, one document per job
+job_collection = db["jobs"]
+# Persistent tier of the embedding cache, keyed by model and image content hash
+embedding_cache_collection = db["embedding_cache"]
+# Original image bytes, keyed by content hash and referenced from cattle image entries
+image_blob_collection = db["image_blobs"]
+# Incrementally maintained herd statistics (one document)
+stats_collection = db["herd_stats"]
 
 # -----------------------------------------------------------------------------
 # Load Data.csv
@@ -92,13 +168,18 @@ cattle_df = load_csv()
 # -----------------------------------------------------------------------------
 # Load CLIP Model with error handling
 # -----------------------------------------------------------------------------
+# Images per CLIP forward pass
+CLIP_BATCH_SIZE = int(os.environ.get("CLIP_BATCH_SIZE", 32))
+# Embeddings kept in the in-process cache tier (the MongoDB tier is unbounded)
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", 4096))
+
 @st.cache_resource
 def load_clip_model():
     """Load CLIP model with caching and error handling"""
     try:
         device = "cuda" if torch.cuda.is_available() else "cpu"
         # Use ViT-B/16 for higher resolution and better accuracy
-        model, preprocess = clip.load("ViT-B/16", device=device)
+        model, preprocess = clip.load(CLIP_MODEL_NAME, device=device)
         return model, preprocess, device
     except Exception as e:
         st.error(f"Failed to load CLIP model: {str(e)}")
@@ -116,14 +197,21 @@ def load_yolo_models():
     if not YOLO_AVAILABLE:
         return None, None
     try:
-        roi_model = YOLO("./models/roi_best_600.pt")   # ROI detection model new  
-        cls_model = YOLO("./models/best_25_train8.pt")  # Classification model
+        roi_model = YOLO(ROI_MODEL_PATH)
+        cls_model = YOLO(CLS_MODEL_PATH)
         return roi_model, cls_model
     except Exception as e:
         st.warning(f"YOLO model loading error: {str(e)[:200]}")
         return None, None
 
+@st.cache_resource
+def weights_version(path: str):
+    """model_file_version of a weights file, hashed once per process"""
+    return model_file_version(path)
+
 roi_model, cls_model = load_yolo_models()
+ROI_MODEL_VERSION = weights_version(ROI_MODEL_PATH)
+CLS_MODEL_VERSION = weights_version(CLS_MODEL_PATH)
 
 # -----------------------------------------------------------------------------
 # FAISS Index Setup (MongoDB backed)
@@ -135,34 +223,298 @@ os.makedirs(".streamlit", exist_ok=True)
 
 # Initialize FAISS index
 embedding_dim = 512
-index = faiss.IndexFlatIP(embedding_dim)
+
+# Index backends: "flat" is exact search, "ivf" and "hnsw" are approximate.
+# "auto" picks one from the number of indexed animals.
+FAISS_INDEX_MODES = ["auto", "flat", "ivf", "hnsw"]
+FAISS_INDEX_MODE = os.environ.get("FAISS_INDEX_MODE", "auto").lower()
+IVF_MIN_VECTORS = 10_000     # below this exact search is fast enough
+HNSW_MIN_VECTORS = 100_000   # above this HNSW keeps search sub-millisecond
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 80
+HNSW_EF_SEARCH = 64
+# Vector encodings: "flat" keeps float32 vectors, the others compress them
+# (sqfp16 2x, sq8 4x, pq 16x smaller) at some cost in recall.
+FAISS_ENCODINGS = ["flat", "sqfp16", "sq8", "pq"]
+FAISS_ENCODING = os.environ.get("FAISS_ENCODING", "flat").lower()
+SQ_TYPES = {"sq8": faiss.ScalarQuantizer.QT_8bit, "sqfp16": faiss.ScalarQuantizer.QT_fp16}
+PQ_M = 128             # sub-quantizers of 8 bits -> 128 bytes per vector
+PQ_MIN_VECTORS = 256   # PQ needs at least one training point per centroid
+RECALL_K = 10
+RECALL_SAMPLE = 500
+# A rebuild that keeps losing the publish race to other writers' new versions gives up after this many builds
+FAISS_REBUILD_ATTEMPTS = 3
+
+
+class ReadWriteLock:
+    """Lock allowing many concurrent readers or a single writer"""
+    def __init__(self):
+        self._cond = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writer = False
+
+    @contextmanager
+    def read(self):
+        with self._cond:
+            while self._writer:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self._cond:
+            while self._writer or self._readers > 0:
+                self._cond.wait()
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+class FaissStore:
+    """FAISS index shared by all sessions of this process"""
+    def __init__(self):
+        self.lock = ReadWriteLock()
+        # Rows are keyed by the numeric 12-digit cattle ID
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(embedding_dim))
+        # Requested mode, built backend and search parameters (persisted with the index)
+        self.config = default_faiss_config(FAISS_INDEX_MODE, FAISS_ENCODING)
+        # Version token of the MongoDB copy this index matches (reloaded only when it changes)
+        self.version = None
+        # Number of entries of that version's delta log already applied to the index
+        self.applied = 0
+        # Held by the session rebuilding because maintenance is due
+        self.rebuild_lock = threading.Lock()
+
+@st.cache_resource
+def get_faiss_store():
+    """Create the process-wide FAISS store (once per process)"""
+    return FaissStore()
+
+faiss_store = get_faiss_store()
 
 # -----------------------------------------------------------------------------
 # Helper Functions
 # -----------------------------------------------------------------------------
-def embed_image(img):
-    """Convert image to CLIP embedding"""
+class LRUCache:
+    """Thread-safe bounded mapping that evicts the least recently used entries, with hit/miss counters.
+
+    Bounded by entry count (``max_items``), total size in bytes (``max_bytes``,
+    measured with ``sizeof``) or both.
+    """
+
+    def __init__(self, max_items=None, max_bytes=None, sizeof=len):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.bytes = 0
+        # key -> (value, size)
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return self._data[key][0]
+
+    def put(self, key, value):
+        size = self.sizeof(value) if self.max_bytes is not None else 0
+        if self.max_bytes is not None and size > self.max_bytes:
+            # Would evict everything else and still not fit
+            return
+        with self._lock:
+            if key in self._data:
+                self.bytes -= self._data[key][1]
+            self._data[key] = (value, size)
+            self._data.move_to_end(key)
+            self.bytes += size
+            while ((self.max_items is not None and len(self._data) > self.max_items)
+                   or (self.max_bytes is not None and self.bytes > self.max_bytes)):
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+
+    def __len__(self):
+        return len(self._data)
+
+@st.cache_resource
+def get_embedding_lru():
+    """Process-wide in-memory tier of the embedding cache"""
+    return LRUCache(EMBEDDING_CACHE_SIZE)
+
+embedding_lru = get_embedding_lru()
+
+def get_cached_embeddings(image_hashes):
+    """Look up embeddings by content hash, in memory first, then MongoDB; {hash: vector} of the hits"""
+    found, missing = {}, []
+    for image_hash in set(image_hashes):
+        vec = embedding_lru.get(embedding_cache_key(image_hash))
+        if vec is None:
+            missing.append(image_hash)
+        else:
+            found[image_hash] = vec
+    if missing:
+        try:
+            cursor = embedding_cache_collection.find(
+                {"_id": {"$in": [embedding_cache_key(h) for h in missing]}}, {"hash": 1, "vector": 1, "dtype": 1}
+            )
+            for doc in cursor:
+                vec = unpack_vector(doc["vector"], doc.get("dtype", EMBEDDING_DTYPE))
+                embedding_lru.put(doc["_id"], vec)
+                found[doc["hash"]] = vec
+        except Exception as e:
+            # The cache is an optimization: fall back to embedding
+            st.warning(f"Embedding cache lookup failed: {e}")
+    return found
+
+def put_cached_embeddings(hash_vectors):
+    """Store {hash: vector} in both cache tiers"""
+    if not hash_vectors:
+        return
+    for image_hash, vec in hash_vectors.items():
+        embedding_lru.put(embedding_cache_key(image_hash), np.asarray(vec, dtype=np.float32).reshape(-1))
     try:
-        img_tensor = preprocess(img).unsqueeze(0).to(device)
-        with torch.no_grad():
+        embedding_cache_collection.bulk_write([
+            ReplaceOne({"_id": embedding_cache_key(image_hash)}, embedding_cache_doc(image_hash, vec), upsert=True)
+            for image_hash, vec in hash_vectors.items()
+        ], ordered=False)
+    except Exception as e:
+        st.warning(f"Embedding cache write failed: {e}")
+
+def encode_image_tensors(tensors, batch_size=None):
+    """Encode already preprocessed CLIP input tensors to normalized embeddings (one row per tensor)"""
+    batch_size = batch_size or CLIP_BATCH_SIZE
+    feats = []
+    for start in range(0, len(tensors), batch_size):
+        img_tensor = torch.stack(tensors[start:start + batch_size]).to(device)
+        with torch.inference_mode():
             feat = model.encode_image(img_tensor)
-        feat = feat / feat.norm(dim=-1, keepdim=True)
-        return feat.cpu().numpy()
+            feat = feat / feat.norm(dim=-1, keepdim=True)
+        feats.append(feat.float().cpu().numpy())
+    return np.vstack(feats) if feats else np.empty((0, embedding_dim), dtype=np.float32)
+
+def embed_images(imgs, batch_size=None, hashes=None):
+    """Convert a list of images to CLIP embeddings (one row per image), one forward pass per batch.
+
+    With ``hashes`` (content hashes aligned with ``imgs``, None where unknown)
+    images seen before are served from the embedding cache and not re-embedded.
+    """
+    try:
+        if hashes is None:
+            return encode_image_tensors([preprocess(img) for img in imgs], batch_size=batch_size)
+        
+        cached = get_cached_embeddings([h for h in hashes if h])
+        feats = np.empty((len(imgs), embedding_dim), dtype=np.float32)
+        todo, first_seen = [], {}
+        for i, image_hash in enumerate(hashes):
+            if image_hash in cached:
+                feats[i] = cached[image_hash]
+            elif image_hash and image_hash in first_seen:
+                continue
+            else:
+                todo.append(i)
+                if image_hash:
+                    first_seen[image_hash] = i
+        if todo:
+            feats[todo] = encode_image_tensors([preprocess(imgs[i]) for i in todo], batch_size=batch_size)
+            put_cached_embeddings({hashes[i]: feats[i] for i in todo if hashes[i]})
+        # Duplicates of an image embedded in this call
+        for i, image_hash in enumerate(hashes):
+            if image_hash in first_seen and first_seen[image_hash] != i:
+                feats[i] = feats[first_seen[image_hash]]
+        return feats
     except Exception as e:
-        st.error(f"Error processing image: {str(e)}")
+        st.error(f"Error processing images: {str(e)}")
         return None
 
-def save_yolo_result(image_id: str, roi_conf: float, class_name: str, confidence: float, roi_bbox: list):
-    """Save YOLO classification result to MongoDB"""
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+
+def prepare_image(name: str, raw: bytes):
+    """Decode one upload into the working record shared by ROI detection, classification and CLIP.
+
+    Keys: name, raw (original bytes, stored as-is), hash (content hash),
+    image (working RGB image) and scale (working to original pixel factor).
+    """
+    image, scale = decode_image(raw, PROCESSING_MAX_SIDE)
+    return {"name": name, "raw": raw, "hash": content_hash(raw), "image": image, "scale": scale}
+
+def prepare_upload(f):
+    """prepare_image for an uploaded file object"""
+    return prepare_image(getattr(f, "name", "image"), f.getvalue())
+
+def iter_uploaded_images(files):
+    """Yield (name, raw bytes) for uploaded images, expanding ZIP archives"""
+    for f in files:
+        name = getattr(f, "name", "image")
+        f.seek(0)
+        if name.lower().endswith(".zip"):
+            with zipfile.ZipFile(f) as z:
+                for info in z.infolist():
+                    member = info.filename
+                    if info.is_dir() or member.startswith("__MACOSX/") or not member.lower().endswith(IMAGE_EXTENSIONS):
+                        continue
+                    yield member, z.read(info)
+        elif name.lower().endswith(IMAGE_EXTENSIONS):
+            yield name, f.read()
+
+def identify_images_batch(files, k, batch_size=None):
+    """Decode and embed uploaded images in batches and search them with one matrix query.
+
+    Returns the image names, their (cattle_id, score) hits and the names that could not be decoded.
+    """
+    batch_size = batch_size or CLIP_BATCH_SIZE
+    names, feats, failed = [], [], []
+    pending_names, pending_imgs, pending_hashes = [], [], []
+    
+    def flush():
+        if pending_imgs:
+            batch_feats = embed_images(pending_imgs, batch_size=batch_size, hashes=pending_hashes)
+            if batch_feats is None:
+                failed.extend(pending_names)
+            else:
+                feats.append(batch_feats)
+                names.extend(pending_names)
+            pending_names.clear()
+            pending_imgs.clear()
+            pending_hashes.clear()
+    
+    for name, raw in iter_uploaded_images(files):
+        try:
+            pending_imgs.append(decode_image(raw, PROCESSING_MAX_SIDE)[0])
+            pending_names.append(name)
+            pending_hashes.append(content_hash(raw))
+        except Exception:
+            failed.append(name)
+            continue
+        # Only one batch of decoded images is held in memory at a time
+        if len(pending_imgs) >= batch_size:
+            flush()
+    flush()
+    
+    if not names:
+        return [], [], failed
+    return names, faiss_search_batch(np.vstack(feats), k), failed
+
+def save_yolo_result(image_id: str, roi_conf: float, roi_bbox, class_name=None, confidence=None):
+    """Save YOLO ROI (and optional classification) result to MongoDB, keyed by image content hash"""
     try:
-        doc = {
-            "image_id": image_id,
-            "roi_confidence": roi_conf,
-            "class_name": class_name,
-            "classification_confidence": confidence,
-            "roi_bbox": roi_bbox,
-            "timestamp": datetime.utcnow().isoformat()
-        }
+        doc = yolo_result_doc(image_id, ROI_MODEL_VERSION, roi_conf, roi_bbox)
+        if class_name is not None:
+            doc.update(classification_fields(CLS_MODEL_VERSION, class_name, confidence))
         yolo_collection.replace_one({"image_id": image_id}, doc, upsert=True)
         return True
     except Exception as e:
@@ -170,30 +522,128 @@ def save_yolo_result(image_id: str, roi_conf: float, class_name: str, confidence
         return False
 
 def get_yolo_result(image_id: str):
-    """Get YOLO classification result from MongoDB"""
+    """Get the YOLO result of an image from MongoDB (None unless computed with the current ROI model)"""
     try:
-        return yolo_collection.find_one({"image_id": image_id})
+        return yolo_collection.find_one({"image_id": image_id, "roi_model": ROI_MODEL_VERSION})
     except Exception as e:
         st.error(f"Error retrieving YOLO result: {str(e)}")
         return None
 
-def show_images_with_captions(img_paths, title="Reference Image", from_db=False):
-    """Display images with captions"""
+def detect_roi(item):
+    """Highest-confidence ROI of a prepared image as ([x1, y1, x2, y2], confidence), or (None, 0.0) if none is detected.
+
+    The bbox is in original image pixels. Results are cached in yolo_results
+    by image content hash and ROI model version.
+    """
+    cached = get_yolo_result(item["hash"])
+    if cached:
+        return cached.get("roi_bbox"), cached.get("roi_confidence", 0.0)
+    
+    roi_bbox, roi_conf = None, 0.0
+    roi_results = roi_model.predict(item["image"])
+    if roi_results and len(roi_results[0].boxes) > 0:
+        roi_box = max(roi_results[0].boxes, key=lambda b: b.conf)
+        roi_conf = float(roi_box.conf)
+        roi_bbox = [int(round(v * item["scale"])) for v in roi_box.xyxy[0].tolist()]
+    save_yolo_result(item["hash"], roi_conf, roi_bbox)
+    return roi_bbox, roi_conf
+
+def roi_crop(item, roi_bbox):
+    """Crop a prepared image's working image to an ROI given in original image pixels"""
+    return item["image"].crop(tuple(int(round(v / item["scale"])) for v in roi_bbox))
+
+def classify_roi(item, roi_bbox):
+    """Classify the ROI crop of a prepared image as (class name, confidence), cached like detect_roi"""
+    cached = get_yolo_result(item["hash"])
+    if cached and cached.get("cls_model") == CLS_MODEL_VERSION and cached.get("class_name") is not None:
+        return cached["class_name"], cached.get("classification_confidence", 0.0)
+    
+    results = cls_model.predict(roi_crop(item, roi_bbox))
+    top_result = results[0].probs
+    class_name = cls_model.names[int(top_result.top1)]
+    confidence = float(top_result.top1conf)
+    roi_conf = cached.get("roi_confidence", 0.0) if cached else 0.0
+    save_yolo_result(item["hash"], roi_conf, roi_bbox, class_name, confidence)
+    return class_name, confidence
+
+# Decoded, ready-to-render display images shared by all sessions (bytes budget)
+DISPLAY_CACHE_BYTES = int(os.environ.get("DISPLAY_CACHE_MB", 256)) * 1024 * 1024
+# Longest side of full-size images as displayed (originals stay untouched in the image store)
+DISPLAY_MAX_SIDE = 1280
+DISPLAY_QUALITY = 85
+
+@st.cache_resource
+def get_display_cache():
+    """Process-wide LRU of display image bytes keyed by (kind, filename, content hash)"""
+    return LRUCache(max_bytes=DISPLAY_CACHE_BYTES)
+
+display_cache = get_display_cache()
+
+def display_key(kind: str, img_data):
+    """Display cache key of an image entry; None for legacy inline entries without a content hash"""
+    if not img_data.get("hash"):
+        return None
+    return (kind, img_data.get("filename"), img_data["hash"])
+
+def make_display_image(raw: bytes):
+    """JPEG bytes of an original, downscaled to DISPLAY_MAX_SIDE for rendering"""
+    img, _ = decode_image(raw, DISPLAY_MAX_SIDE)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=DISPLAY_QUALITY)
+    return buf.getvalue()
+
+def display_thumbnail(cattle_id, img_data):
+    """Thumbnail bytes of an image entry ready for st.image (None if unreadable), from the display cache"""
+    key = display_key("thumb", img_data)
+    data = display_cache.get(key) if key else None
+    if data is None:
+        thumb = get_image_thumbnail(cattle_id, img_data)
+        if not thumb:
+            return None
+        data = base64.b64decode(thumb)
+        if key:
+            display_cache.put(key, data)
+    return data
+
+def display_originals(cattle_id):
+    """(image entry, display bytes or None) of all images of one record; only cache misses are read from the image store"""
+    images = get_cattle_images(cattle_id, originals=True)
+    keys = [display_key("full", img_data) for img_data in images]
+    shown = [display_cache.get(key) if key else None for key in keys]
+    missing = [i for i, data in enumerate(shown) if data is None]
+    for i, raw in zip(missing, load_image_originals([images[i] for i in missing])):
+        if not raw:
+            continue
+        try:
+            shown[i] = make_display_image(raw)
+        except Exception:
+            continue
+        if keys[i]:
+            display_cache.put(keys[i], shown[i])
+    return list(zip(images, shown))
+
+def show_images_with_captions(img_paths, title="Reference Image", from_db=False, cattle_id=None, key="images"):
+    """Display images with captions (stored thumbnails for database images)"""
     try:
         if from_db:
-            # Handle base64 encoded images from database
+            # Handle image entries from database: draw the stored thumbnail
             if isinstance(img_paths, list):
                 for i, img_data in enumerate(img_paths):
-                    if isinstance(img_data, dict) and 'b64' in img_data:
+                    if isinstance(img_data, dict) and ('thumb' in img_data or 'hash' in img_data or 'b64' in img_data or cattle_id):
                         try:
-                            raw = base64.b64decode(img_data['b64'])
-                            if len(raw) > 0:
-                                st.image(Image.open(io.BytesIO(raw)), caption=img_data.get('filename', f'Ref {i+1}'), width=120)
+                            thumb = display_thumbnail(cattle_id, img_data)
+                            if thumb:
+                                st.image(thumb, caption=img_data.get('filename', f'Ref {i+1}'), width=120)
                             else:
                                 st.error(f"❌ Empty image data: {img_data.get('filename', f'Ref {i+1}')}")
                         except Exception as e:
                             st.error(f"❌ Invalid image: {img_data.get('filename', f'Ref {i+1}')} - {str(e)[:50]}")
                             continue
+                # Originals are only fetched on request
+                if cattle_id and st.checkbox("Show full-size images", key=f"originals_{key}_{cattle_id}"):
+                    for i, (img_data, data) in enumerate(display_originals(cattle_id)):
+                        if data:
+                            st.image(data, caption=img_data.get('filename', f'Ref {i+1}'))
             return
         
         # Handle file paths (existing functionality)
@@ -211,15 +661,295 @@ def show_images_with_captions(img_paths, title="Reference Image", from_db=False)
     except Exception as e:
         st.error(f"Error displaying images: {str(e)}")
 
+# -----------------------------------------------------------------------------
+# Embedding Storage (cattle_embeddings collection)
+# -----------------------------------------------------------------------------
+# One slim document per animal, keyed by 12-digit ID (layout in cattle_core).
+def save_cattle_embeddings(cattle_id: str, image_vectors):
+    """Replace all stored embeddings of one animal with the given (filename, vector) pairs.
+    
+    Returns the change in animals with a vector, for the caller's herd statistics update.
+    """
+    doc = embedding_doc(image_vectors, embedding_dim)
+    before = embedding_collection.find_one_and_replace({"_id": cattle_id}, doc, projection={"vector": 1}, upsert=True)
+    return vector_change(before, doc["vector"])
+
+# Running-sum edits are conditional on the document they were computed from; after this
+# many lost races the caller recomputes the embeddings from the record instead
+EMBEDDING_UPDATE_ATTEMPTS = 5
+
+def add_image_embeddings(cattle_id: str, image_vectors):
+    """Add (filename, vector) pairs to an animal's running embedding; False if it has no running sum yet"""
+    vectors = [np.asarray(vec, dtype=np.float32).reshape(-1) for _, vec in image_vectors]
+    entries = [{"filename": filename, "vector": pack_vector(vec)} for (filename, _), vec in zip(image_vectors, vectors)]
+    for _ in range(EMBEDDING_UPDATE_ATTEMPTS):
+        emb_doc = embedding_collection.find_one({"_id": cattle_id}, {"sum": 1, "count": 1, "dtype": 1, "model": 1, "updated_at": 1})
+        if (not emb_doc or emb_doc.get("sum") is None
+                or emb_doc.get("model") != CLIP_MODEL_NAME or emb_doc.get("dtype") != EMBEDDING_DTYPE):
+            return False
+        
+        embedding_sum = unpack_vector(emb_doc["sum"], np.float32) + np.sum(vectors, axis=0)
+        fields = embedding_fields(embedding_sum, emb_doc.get("count", 0) + len(vectors))
+        fields["updated_at"] = datetime.utcnow().isoformat()
+        # Applied only if no other edit (or re-embed) changed the sum since it was read
+        before = embedding_collection.find_one_and_update(
+            {"_id": cattle_id, "count": emb_doc.get("count"), "updated_at": emb_doc.get("updated_at")},
+            {"$push": {"images": {"$each": entries}}, "$set": fields},
+            projection={"vector": 1}
+        )
+        if before is not None:
+            update_herd_stats(with_embeddings=vector_change(before, fields["vector"]))
+            return True
+    return False
+
+def remove_image_embedding(cattle_id: str, image_filename: str):
+    """Subtract one image's embedding from an animal's running sum; False if it has no running sum yet"""
+    for _ in range(EMBEDDING_UPDATE_ATTEMPTS):
+        emb_doc = embedding_collection.find_one(
+            {"_id": cattle_id},
+            {"sum": 1, "count": 1, "dtype": 1, "updated_at": 1, "images": {"$elemMatch": {"filename": image_filename}}}
+        )
+        if not emb_doc or emb_doc.get("sum") is None:
+            return False
+        removed = (emb_doc.get("images") or [None])[0]
+        if removed is None:
+            # Image was never embedded: nothing to subtract
+            return True
+        
+        embedding_sum = unpack_vector(emb_doc["sum"], np.float32) - unpack_vector(removed["vector"], emb_doc.get("dtype", EMBEDDING_DTYPE))
+        fields = embedding_fields(embedding_sum, emb_doc.get("count", 0) - 1)
+        fields["updated_at"] = datetime.utcnow().isoformat()
+        before = embedding_collection.find_one_and_update(
+            {"_id": cattle_id, "count": emb_doc.get("count"), "updated_at": emb_doc.get("updated_at")},
+            {"$pull": {"images": {"filename": image_filename}}, "$set": fields},
+            projection={"vector": 1}
+        )
+        if before is not None:
+            # The last embedded image takes the animal's vector with it
+            update_herd_stats(with_embeddings=vector_change(before, fields["vector"]))
+            return True
+    return False
+
+def get_cattle_embedding(cattle_id: str):
+    """Get one animal's normalized embedding as a float32 vector (None if missing)"""
+    emb_doc = embedding_collection.find_one({"_id": cattle_id, "model": CLIP_MODEL_NAME}, {"vector": 1, "dtype": 1})
+    if not emb_doc or emb_doc.get("vector") is None:
+        return None
+    return unpack_vector(emb_doc["vector"], emb_doc.get("dtype", EMBEDDING_DTYPE))
+
+def get_embedded_ids(cattle_ids=None):
+    """Set of cattle IDs (optionally restricted to ``cattle_ids``) that have an embedding"""
+    q = {"vector": {"$ne": None}}
+    if cattle_ids is not None:
+        q["_id"] = {"$in": list(cattle_ids)}
+    return {doc["_id"] for doc in embedding_collection.find(q, {"_id": 1})}
+
+@st.cache_resource
+def migrate_legacy_embeddings():
+    """Move embeddings stored inside cattle documents to the embeddings collection (once per process)"""
+    legacy = {"$or": [{"embedding": {"$exists": True}}, {"embedding_sum": {"$exists": True}}]}
+    projection = {"12_digit_id": 1, "embedding": 1, "images.filename": 1, "images.embedding": 1}
+    moved = with_embeddings = 0
+    try:
+        for doc in cattle_collection.find(legacy, projection):
+            cattle_id = doc.get("12_digit_id")
+            image_vectors = [(img["filename"], img["embedding"]) for img in doc.get("images", [])
+                             if img.get("embedding") is not None]
+            if cattle_id and image_vectors:
+                with_embeddings += save_cattle_embeddings(cattle_id, image_vectors)
+            elif cattle_id and doc.get("embedding"):
+                # Averaged embedding only: keep it searchable, image vectors are backfilled on first edit
+                averaged = averaged_embedding_doc(doc["embedding"], embedding_dim)
+                before = embedding_collection.find_one_and_replace({"_id": cattle_id}, averaged, projection={"vector": 1}, upsert=True)
+                with_embeddings += vector_change(before, averaged["vector"])
+            
+            unset = {"embedding": "", "embedding_sum": "", "embedding_count": ""}
+            if "images" in doc:
+                unset["images.$[].embedding"] = ""
+            cattle_collection.update_one({"_id": doc["_id"]}, {"$unset": unset})
+            moved += 1
+    except Exception as e:
+        st.error(f"Error migrating embeddings: {e}")
+    update_herd_stats(with_embeddings=with_embeddings)
+    return moved
+
+# -----------------------------------------------------------------------------
+# Image Store (image_blobs collection)
+# -----------------------------------------------------------------------------
+# One document per distinct image:
+#   {_id: sha256 of the bytes, data: raw bytes, size, refcount, created_at}
+# Cattle image entries reference it by "hash", so identical uploads are stored once.
+# Records saved by older versions keep base64 bytes inline ("b64") until migrated.
+def put_image_blob(raw: bytes):
+    """Store image bytes, or take another reference to identical stored bytes; returns the content hash"""
+    image_hash = content_hash(raw)
+    image_blob_collection.update_one({"_id": image_hash}, image_blob_update(raw), upsert=True)
+    return image_hash
+
+def release_image_blobs(hashes):
+    """Drop one reference per listed hash and delete blobs that are no longer referenced"""
+    counts = Counter(h for h in hashes if h)
+    if not counts:
+        return
+    image_blob_collection.bulk_write(
+        [UpdateOne({"_id": h}, {"$inc": {"refcount": -n}}) for h, n in counts.items()], ordered=False
+    )
+    image_blob_collection.delete_many({"_id": {"$in": list(counts)}, "refcount": {"$lte": 0}})
+
+def get_image_blobs(hashes):
+    """Raw bytes of stored images keyed by content hash, in one query"""
+    if not hashes:
+        return {}
+    cursor = image_blob_collection.find({"_id": {"$in": list(set(hashes))}}, {"data": 1})
+    return {doc["_id"]: bytes(doc["data"]) for doc in cursor}
+
+def load_image_originals(images):
+    """Original bytes of cattle image entries, in order (None where missing or unreadable)"""
+    blobs = get_image_blobs([img["hash"] for img in images if img.get("hash")])
+    originals = []
+    for img in images:
+        raw = None
+        if img.get("hash"):
+            raw = blobs.get(img["hash"])
+        elif img.get("b64"):
+            try:
+                raw = base64.b64decode(img["b64"])
+            except Exception:
+                raw = None
+        originals.append(raw or None)
+    return originals
+
+def new_image_entry(filename: str, raw: bytes):
+    """Image entry of a cattle document for newly stored bytes: blob reference, size and thumbnail"""
+    # Thumbnail first: an undecodable upload raises before a blob reference is taken
+    thumb = make_thumbnail(raw)
+    return image_entry(filename, put_image_blob(raw), len(raw), thumb)
+
+def migrate_inline_images(chunk_size=50):
+    """Move base64 images stored inside cattle documents to the image store; returns the number moved"""
+    inline = {"images.b64": {"$exists": True}}
+    moved = 0
+    while True:
+        docs = list(cattle_collection.find(inline, {"images.filename": 1, "images.b64": 1, "images.thumb": 1}).limit(chunk_size))
+        if not docs:
+            break
+        for doc in docs:
+            update = {"$set": {}, "$unset": {}}
+            filters, hashes = [], []
+            for n, img in enumerate(img for img in doc.get("images", []) if "b64" in img):
+                filters.append({f"m{n}.filename": img.get("filename")})
+                update["$unset"][f"images.$[m{n}].b64"] = ""
+                try:
+                    raw = base64.b64decode(img["b64"])
+                except Exception:
+                    raw = b""
+                if not raw:
+                    # Not an image: nothing worth moving
+                    continue
+                hashes.append(put_image_blob(raw))
+                update["$set"][f"images.$[m{n}].hash"] = hashes[-1]
+                update["$set"][f"images.$[m{n}].size"] = len(raw)
+                if "thumb" not in img:
+                    try:
+                        update["$set"][f"images.$[m{n}].thumb"] = make_thumbnail(raw)
+                    except Exception:
+                        update["$set"][f"images.$[m{n}].thumb"] = ""
+            if not update["$set"]:
+                del update["$set"]
+            result = cattle_collection.update_one({"_id": doc["_id"]}, update, array_filters=filters)
+            if result.modified_count == 0:
+                # The record changed or vanished meanwhile; it is picked up again if still inline
+                release_image_blobs(hashes)
+            else:
+                moved += len(hashes)
+    return moved
+
+@st.cache_resource
+def start_image_migration():
+    """Migrate inline images in a background thread (once per process); readers handle both layouts meanwhile"""
+    thread = threading.Thread(target=migrate_inline_images, name="image-migration", daemon=True)
+    thread.start()
+    return thread
+
+# -----------------------------------------------------------------------------
+# Herd Statistics (herd_stats collection)
+# -----------------------------------------------------------------------------
+# A single document, updated with $inc by every register/update/delete:
+#   {_id: "herd", records, images, with_embeddings,
+#    classes: {class: records}, image_counts: {"<images per record>": records}}
+# reconcile_herd_stats recomputes it from the collections to fix drift.
+def update_herd_stats(records=0, images=0, with_embeddings=0, classes=None, image_counts=None):
+    """Atomically apply deltas to the herd statistics; ``classes``/``image_counts`` map keys to deltas"""
+    update = herd_stats_update(records, images, with_embeddings, classes, image_counts)
+    if update is None:
+        return
+    try:
+        stats_collection.update_one({"_id": HERD_STATS_ID}, update, upsert=True)
+    except Exception as e:
+        st.warning(f"Could not update herd statistics: {e}")
+
+def compute_herd_stats():
+    """Recompute the herd statistics from the collections (O(herd), image arrays sized server side)"""
+    stats = {"records": 0, "images": 0, "classes": {}, "image_counts": {}}
+    cursor = cattle_collection.aggregate([
+        {"$project": {"cattle_class": 1, "n": {"$size": {"$ifNull": ["$images", []]}}}}
+    ])
+    for doc in cursor:
+        class_key = stats_key(doc.get("cattle_class", "Unknown"))
+        stats["records"] += 1
+        stats["images"] += doc["n"]
+        stats["classes"][class_key] = stats["classes"].get(class_key, 0) + 1
+        stats["image_counts"][str(doc["n"])] = stats["image_counts"].get(str(doc["n"]), 0) + 1
+    stats["with_embeddings"] = embedding_collection.count_documents({"vector": {"$ne": None}})
+    return stats
+
+def reconcile_herd_stats():
+    """Overwrite the herd statistics with recomputed values; returns {field: (stored, actual)} of what drifted"""
+    actual = compute_herd_stats()
+    stored = stats_collection.find_one({"_id": HERD_STATS_ID}) or {}
+    drift = {}
+    for field in ("records", "images", "with_embeddings"):
+        if stored.get(field, 0) != actual[field]:
+            drift[field] = (stored.get(field, 0), actual[field])
+    for field in ("classes", "image_counts"):
+        current = {k: v for k, v in stored.get(field, {}).items() if v}
+        if current != actual[field]:
+            drift[field] = (current, actual[field])
+    now = datetime.utcnow().isoformat()
+    stats_collection.replace_one(
+        {"_id": HERD_STATS_ID}, {**actual, "updated_at": now, "reconciled_at": now}, upsert=True
+    )
+    return drift
+
+def get_herd_stats():
+    """Current herd statistics with decoded class names (zero buckets dropped)"""
+    stats = stats_collection.find_one({"_id": HERD_STATS_ID}) or {}
+    return {
+        "records": stats.get("records", 0),
+        "images": stats.get("images", 0),
+        "with_embeddings": stats.get("with_embeddings", 0),
+        "classes": {stats_name(k): v for k, v in stats.get("classes", {}).items() if v},
+        "image_counts": {int(k): v for k, v in stats.get("image_counts", {}).items() if v},
+        "reconciled_at": stats.get("reconciled_at")
+    }
+
+@st.cache_resource
+def ensure_herd_stats():
+    """Build the herd statistics document if it does not exist yet (once per process)"""
+    if stats_collection.find_one({"_id": HERD_STATS_ID}, {"_id": 1}) is None:
+        reconcile_herd_stats()
+    return True
+
 # -----------------------------------------------------------------------------
 # MongoDB Helper Functions
 # -----------------------------------------------------------------------------
-def save_new_cattle_to_db(cattle_id: str, cattle_name: str, cattle_class: str, image_files, embeddings=None):
-    """Save new cattle to MongoDB with images and embeddings"""
+def save_new_cattle_to_db(cattle_id: str, cattle_name: str, cattle_class: str, image_files, embeddings=None, image_embeddings=None, image_rois=None):
+    """Save new cattle to MongoDB with images, per-image embeddings and ROIs (aligned with ``image_files``)"""
     # MongoDB is now required, no need to check
         
     created_at = datetime.utcnow().isoformat()
     image_entries = []
+    image_vectors = []
     
     for i, f in enumerate(image_files, start=1):
         try:
@@ -241,48 +971,216 @@ def save_new_cattle_to_db(cattle_id: str, cattle_name: str, cattle_class: str, i
                     continue
                 ext = ".jpg"
             
-            b64 = base64.b64encode(raw).decode("utf-8")
             filename = f"{cattle_id}_{i}{ext}"
-            image_entries.append({"filename": filename, "b64": b64})
+            image_entry = new_image_entry(filename, raw)
+            if image_rois is not None and image_rois[i - 1]:
+                image_entry.update(image_rois[i - 1])
+            image_entries.append(image_entry)
+            if image_embeddings is not None and image_embeddings[i - 1] is not None:
+                image_vectors.append((filename, image_embeddings[i - 1]))
         except Exception as e:
             st.error(f"Error processing image {i}: {str(e)}")
             continue
 
-    doc = {
-        "12_digit_id": cattle_id,
-        "cattle_name": cattle_name,
-        "cattle_class": cattle_class,
-        "images": image_entries,
-        "embedding": embeddings.flatten().tolist() if embeddings is not None else None,
-        "created_at": created_at
-    }
+    doc = cattle_doc(cattle_id, cattle_name, cattle_class, image_entries, created_at)
     
     try:
         cattle_collection.insert_one(doc)
+        with_embeddings = 0
+        if image_vectors:
+            with_embeddings = save_cattle_embeddings(cattle_id, image_vectors)
+        elif embeddings is not None:
+            averaged = averaged_embedding_doc(embeddings, embedding_dim)
+            before = embedding_collection.find_one_and_replace({"_id": cattle_id}, averaged, projection={"vector": 1}, upsert=True)
+            with_embeddings = vector_change(before, averaged["vector"])
+        update_herd_stats(
+            records=1, images=len(image_entries), with_embeddings=with_embeddings,
+            classes={cattle_class: 1}, image_counts={len(image_entries): 1}
+        )
         return doc
     except Exception as e:
+        release_image_blobs([img["hash"] for img in image_entries])
         st.error(f"Error saving to MongoDB: {e}")
         return None
 
-def get_cattle_by_id(cattle_id: str):
+# Projection of cattle documents with image metadata and thumbnails, but without inline originals
+WITHOUT_ORIGINALS = {"images.b64": 0}
+# Projection of cattle documents for metadata queries: image references only
+METADATA_ONLY = {"images.b64": 0, "images.thumb": 0}
+
+def get_cattle_by_id(cattle_id: str, projection=None):
     """Get cattle record by ID from MongoDB"""
-    return cattle_collection.find_one({"12_digit_id": cattle_id})
+    return cattle_collection.find_one({"12_digit_id": cattle_id}, projection)
 
-def list_cattle_from_db(filter_id=None, filter_name=None, limit=100):
-    """List cattle from MongoDB with optional filters"""
-        
-    q = {}
-    if filter_id:
-        q["12_digit_id"] = {"$regex": f"^{filter_id}"}
-    if filter_name:
-        q["cattle_name"] = {"$regex": filter_name, "$options": "i"}
+def get_cattle_details(cattle_ids):
+    """Get lightweight metadata (no images) for the given cattle IDs, keyed by ID"""
+    if not cattle_ids:
+        return {}
+    try:
+        cursor = cattle_collection.find(
+            {"12_digit_id": {"$in": list(cattle_ids)}},
+            {"_id": 0, "12_digit_id": 1, "cattle_name": 1, "cattle_class": 1}
+        )
+        return {doc["12_digit_id"]: doc for doc in cursor}
+    except Exception as e:
+        st.error(f"Error loading cattle details: {e}")
+        return {}
+
+def get_cattle_images(cattle_id: str, originals=False):
+    """Get only the stored image entries of one cattle record (thumbnails only unless ``originals``)"""
+    try:
+        projection = {"_id": 0, "images.filename": 1, "images.hash": 1, "images.b64": 1} if originals else {"_id": 0, "images.filename": 1, "images.hash": 1, "images.thumb": 1}
+        doc = cattle_collection.find_one({"12_digit_id": cattle_id}, projection)
+        return doc.get("images", []) if doc else []
+    except Exception as e:
+        st.error(f"Error loading images: {e}")
+        return []
+
+def get_image_thumbnail(cattle_id, img_data):
+    """Stored base64 thumbnail of an image entry; legacy entries get one built from the original and saved"""
+    if "thumb" in img_data:
+        # Empty for images that could not be decoded
+        return img_data["thumb"] or None
+    if not (img_data.get("hash") or img_data.get("b64")) and cattle_id:
+        doc = cattle_collection.find_one(
+            {"12_digit_id": cattle_id},
+            {"images": {"$elemMatch": {"filename": img_data.get("filename")}}}
+        )
+        img_data = ((doc or {}).get("images") or [{}])[0]
+    raw = load_image_originals([img_data])[0]
+    if not raw:
+        return None
+    thumb = make_thumbnail(raw)
+    if cattle_id:
+        cattle_collection.update_one(
+            {"12_digit_id": cattle_id, "images.filename": img_data.get("filename")},
+            {"$set": {"images.$.thumb": thumb}}
+        )
+    return thumb
+
+def backfill_thumbnails(chunk_size=50, progress=None):
+    """Generate missing thumbnails of stored images; returns the number created.
+
+    Only records with an image lacking a thumbnail are read, so an
+    interrupted run simply continues on the next call.
+    """
+    missing = {"images": {"$elemMatch": {"thumb": {"$exists": False}}}}
+    total = cattle_collection.count_documents(missing)
+    created, done = 0, 0
+    
+    def build(raw):
+        try:
+            return make_thumbnail(raw)
+        except Exception:
+            return None
+    
+    with ThreadPoolExecutor(max_workers=REEMBED_WORKERS) as pool:
+        while True:
+            docs = list(cattle_collection.find(
+                missing, {"12_digit_id": 1, "images.filename": 1, "images.hash": 1, "images.b64": 1, "images.thumb": 1}
+            ).limit(chunk_size))
+            if not docs:
+                break
+            ops = []
+            for doc in docs:
+                todo = [img for img in doc.get("images", []) if "thumb" not in img]
+                thumbs = list(pool.map(build, load_image_originals(todo)))
+                # Unreadable images get an empty thumbnail so they are not retried forever
+                update = {f"images.$[t{n}].thumb": thumb or "" for n, thumb in enumerate(thumbs)}
+                filters = [{f"t{n}.filename": img["filename"]} for n, img in enumerate(todo)]
+                ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": update}, array_filters=filters))
+                created += sum(1 for thumb in thumbs if thumb)
+            cattle_collection.bulk_write(ops, ordered=False)
+            done += len(docs)
+            if progress is not None:
+                progress(min(done / total, 1.0) if total else 1.0)
+    return created
+
+def backfill_search_fields(chunk_size=500):
+    """Add search fields to records created before they existed; returns the number updated"""
+    missing = {"$or": [{field: {"$exists": False}} for field in SEARCH_FIELDS.values()]}
+    updated = 0
+    while True:
+        docs = list(cattle_collection.find(missing, {field: 1 for field in SEARCH_FIELDS}).limit(chunk_size))
+        if not docs:
+            break
+        cattle_collection.bulk_write([
+            UpdateOne({"_id": doc["_id"]}, {"$set": search_fields({field: doc.get(field) for field in SEARCH_FIELDS})})
+            for doc in docs
+        ], ordered=False)
+        updated += len(docs)
+    return updated
+
+@st.cache_resource
+def start_search_backfill():
+    """Backfill search fields in a background thread (once per process)"""
+    thread = threading.Thread(target=backfill_search_fields, name="search-backfill", daemon=True)
+    thread.start()
+    return thread
+
+# Page order of list_cattle_page, backed by the created_at/_id index
+PAGE_SORT = {"created_at": -1, "_id": -1}
+
+def page_filter(q=None, after=None):
+    """``q`` restricted to records after the keyset cursor ``after`` = (created_at, _id)"""
+    match = dict(q or {})
+    if after is not None:
+        created_at, last_id = after
+        keyset = {"$or": [{"created_at": created_at, "_id": {"$lt": last_id}}]}
+        if created_at is not None:
+            # Records without created_at sort after all dated ones
+            keyset["$or"] += [{"created_at": {"$lt": created_at}}, {"created_at": None}]
+        match = {"$and": [match, keyset]} if match else keyset
+    return match
+
+def list_cattle_page(q=None, page_size=20, after=None):
+    """One page of lightweight rows (no image data), newest first, starting after the keyset cursor ``after``.
     
+    Returns (rows, next_cursor); next_cursor is None on the last page. Rows carry an
+    ``image_count`` computed server side instead of the image array.
+    """
     try:
-        cursor = cattle_collection.find(q).sort("created_at", -1).limit(limit)
-        return list(cursor)
+        rows = list(cattle_collection.aggregate([
+            {"$match": page_filter(q, after)},
+            {"$sort": PAGE_SORT},
+            {"$limit": page_size + 1},
+            {"$project": {"12_digit_id": 1, "cattle_name": 1, "cattle_class": 1, "created_at": 1,
+                          "image_count": {"$size": {"$ifNull": ["$images", []]}}}}
+        ]))
     except Exception as e:
         st.error(f"Error querying MongoDB: {e}")
-        return []
+        return [], None
+    if len(rows) <= page_size:
+        return rows, None
+    rows = rows[:page_size]
+    return rows, (rows[-1].get("created_at"), rows[-1]["_id"])
+
+def paginated_cattle(key, q=None, page_size=20):
+    """Render Previous/Next controls and return the current page of ``list_cattle_page``.
+    
+    The start cursor of every visited page is kept in ``st.session_state[key]``; it is
+    reset whenever the filter or page size changes.
+    """
+    signature = (repr(q), page_size)
+    state = st.session_state.get(key)
+    if state is None or state["signature"] != signature:
+        state = st.session_state[key] = {"signature": signature, "cursors": [None]}
+    cursors = state["cursors"]
+    
+    rows, next_cursor = list_cattle_page(q, page_size, after=cursors[-1])
+    
+    col1, col2, col3 = st.columns([1, 2, 1])
+    with col1:
+        if st.button("⬅️ Previous", key=f"{key}_prev", disabled=len(cursors) == 1):
+            cursors.pop()
+            st.rerun()
+    with col2:
+        st.caption(f"Page {len(cursors)}")
+    with col3:
+        if st.button("Next ➡️", key=f"{key}_next", disabled=next_cursor is None):
+            cursors.append(next_cursor)
+            st.rerun()
+    return rows
 
 def update_cattle_in_db(cattle_id: str, updates: dict):
     """Update cattle record in MongoDB"""
@@ -290,48 +1188,130 @@ def update_cattle_in_db(cattle_id: str, updates: dict):
         return False
     
     try:
-        result = cattle_collection.update_one(
+        before = cattle_collection.find_one_and_update(
             {"12_digit_id": cattle_id},
-            {"$set": updates}
+            {"$set": {**updates, **search_fields(updates)}},
+            projection={field: 1 for field in updates}
         )
-        return result.modified_count > 0
+        if before is None:
+            return False
+        if "cattle_class" in updates and before.get("cattle_class", "Unknown") != updates["cattle_class"]:
+            update_herd_stats(classes={before.get("cattle_class", "Unknown"): -1, updates["cattle_class"]: 1})
+        return any(before.get(field) != value for field, value in updates.items())
     except Exception as e:
         st.error(f"Error updating cattle: {e}")
         return False
 
+def backfill_image_embeddings(cattle_id: str, known_vectors=None):
+    """Embed stored images without a per-image embedding (legacy records) and recompute the running sum"""
+    try:
+        doc = cattle_collection.find_one({"12_digit_id": cattle_id}, {"images.filename": 1, "images.hash": 1, "images.b64": 1})
+        if not doc:
+            return False
+        
+        # Reuse image vectors already stored for the current model
+        emb_doc = embedding_collection.find_one({"_id": cattle_id}, {"images": 1, "dtype": 1, "model": 1}) or {}
+        known = {}
+        if emb_doc.get("model", CLIP_MODEL_NAME) == CLIP_MODEL_NAME:
+            known = {entry["filename"]: unpack_vector(entry["vector"], emb_doc.get("dtype", EMBEDDING_DTYPE))
+                     for entry in emb_doc.get("images", [])}
+        known.update(known_vectors or {})
+        
+        # Decode the images that still need a vector and embed them in one batch
+        missing_names, missing_imgs, missing_hashes = [], [], []
+        todo = [img_data for img_data in doc.get("images", []) if img_data.get("filename") not in known]
+        for img_data, raw in zip(todo, load_image_originals(todo)):
+            if raw:
+                try:
+                    missing_imgs.append(decode_image(raw, PROCESSING_MAX_SIDE)[0])
+                    missing_names.append(img_data["filename"])
+                    missing_hashes.append(content_hash(raw))
+                except Exception as e:
+                    st.warning(f"Skipping corrupted image: {img_data.get('filename', 'unknown')}")
+                    continue
+        if missing_imgs:
+            feats = embed_images(missing_imgs, hashes=missing_hashes)
+            if feats is not None:
+                known.update(zip(missing_names, feats))
+        
+        image_vectors = [(img_data["filename"], known[img_data["filename"]])
+                         for img_data in doc.get("images", []) if img_data.get("filename") in known]
+        update_herd_stats(with_embeddings=save_cattle_embeddings(cattle_id, image_vectors))
+        return True
+    except Exception as e:
+        st.error(f"Error backfilling image embeddings: {e}")
+        return False
+
 def delete_cattle_image_from_db(cattle_id: str, image_filename: str):
-    """Remove a specific image from cattle record"""
+    """Remove a specific image from cattle record and subtract its embedding"""
     if cattle_collection is None:
         return False
     
     try:
-        result = cattle_collection.update_one(
-            {"12_digit_id": cattle_id},
-            {"$pull": {"images": {"filename": image_filename}}}
+        before = cattle_collection.find_one_and_update(
+            {"12_digit_id": cattle_id, "images.filename": image_filename},
+            {"$pull": {"images": {"filename": image_filename}},
+             "$set": {"images_updated_at": datetime.utcnow().isoformat()}},
+            projection={"images.filename": 1, "images.hash": 1}
         )
-        return result.modified_count > 0
+        if before is None:
+            return False
+        images = before.get("images", [])
+        release_image_blobs([img.get("hash") for img in images if img.get("filename") == image_filename])
+        removed_count = sum(1 for img in images if img.get("filename") == image_filename)
+        update_herd_stats(images=-removed_count, image_counts={len(images): -1, len(images) - removed_count: 1})
+        if not remove_image_embedding(cattle_id, image_filename):
+            # Legacy record (or edits kept racing): recompute from its remaining images
+            backfill_image_embeddings(cattle_id)
+        return True
     except Exception as e:
         st.error(f"Error removing image: {e}")
         return False
 
-def add_cattle_images_to_db(cattle_id: str, new_images):
-    """Add new images to existing cattle record"""
+def delete_cattle_from_db(cattle_ids):
+    """Delete cattle records with their embeddings and image references; returns the number deleted"""
+    cattle_ids = list(cattle_ids)
+    docs = list(cattle_collection.find({"12_digit_id": {"$in": cattle_ids}}, {"cattle_class": 1, "images.hash": 1}))
+    with_embeddings = embedding_collection.count_documents({"_id": {"$in": cattle_ids}, "vector": {"$ne": None}})
+    result = cattle_collection.delete_many({"12_digit_id": {"$in": cattle_ids}})
+    embedding_collection.delete_many({"_id": {"$in": cattle_ids}})
+    release_image_blobs([img.get("hash") for doc in docs for img in doc.get("images", [])])
+    
+    classes, image_counts = Counter(), Counter()
+    for doc in docs:
+        classes[doc.get("cattle_class", "Unknown")] -= 1
+        image_counts[len(doc.get("images", []))] -= 1
+    update_herd_stats(
+        records=-len(docs), images=-sum(len(doc.get("images", [])) for doc in docs),
+        with_embeddings=-with_embeddings, classes=classes, image_counts=image_counts
+    )
+    return result.deleted_count
+
+def add_cattle_images_to_db(cattle_id: str, new_images, new_embeddings=None, new_rois=None):
+    """Add new images (and their embeddings and ROIs, aligned with ``new_images``) to existing cattle record"""
     if cattle_collection is None:
         return False
     
     try:
-        # Get current cattle record
-        cattle = get_cattle_by_id(cattle_id)
+        # Get current cattle record (without image data)
+        cattle = cattle_collection.find_one({"12_digit_id": cattle_id}, {"images.filename": 1})
         if not cattle:
             return False
         
         # Get current image count
         current_images = cattle.get("images", [])
+        used_names = {os.path.splitext(img.get("filename", ""))[0] for img in current_images}
         start_idx = len(current_images) + 1
         
         # Process new images
         image_entries = []
-        for i, f in enumerate(new_images, start=start_idx):
+        image_vectors = []
+        for pos, f in enumerate(new_images):
+            # Don't reuse a filename left behind by a removed image
+            while f"{cattle_id}_{start_idx}" in used_names:
+                start_idx += 1
+            i = start_idx
+            start_idx += 1
             try:
                 if hasattr(f, 'read'):
                     f.seek(0)  # Reset file pointer FIRST
@@ -349,9 +1329,13 @@ def add_cattle_images_to_db(cattle_id: str, new_images):
                         continue
                     ext = ".jpg"
                 
-                b64 = base64.b64encode(raw).decode("utf-8")
                 filename = f"{cattle_id}_{i}{ext}"
-                image_entries.append({"filename": filename, "b64": b64})
+                image_entry = new_image_entry(filename, raw)
+                if new_rois is not None and new_rois[pos]:
+                    image_entry.update(new_rois[pos])
+                image_entries.append(image_entry)
+                if new_embeddings is not None and new_embeddings[pos] is not None:
+                    image_vectors.append((filename, new_embeddings[pos]))
             except Exception as e:
                 st.error(f"Error processing additional image {i}: {str(e)}")
                 continue
@@ -359,156 +1343,740 @@ def add_cattle_images_to_db(cattle_id: str, new_images):
         # Add new images to database
         result = cattle_collection.update_one(
             {"12_digit_id": cattle_id},
-            {"$push": {"images": {"$each": image_entries}}}
+            {"$push": {"images": {"$each": image_entries}},
+             "$set": {"images_updated_at": datetime.utcnow().isoformat()}}
         )
-        return result.modified_count > 0
+        if result.modified_count == 0:
+            # Record deleted meanwhile: don't recreate embeddings for it
+            release_image_blobs([img["hash"] for img in image_entries])
+            return False
+        if image_entries:
+            update_herd_stats(images=len(image_entries), image_counts={
+                len(current_images): -1, len(current_images) + len(image_entries): 1
+            })
+        
+        # Update the running embedding sum incrementally
+        if image_vectors and not add_image_embeddings(cattle_id, image_vectors):
+            # Legacy record without a running sum (or edits kept racing): recompute it once, reusing the new vectors
+            backfill_image_embeddings(cattle_id, known_vectors=dict(image_vectors))
+        return True
     except Exception as e:
         st.error(f"Error adding images: {e}")
         return False
 
-def save_faiss_to_mongodb(index, ordered_ids):
-    """Save FAISS index and ordered IDs to MongoDB"""
+def choose_index_mode(ntotal: int):
+    """Pick an index backend from the number of vectors"""
+    if ntotal < IVF_MIN_VECTORS:
+        return "flat"
+    if ntotal < HNSW_MIN_VECTORS:
+        return "ivf"
+    return "hnsw"
+
+def resolve_index_spec(mode: str, encoding: str, n: int):
+    """Backend and encoding actually built for a requested mode/encoding over ``n`` vectors.
+
+    Returns (mode, encoding, notes); ``notes`` explain the fallbacks that were applied.
+    """
+    notes = []
+    if mode == "auto":
+        mode = choose_index_mode(n)
+    
+    # Fall back to what can be trained on the stored embeddings
+    if encoding == "pq" and n < PQ_MIN_VECTORS:
+        notes.append(f"PQ needs at least {PQ_MIN_VECTORS} vectors to train; using SQ8 instead.")
+        encoding = "sq8"
+    if encoding == "sq8" and n == 0:
+        encoding = "flat"
+    if mode == "hnsw" and encoding == "pq":
+        notes.append("HNSW does not support PQ vectors here; using IVF-PQ instead.")
+        mode = "ivf"
+    if mode == "ivf" and n == 0:
+        mode = "flat"
+    return mode, encoding, notes
+
+def create_faiss_index(mode: str, embeddings, encoding: str = "flat"):
+    """Create and train an index of the given mode and vector encoding on the embeddings matrix.
+
+    Returns the (empty) ID-mapped index, the backend and encoding actually built and its search parameters.
+    """
+    n = len(embeddings)
+    mode, encoding, notes = resolve_index_spec(mode, encoding, n)
+    for note in notes:
+        st.warning(note)
+    
+    metric = faiss.METRIC_INNER_PRODUCT
+    if mode == "ivf":
+        # ~4*sqrt(n) lists, keeping at least 39 training points per list
+        nlist = int(max(1, min(4 * np.sqrt(n), n // 39)))
+        quantizer = faiss.IndexFlatIP(embedding_dim)
+        if encoding == "pq":
+            index = faiss.IndexIVFPQ(quantizer, embedding_dim, nlist, PQ_M, 8, metric)
+        elif encoding in SQ_TYPES:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, embedding_dim, nlist, SQ_TYPES[encoding], metric)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, embedding_dim, nlist, metric)
+        search_params = {"nprobe": min(nlist, max(8, nlist // 32))}
+    elif mode == "hnsw":
+        if encoding in SQ_TYPES:
+            index = faiss.IndexHNSWSQ(embedding_dim, SQ_TYPES[encoding], HNSW_M, metric)
+        else:
+            index = faiss.IndexHNSWFlat(embedding_dim, HNSW_M, metric)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        search_params = {"efSearch": HNSW_EF_SEARCH}
+    else:
+        # Exact scan over (possibly compressed) vectors
+        if encoding == "pq":
+            index = faiss.IndexPQ(embedding_dim, PQ_M, 8, metric)
+        elif encoding in SQ_TYPES:
+            index = faiss.IndexScalarQuantizer(embedding_dim, SQ_TYPES[encoding], metric)
+        else:
+            index = faiss.IndexFlatIP(embedding_dim)
+        search_params = {}
+    
+    if not index.is_trained:
+        index.train(embeddings)
+    
+    # Rows are keyed by the numeric 12-digit cattle ID
+    return faiss.IndexIDMap2(index), mode, encoding, search_params
+
+def evaluate_faiss_index(index, embeddings, labels):
+    """Report the serialized size of an index and its recall@k against exact search"""
+    n = len(embeddings)
+    stats = {
+        "vectors": int(n),
+        "bytes": int(faiss.serialize_index(index).size),
+        "exact_bytes": int(n * embedding_dim * 4)
+    }
+    k = min(RECALL_K, n)
+    if k == 0:
+        return stats
+    
+    # Queries are a sample of the stored vectors; ground truth is a flat scan
+    sample = np.random.default_rng(0).choice(n, size=min(RECALL_SAMPLE, n), replace=False)
+    exact = faiss.IndexFlatIP(embedding_dim)
+    exact.add(embeddings)
+    _, true_rows = exact.search(embeddings[sample], k)
+    _, found = index.search(embeddings[sample], k)
+    hits = sum(len(set(labels[rows]) & set(found_row)) for rows, found_row in zip(true_rows, found))
+    stats[f"recall_at_{RECALL_K}"] = round(hits / (len(sample) * k), 4)
+    return stats
+
+def save_faiss_to_mongodb(index, config=None, expected=None):
+    """Save FAISS index and index config to MongoDB (GridFS), returning the new version token.
+
+    The delta log is reset. With ``expected`` = (version, applied deltas) the index is only
+    published if the stored copy is still exactly that; otherwise None is returned.
+    """
     try:
-        # Serialize FAISS index to bytes
-        import tempfile
-        with tempfile.NamedTemporaryFile(delete=False, suffix=".faiss") as tmp:
-            faiss.write_index(index, tmp.name)
-            tmp.flush()
-            # Read back as bytes
-            with open(tmp.name, 'rb') as f:
-                index_bytes = f.read()
-            os.unlink(tmp.name)
+        # Serialize FAISS index to bytes in memory
+        payload, checksum, compression, size = encode_faiss_index(index)
         
-        # Store in MongoDB
-        faiss_index_collection.update_one(
-            {"_id": "faiss_index"},
-            {
-                "$set": {
-                    "index_data": index_bytes,
-                    "ordered_ids": ordered_ids,
-                    "updated_at": datetime.now()
-                }
-            },
-            upsert=True
+        # Write the new version in chunks first; readers keep using the old one meanwhile
+        version = uuid.uuid4().hex
+        file_id = faiss_blobs.put(payload, filename=f"faiss_index_{version}", version=version,
+                                  checksum=checksum, compression=compression)
+        
+        # Atomic publish: flip the pointer document to the fully written file
+        previous = faiss_index_collection.find_one_and_update(
+            faiss_pointer_query(expected),
+            faiss_pointer_update(file_id, checksum, compression, size, config or faiss_store.config, version),
+            projection={"file_id": 1},
+            upsert=expected is None
         )
-        return True
+        if previous is None and expected is not None:
+            # Lost the race to another writer: our copy was never published
+            faiss_blobs.delete(file_id)
+            return None
+        
+        # Keep the previous version for readers still fetching it, drop only files uploaded
+        # before it: newer ones may belong to another writer that has not published yet
+        previous_file = faiss_blobs.find_one({"_id": previous["file_id"]}) if previous and previous.get("file_id") else None
+        if previous_file is not None:
+            for old in faiss_blobs.find({"uploadDate": {"$lt": previous_file.upload_date}}):
+                faiss_blobs.delete(old._id)
+        return version
     except Exception as e:
         st.error(f"Error saving FAISS index to MongoDB: {e}")
+        return None
+
+def get_faiss_version():
+    """Get the version token of the FAISS index stored in MongoDB and its delta log length ((None, 0) if missing)"""
+    doc = faiss_index_collection.find_one({"_id": "faiss_index"}, {"version": 1, "updated_at": 1, "delta_count": 1})
+    if not doc:
+        return None, 0
+    # Indexes saved before version tokens existed fall back to updated_at
+    return doc.get("version") or doc.get("updated_at"), doc.get("delta_count", 0)
+
+def read_faiss_blob(doc):
+    """Read the stored (possibly compressed) index referenced by the pointer document"""
+    if doc.get("file_id") is not None:
+        return faiss_blobs.get(doc["file_id"]).read()
+    # Older versions stored the blob inline
+    return doc["index_data"]
+
+def load_faiss_from_mongodb():
+    """Load FAISS index, version token and index config from MongoDB"""
+    try:
+        # The delta log is read separately (read_faiss_deltas)
+        doc = faiss_index_collection.find_one({"_id": "faiss_index"}, {"deltas": 0})
+        if doc and ("file_id" in doc or "index_data" in doc):
+            index = decode_faiss_index(doc, read_faiss_blob(doc))
+            
+            # Positional indexes from older versions must be rebuilt as ID-mapped
+            if index is None:
+                return None, None, None
+            
+            config = {**default_faiss_config(FAISS_INDEX_MODE, FAISS_ENCODING), **doc.get("index_config", {})}
+            return index, doc.get("version") or doc.get("updated_at"), config
+        return None, None, None
+    except Exception as e:
+        st.error(f"Error loading FAISS index from MongoDB: {e}")
+        return None, None, None
+
+def get_all_cattle_embeddings():
+    """Get all cattle embeddings of the current model as (sorted IDs, float32 matrix)"""
+    try:
+        # Only the packed vectors are read; always sorted by 12-digit ID
+        cursor = embedding_collection.find(
+            {"model": CLIP_MODEL_NAME, "vector": {"$ne": None}},
+            {"vector": 1, "dtype": 1}
+        ).sort("_id", 1)
+        
+        cattle_ids, chunks, dtypes = [], [], []
+        for doc in cursor:
+            cattle_ids.append(doc["_id"])
+            chunks.append(doc["vector"])
+            dtypes.append(doc.get("dtype", EMBEDDING_DTYPE))
+        
+        if not chunks:
+            return [], np.empty((0, embedding_dim), dtype=np.float32)
+        if len(set(dtypes)) == 1:
+            matrix = np.frombuffer(b"".join(chunks), dtype=dtypes[0]).reshape(-1, embedding_dim)
+        else:
+            matrix = np.vstack([np.frombuffer(chunk, dtype=dtype) for chunk, dtype in zip(chunks, dtypes)])
+        return cattle_ids, matrix.astype(np.float32)
+    except Exception as e:
+        st.error(f"Error fetching embeddings: {e}")
+        return [], np.empty((0, embedding_dim), dtype=np.float32)
+
+def get_faiss_publish_base():
+    """(version, delta_count) of the stored index, None if no versioned index is stored yet"""
+    doc = faiss_index_collection.find_one({"_id": "faiss_index"}, {"version": 1, "delta_count": 1})
+    if not doc or not doc.get("version"):
+        return None
+    return doc["version"], doc.get("delta_count", 0)
+
+def build_faiss_index(requested_mode, requested_encoding):
+    """Build an ID-mapped index of all stored embeddings; returns (index, config)"""
+    # Get embeddings from MongoDB; records without a valid 12-digit ID cannot be keyed
+    cattle_ids, embeddings = get_all_cattle_embeddings()
+    keep = [i for i, cattle_id in enumerate(cattle_ids) if faiss_id(cattle_id) is not None]
+    cattle_ids = [cattle_ids[i] for i in keep]
+    embeddings = np.ascontiguousarray(embeddings[keep])
+    if len(embeddings):
+        embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+    
+    # Train on the stored embeddings, then add them keyed by cattle ID
+    index, index_mode, index_encoding, search_params = create_faiss_index(requested_mode, embeddings, requested_encoding)
+    apply_search_params(index, search_params)
+    labels = np.array([faiss_id(cattle_id) for cattle_id in cattle_ids], dtype=np.int64)
+    if len(embeddings):
+        index.add_with_ids(embeddings, labels)
+    config = {
+        "requested_mode": requested_mode, "index_mode": index_mode,
+        "requested_encoding": requested_encoding, "encoding": index_encoding,
+        "search_params": search_params,
+        "stats": evaluate_faiss_index(index, embeddings, labels)
+    }
+    return index, config
+
+def rebuild_faiss(mode=None, encoding=None):
+    """Rebuild FAISS index from MongoDB embeddings.
+
+    ``mode`` is one of FAISS_INDEX_MODES and ``encoding`` one of FAISS_ENCODINGS;
+    by default the last requested ones are kept. Edits logged while building are
+    replayed onto the new index, so none is dropped when it is published.
+    """
+    try:
+        requested_mode = mode or faiss_store.config.get("requested_mode", FAISS_INDEX_MODE)
+        requested_encoding = encoding or faiss_store.config.get("requested_encoding", FAISS_ENCODING)
+        
+        for _ in range(FAISS_REBUILD_ATTEMPTS):
+            # Read before the embeddings: every delta logged after this may be missing from them
+            base = get_faiss_publish_base()
+            index, config = build_faiss_index(requested_mode, requested_encoding)
+            while True:
+                version = save_faiss_to_mongodb(index, config, expected=base)
+                if version is not None:
+                    # Publish to the shared store, unless a sync already loaded this version
+                    with faiss_store.lock.write():
+                        if faiss_store.version != version:
+                            faiss_store.index = index
+                            faiss_store.config = config
+                            faiss_store.version = version
+                            faiss_store.applied = 0
+                    return True
+                current = get_faiss_publish_base()
+                if current == base:
+                    # Not a lost race: the publish itself failed
+                    return False
+                if base is None or current is None or current[0] != base[0]:
+                    # Another version was published meanwhile: build again on top of it
+                    break
+                # Only new edits were logged: replay them onto the new index and retry
+                deltas = read_faiss_deltas(base[0], base[1], current[1] - base[1])
+                if deltas is None:
+                    break
+                for delta in deltas:
+                    apply_faiss_delta(index, config, delta)
+                base = (base[0], base[1] + len(deltas))
+        st.warning("⚠️ FAISS index was not rebuilt: other writers kept publishing new versions")
+        return False
+    except Exception as e:
+        st.error(f"Error rebuilding FAISS index: {str(e)}")
         return False
 
-def load_faiss_from_mongodb():
-    """Load FAISS index and ordered IDs from MongoDB"""
-    global index
-    try:
-        doc = faiss_index_collection.find_one({"_id": "faiss_index"})
-        if doc and "index_data" in doc:
-            # Write bytes to temporary file (FAISS requirement)
-            import tempfile
-            with tempfile.NamedTemporaryFile(delete=False, suffix=".faiss") as tmp:
-                tmp.write(doc["index_data"])
-                tmp.flush()
-                # Load index from file
-                index = faiss.read_index(tmp.name)
-                os.unlink(tmp.name)
-            
-            ordered_ids = doc.get("ordered_ids", [])
-            return index, ordered_ids
-        return None, []
-    except Exception as e:
-        st.error(f"Error loading FAISS index from MongoDB: {e}")
-        return None, []
+def read_faiss_deltas(version, start: int, count: int):
+    """Entries ``start``..``start + count`` of a version's delta log (None if that version is no longer published)"""
+    doc = faiss_index_collection.find_one(
+        {"_id": "faiss_index", "version": version},
+        faiss_deltas_projection(start, count)
+    )
+    return None if doc is None else doc.get("deltas", [])
+
+def live_vector_count():
+    """Number of searchable rows in the shared index (tombstones excluded)"""
+    return live_vectors(faiss_store.index, faiss_store.config)
+
+def sync_faiss_store():
+    """Bring the shared FAISS index up to date: reload when the version token changed, then apply new deltas"""
+    try:
+        version, delta_count = get_faiss_version()
+    except Exception as e:
+        st.warning(f"Could not check FAISS index version: {str(e)}. Using cached index.")
+        return
+    if version is not None and (version, delta_count) == (faiss_store.version, faiss_store.applied):
+        return
+    
+    with faiss_store.lock.write():
+        # Another session may have synced while we waited for the lock
+        if version is not None and (version, delta_count) == (faiss_store.version, faiss_store.applied):
+            return
+        if version is not None and version != faiss_store.version:
+            loaded_index, loaded_version, loaded_config = load_faiss_from_mongodb()
+            if loaded_index is not None:
+                faiss_store.index = loaded_index
+                faiss_store.config = loaded_config
+                faiss_store.version = loaded_version
+                faiss_store.applied = 0
+        if version is not None and version == faiss_store.version:
+            try:
+                deltas = read_faiss_deltas(version, faiss_store.applied, delta_count - faiss_store.applied)
+            except Exception as e:
+                st.warning(f"Could not read FAISS index updates: {str(e)}. Using cached index.")
+                return
+            # None: compacted meanwhile, picked up by the next sync
+            for delta in deltas or []:
+                apply_faiss_delta(faiss_store.index, faiss_store.config, delta)
+                faiss_store.applied += 1
+            return
+    
+    # Nothing stored yet (or unreadable/legacy): build from embeddings
+    rebuild_faiss()
+
+def compact_faiss_store():
+    """Publish the shared index with its applied deltas folded in as a new version"""
+    # Serializing only reads the index, so searches continue meanwhile
+    with faiss_store.lock.read():
+        base = (faiss_store.version, faiss_store.applied)
+        version = save_faiss_to_mongodb(faiss_store.index, faiss_store.config, expected=base)
+    if version is None:
+        return
+    with faiss_store.lock.write():
+        if (faiss_store.version, faiss_store.applied) == base:
+            faiss_store.version, faiss_store.applied = version, 0
+
+def publish_faiss_deltas(deltas):
+    """Append [{label, vector}] entries to the stored index's delta log and apply them here.
+
+    Afterwards the index is compacted or rebuilt when due. Falls back to a full rebuild
+    when no GridFS-backed index is stored yet.
+    """
+    result = faiss_index_collection.update_one(
+        {"_id": "faiss_index", "file_id": {"$exists": True}},
+        {"$push": {"deltas": {"$each": deltas}}, "$inc": {"delta_count": len(deltas)}}
+    )
+    if result.matched_count == 0:
+        return rebuild_faiss()
+    sync_faiss_store()
+    return maintain_faiss_store()
+
+def faiss_rebuild_due():
+    """Whether the shared index has too many tombstones or the herd outgrew its auto-picked backend"""
+    config = faiss_store.config
+    live = live_vector_count()
+    if config.get("tombstones", 0) > FAISS_MAX_TOMBSTONE_RATIO * max(live, 1):
+        return True
+    # Compared after fallbacks, or auto mode with PQ would rebuild forever
+    if config.get("requested_mode") == "auto":
+        resolved_mode, resolved_encoding, _ = resolve_index_spec(
+            "auto", config.get("requested_encoding", FAISS_ENCODING), live)
+        return (resolved_mode, resolved_encoding) != (config.get("index_mode"), config.get("encoding"))
+    return False
+
+def maintain_faiss_store():
+    """Rebuild the shared index when due (also for deltas published by the service), else compact a long delta log"""
+    if faiss_rebuild_due():
+        # One rebuild per process at a time; other sessions keep searching the current index
+        if not faiss_store.rebuild_lock.acquire(blocking=False):
+            return True
+        try:
+            return rebuild_faiss()
+        finally:
+            faiss_store.rebuild_lock.release()
+    if faiss_store.applied >= FAISS_MAX_DELTAS:
+        compact_faiss_store()
+    return True
+
+def faiss_upsert(cattle_id: str, embedding):
+    """Add or replace one animal's vector in the shared index (through the delta log)"""
+    label = faiss_id(cattle_id)
+    if label is None:
+        st.warning(f"Cattle ID {cattle_id} is not a 12-digit code and cannot be indexed")
+        return False
+    sync_faiss_store()
+    return publish_faiss_deltas([faiss_delta(label, embedding)])
+
+def faiss_remove(cattle_ids):
+    """Remove animals from the shared index (through the delta log)"""
+    labels = {faiss_id(cattle_id) for cattle_id in cattle_ids} - {None}
+    if not labels:
+        return True
+    
+    sync_faiss_store()
+    labels = np.array(sorted(labels), dtype=np.int64)
+    with faiss_store.lock.read():
+        labels = labels[np.isin(labels, faiss.vector_to_array(faiss_store.index.id_map))]
+    deltas = [faiss_delta(label) for label in labels]
+    if not deltas:
+        return True
+    return publish_faiss_deltas(deltas)
+
+def refresh_cattle_in_faiss(cattle_id: str):
+    """Bring one animal's vector in the shared index in line with its stored embedding"""
+    embedding = get_cattle_embedding(cattle_id)
+    if embedding is not None:
+        return faiss_upsert(cattle_id, embedding)
+    return faiss_remove([cattle_id])
+
+def faiss_search_batch(queries, k):
+    """Search the shared FAISS index with a matrix of queries, returning (cattle_id, score) pairs per query"""
+    with faiss_store.lock.read():
+        return search_index(faiss_store.index, faiss_store.config, queries, k)
+
+# -----------------------------------------------------------------------------
+# Identification Scheduler (micro-batching across sessions)
+# -----------------------------------------------------------------------------
+# Largest batch and longest wait for more requests before a batch is run
+IDENTIFY_BATCH_MAX = int(os.environ.get("IDENTIFY_BATCH_MAX", 16))
+IDENTIFY_BATCH_WAIT_MS = float(os.environ.get("IDENTIFY_BATCH_WAIT_MS", 5))
+# Admission control: past this queue depth searches are capped at top-1, past the next new requests are rejected
+IDENTIFY_DEGRADE_DEPTH = int(os.environ.get("IDENTIFY_DEGRADE_DEPTH", 32))
+IDENTIFY_MAX_DEPTH = int(os.environ.get("IDENTIFY_MAX_DEPTH", 64))
+
+class SchedulerBusy(RuntimeError):
+    """Raised when the identification queue is full"""
+
+class IdentifyScheduler:
+    """Coalesces single-image identifications of all sessions into one CLIP forward pass and one FAISS search.
+
+    A batch is run once it holds ``max_batch`` requests or ``max_wait`` seconds after
+    its first request arrived; results are fanned back out through futures.
+    """
+    def __init__(self, max_batch, max_wait, degrade_depth, max_depth):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.degrade_depth = degrade_depth
+        self.max_depth = max_depth
+        self.cond = threading.Condition()
+        self.queue = deque()
+        # requests, degraded, rejected, batches
+        self.stats = Counter()
+        self.thread = threading.Thread(target=self.run, name="identify-scheduler", daemon=True)
+        self.thread.start()
+
+    def identify(self, image, image_hash=None, k=1, timeout=60):
+        """(cattle_id, score) hits of one image; raises SchedulerBusy when the queue is full"""
+        future = Future()
+        with self.cond:
+            depth = len(self.queue)
+            if depth >= self.max_depth:
+                self.stats["rejected"] += 1
+                raise SchedulerBusy(f"{depth} identifications are queued")
+            if depth >= self.degrade_depth:
+                k = 1
+                self.stats["degraded"] += 1
+            self.queue.append((image, image_hash, k, future))
+            self.stats["requests"] += 1
+            self.cond.notify()
+        return future.result(timeout=timeout)
+
+    def take_batch(self):
+        """Block until a batch is due and remove it from the queue"""
+        with self.cond:
+            while not self.queue:
+                self.cond.wait()
+            deadline = time.monotonic() + self.max_wait
+            while len(self.queue) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            return [self.queue.popleft() for _ in range(min(self.max_batch, len(self.queue)))]
+
+    def run(self):
+        while True:
+            batch = self.take_batch()
+            try:
+                feats = embed_images([image for image, _, _, _ in batch], hashes=[h for _, h, _, _ in batch])
+                if feats is None:
+                    raise RuntimeError("embedding failed")
+                hits = faiss_search_batch(feats, max(k for _, _, k, _ in batch))
+                for (_, _, k, future), image_hits in zip(batch, hits):
+                    future.set_result(image_hits[:k])
+            except Exception as e:
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+            self.stats["batches"] += 1
+
+@st.cache_resource
+def get_identify_scheduler():
+    """Create the process-wide identification scheduler (once per process)"""
+    return IdentifyScheduler(IDENTIFY_BATCH_MAX, IDENTIFY_BATCH_WAIT_MS / 1000, IDENTIFY_DEGRADE_DEPTH, IDENTIFY_MAX_DEPTH)
+
+identify_scheduler = get_identify_scheduler()
+
+# Exports are written to a temporary file that moves from memory to disk past this size
+EXPORT_SPOOL_MAX_BYTES = 32 * 1024 * 1024
+EXPORT_BATCH_SIZE = 50
+
+def iter_export_docs(cattle_ids, projection):
+    """Stream the cattle documents of an export from a cursor, newest first"""
+    return cattle_collection.find({"12_digit_id": {"$in": list(cattle_ids)}}, projection) \
+        .sort("created_at", -1).batch_size(EXPORT_BATCH_SIZE)
+
+def iter_metadata_rows(cattle_ids):
+    """Yield one metadata CSV row per stored image"""
+    for d in iter_export_docs(cattle_ids, METADATA_ONLY):
+        for img in d.get("images", []):
+            yield [d.get("12_digit_id"), d.get("cattle_name"), d.get("created_at"), img.get("filename")]
+
+def iter_image_files(cattle_ids):
+    """Yield (filename, raw bytes) of stored images, one record's images in memory at a time"""
+    for d in iter_export_docs(cattle_ids, {"images.filename": 1, "images.hash": 1, "images.b64": 1}):
+        images = d.get("images", [])
+        for img, raw in zip(images, load_image_originals(images)):
+            if raw:
+                yield img.get("filename"), raw
+
+def export_metadata_csv(cattle_ids):
+    """Write the metadata CSV of the given cattle to a spooled temporary file, rewound for reading"""
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    # Rows are formatted per batch and written encoded: spooled files only support
+    # io.TextIOWrapper from Python 3.11
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(["12_digit_id", "cattle_name", "created_at", "image_filename"])
+    for i, row in enumerate(iter_metadata_rows(cattle_ids), 1):
+        writer.writerow(row)
+        if i % EXPORT_BATCH_SIZE == 0:
+            out.write(text.getvalue().encode("utf-8"))
+            text.seek(0)
+            text.truncate()
+    out.write(text.getvalue().encode("utf-8"))
+    out.seek(0)
+    return out
+
+def export_images_zip(cattle_ids):
+    """Write the stored images of the given cattle to a ZIP in a spooled temporary file, rewound for reading.
+
+    Entries are stored, not deflated: JPEG/PNG data does not compress further.
+    """
+    out = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    with zipfile.ZipFile(out, mode="w", compression=zipfile.ZIP_STORED) as z:
+        for filename, raw in iter_image_files(cattle_ids):
+            z.writestr(filename, raw)
+    out.seek(0)
+    return out
+
+# -----------------------------------------------------------------------------
+# Query Audit
+# -----------------------------------------------------------------------------
+# A query examining more documents than this multiple of what it returns is reported
+AUDIT_MAX_DOCS_RATIO = 10
+
+def audit_query_shapes():
+    """The query shapes issued by interactive pages and per-item lookups, as (label, collection, find command).
+    
+    Filter values come from a sample record so the planner sees realistic keys. Whole-collection
+    maintenance scans (backfills, integrity checks) are intentionally left out.
+    """
+    sample = cattle_collection.find_one({}, {"12_digit_id": 1, "name_lc": 1, "created_at": 1}) or {}
+    cattle_id = sample.get("12_digit_id", "0" * 12)
+    name = (sample.get("name_lc") or "a")[:3]
+    some_hash = "0" * 64
+    return [
+        ("Record by ID", "cattle_images", {"filter": {"12_digit_id": cattle_id}, "limit": 1}),
+        ("Records by IDs", "cattle_images", {"filter": {"12_digit_id": {"$in": [cattle_id]}}}),
+        ("Records page", "cattle_images", {"filter": page_filter(), "sort": PAGE_SORT, "limit": 21}),
+        ("Records page after cursor", "cattle_images",
+         {"filter": page_filter(after=(sample.get("created_at"), sample.get("_id"))), "sort": PAGE_SORT, "limit": 21}),
+        ("Search by ID/name/class prefix", "cattle_images",
+         {"filter": page_filter(search_cattle_filter(name)), "sort": PAGE_SORT, "limit": 21}),
+        # list_cattle_page with Browse's default limit of 50
+        ("Browse by ID and name prefix", "cattle_images",
+         {"filter": page_filter(cattle_filter(cattle_id[:4], name)), "sort": PAGE_SORT, "limit": 51}),
+        ("Re-embed chunk", "cattle_images",
+         {"filter": {"12_digit_id": {"$gt": cattle_id}}, "sort": {"12_digit_id": 1}, "limit": REEMBED_CHUNK_SIZE}),
+        ("YOLO result by image", "yolo_results", {"filter": {"image_id": some_hash, "roi_model": ROI_MODEL_VERSION}, "limit": 1}),
+        ("Embedding by ID", "cattle_embeddings", {"filter": {"_id": cattle_id, "model": CLIP_MODEL_NAME}, "limit": 1}),
+        ("Embedded IDs", "cattle_embeddings", {"filter": {"_id": {"$in": [cattle_id]}, "vector": {"$ne": None}}}),
+        ("FAISS rebuild vectors", "cattle_embeddings",
+         {"filter": {"model": CLIP_MODEL_NAME, "vector": {"$ne": None}}, "sort": {"_id": 1}}),
+        ("Embedding cache lookup", "embedding_cache", {"filter": {"_id": {"$in": [embedding_cache_key(some_hash)]}}}),
+        ("Image blobs by hash", "image_blobs", {"filter": {"_id": {"$in": [some_hash]}}}),
+        ("Herd statistics", "herd_stats", {"filter": {"_id": HERD_STATS_ID}, "limit": 1}),
+    ]
+
+def plan_stages(plan):
+    """All stage names in an explain plan tree (classic and slot-based engine layouts)"""
+    stages = []
+    if isinstance(plan, dict):
+        if "stage" in plan:
+            stages.append(plan["stage"])
+        for value in plan.values():
+            stages += plan_stages(value)
+    elif isinstance(plan, list):
+        for value in plan:
+            stages += plan_stages(value)
+    return stages
+
+def audit_queries():
+    """``explain`` every audited query shape; returns one row per shape with the problems found"""
+    rows = []
+    for label, collection_name, command in audit_query_shapes():
+        row = {"Query": label, "Collection": collection_name}
+        try:
+            explain = db.command("explain", {"find": collection_name, **command}, verbosity="executionStats")
+        except Exception as e:
+            rows.append({**row, "Issues": f"explain failed: {e}"})
+            continue
+        stages = plan_stages(explain.get("queryPlanner", {}).get("winningPlan", {}))
+        stats = explain.get("executionStats", {})
+        returned = stats.get("nReturned", 0)
+        docs_examined = stats.get("totalDocsExamined", 0)
+        issues = []
+        if "COLLSCAN" in stages:
+            issues.append("collection scan")
+        if "SORT" in stages:
+            issues.append("in-memory sort")
+        if docs_examined > AUDIT_MAX_DOCS_RATIO * max(returned, 1):
+            issues.append(f"examined {docs_examined} docs for {returned}")
+        rows.append({
+            **row,
+            "Plan": " > ".join(dict.fromkeys(stages)),
+            "Returned": returned,
+            "Keys Examined": stats.get("totalKeysExamined", 0),
+            "Docs Examined": docs_examined,
+            "Time (ms)": stats.get("executionTimeMillis", 0),
+            "Issues": ", ".join(issues)
+        })
+    return rows
+
+# -----------------------------------------------------------------------------
+# Re-embed Engine (background, checkpointed)
+# -----------------------------------------------------------------------------
+# Parallel image decode workers
+REEMBED_WORKERS = int(os.environ.get("REEMBED_WORKERS", 4))
 
-def get_all_cattle_embeddings():
-    """Get all cattle embeddings for FAISS index in sorted order"""
-    try:
-        # Always sort by 12_digit_id for consistent ordering
-        cursor = cattle_collection.find(
-            {"embedding": {"$ne": None}}, 
-            {"12_digit_id": 1, "embedding": 1}
-        ).sort("12_digit_id", 1)  # Sort ascending by ID
-        
-        # Return both ordered list and dict
-        ordered_ids = []
-        embeddings_dict = {}
-        for doc in cursor:
-            cattle_id = doc["12_digit_id"]
-            ordered_ids.append(cattle_id)
-            embeddings_dict[cattle_id] = doc["embedding"]
-        
-        return ordered_ids, embeddings_dict
-    except Exception as e:
-        st.error(f"Error fetching embeddings: {e}")
-        return [], {}
+class AppReembedJob(ReembedJob):
+    """Re-embed job on the loaded CLIP model, looking embeddings up in both cache tiers"""
 
-def rebuild_faiss():
-    """Rebuild FAISS index from MongoDB embeddings with consistent ordering"""
-    global index
-    try:
-        index = faiss.IndexFlatIP(embedding_dim)
-        
-        # Get embeddings from MongoDB in sorted order
-        ordered_ids, embeddings_dict = get_all_cattle_embeddings()
-        
-        # Build index in the same order as IDs
-        for cattle_id in ordered_ids:
-            embedding = embeddings_dict[cattle_id]
-            if embedding:
-                emb = np.array(embedding, dtype=np.float32).reshape(1, -1)
-                emb = emb / np.linalg.norm(emb, axis=1, keepdims=True)
-                index.add(emb)
-        
-        # Save FAISS index to MongoDB
-        save_faiss_to_mongodb(index, ordered_ids)
-                    
-        return True
-    except Exception as e:
-        st.error(f"Error rebuilding FAISS index: {str(e)}")
-        return False
+    def decode(self, raw: bytes):
+        try:
+            return preprocess(decode_image(raw, PROCESSING_MAX_SIDE)[0])
+        except Exception:
+            return None
 
-def create_metadata_csv_bytes(docs):
-    rows = []
-    for d in docs:
-        cid = d.get("12_digit_id")
-        name = d.get("cattle_name")
-        created = d.get("created_at")
-        for img in d.get("images", []):
-            rows.append({
-                "12_digit_id": cid,
-                "cattle_name": name,
-                "created_at": created,
-                "image_filename": img.get("filename")
-            })
-    df = pd.DataFrame(rows)
-    buf = io.BytesIO()
-    df.to_csv(buf, index=False)
-    buf.seek(0)
-    return buf.read()
+    def encode(self, inputs):
+        return encode_image_tensors(inputs)
 
-def create_images_zip_bytes(docs):
-    buf = io.BytesIO()
-    with zipfile.ZipFile(buf, mode="w", compression=zipfile.ZIP_DEFLATED) as z:
-        for d in docs:
-            for img in d.get("images", []):
-                filename = img.get("filename")
-                b64 = img.get("b64")
-                raw = base64.b64decode(b64)
-                z.writestr(filename, raw)
-    buf.seek(0)
-    return buf.read()
-
-# Load existing FAISS index if available
-# Load FAISS index from MongoDB or create new one
-try:
-    loaded_index, loaded_ids = load_faiss_from_mongodb()
-    if loaded_index is not None:
-        index = loaded_index
-    else:
-        index = faiss.IndexFlatIP(embedding_dim)
+    def cached_embeddings(self, image_hashes):
+        return get_cached_embeddings(image_hashes)
+
+    def put_cached_embeddings(self, hash_vectors):
+        put_cached_embeddings(hash_vectors)
+
+    def get_blobs(self, image_hashes):
+        return get_image_blobs(image_hashes)
+
+    def finish(self):
         rebuild_faiss()
-except Exception as e:
-    st.warning(f"Could not load FAISS index from MongoDB: {str(e)}. Will rebuild.")
-    index = faiss.IndexFlatIP(embedding_dim)
-    rebuild_faiss()
+        # Records that had no embedding may have gained one
+        reconcile_herd_stats()
+
+reembed_job = AppReembedJob(db, embedding_dim, workers=REEMBED_WORKERS)
+
+class ReembedRunner:
+    """Owns the background re-embed thread so a run outlives the UI session that started it"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, mode="full", resume=False):
+        """Start a run in a daemon thread; False if one is already running"""
+        with self._lock:
+            if self.running():
+                return False
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(
+                target=reembed_job.run, args=(mode, resume, self.stop_event), name="reembed", daemon=True
+            )
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """Ask the running job to stop after its current chunk"""
+        self.stop_event.set()
+
+@st.cache_resource
+def get_reembed_runner():
+    """Process-wide re-embed runner"""
+    return ReembedRunner()
+
+reembed_runner = get_reembed_runner()
+
+# Create the herd statistics document on first start (before the migrations apply their deltas)
+ensure_herd_stats()
+
+# Move embeddings of records saved by older versions to the embeddings collection
+migrate_legacy_embeddings()
+
+# Move inline base64 images of older records to the image store (background)
+start_image_migration()
+
+# Add search fields to older records (background)
+start_search_backfill()
+
+# Refresh the shared FAISS index only if a newer version or new edits were published,
+# then rebuild or compact it if those edits (possibly made by the service) call for it
+sync_faiss_store()
+maintain_faiss_store()
 
 # -----------------------------------------------------------------------------
 # Streamlit UI
@@ -522,8 +2090,8 @@ with col1:
     st.metric("Device", device.upper())
 with col2:
     try:
-        db_count = cattle_collection.count_documents({})
-        st.metric("MongoDB Records", db_count)
+        herd_stats = get_herd_stats()
+        st.metric("MongoDB Records", herd_stats["records"])
     except:
         st.metric("MongoDB Records", "Error")
 with col3:
@@ -539,7 +2107,7 @@ with tabs[0]:
     # Check if we have any registered cattle
     total_cattle = 0
     try:
-        total_cattle = cattle_collection.count_documents({})
+        total_cattle = get_herd_stats()["records"]
     except:
         total_cattle = 0
     
@@ -553,95 +2121,122 @@ with tabs[0]:
         with col_param2:
             threshold = st.slider("Confidence threshold", 0.0, 1.0, 0.75, step=0.05, key="clip_threshold")
 
-        test_file = st.file_uploader(
-            "Upload New Image to Identify", 
-            type=["jpg","jpeg","png"], 
-            key="test",
-            help="Upload a clear image of cattle muzzle for identification"
-        )
+        identify_mode = st.radio("Mode", ["Single image", "Batch (ZIP / multiple files)"], horizontal=True, key="clip_mode")
+        
+        test_file = None
+        if identify_mode == "Single image":
+            test_file = st.file_uploader(
+                "Upload New Image to Identify", 
+                type=["jpg","jpeg","png"], 
+                key="test",
+                help="Upload a clear image of cattle muzzle for identification"
+            )
+        else:
+            batch_files = st.file_uploader(
+                "Upload images or ZIP archives to identify",
+                type=["jpg","jpeg","png","zip"],
+                accept_multiple_files=True,
+                key="test_batch",
+                help="Images are decoded and embedded in batches and searched with one query"
+            )
+            batch_key = [(f.name, f.size) for f in batch_files or []]
+            
+            if batch_files and st.button("🔍 Identify Batch", type="primary"):
+                with st.spinner("Embedding images in batches and searching..."):
+                    names, batch_hits, failed = identify_images_batch(batch_files, k)
+                    details_map = get_cattle_details({cattle_id for hits in batch_hits for cattle_id, _ in hits})
+                    report_rows = []
+                    for name, hits in zip(names, batch_hits):
+                        for rank, (cattle_id, score) in enumerate(hits, start=1):
+                            details = details_map.get(cattle_id, {})
+                            report_rows.append({
+                                "image": name,
+                                "rank": rank,
+                                "12_digit_id": cattle_id,
+                                "cattle_name": details.get("cattle_name", "Unknown"),
+                                "cattle_class": details.get("cattle_class", "Unknown"),
+                                "score": round(score, 4)
+                            })
+                    st.session_state["clip_batch_results"] = {
+                        "upload": batch_key, "rows": report_rows, "images": len(names), "failed": failed
+                    }
+            
+            batch_results = st.session_state.get("clip_batch_results")
+            if batch_files and batch_results and batch_results["upload"] == batch_key:
+                report = pd.DataFrame(batch_results["rows"], columns=["image", "rank", "12_digit_id", "cattle_name", "cattle_class", "score"])
+                report["match"] = report["score"] >= threshold
+                matched = report[(report["rank"] == 1) & report["match"]]["image"].nunique()
+                st.success(f"✅ {matched} of {batch_results['images']} image(s) matched above threshold {threshold:.2f}")
+                if batch_results["failed"]:
+                    st.warning(f"⚠️ {len(batch_results['failed'])} file(s) could not be decoded: {', '.join(batch_results['failed'][:10])}")
+                st.dataframe(report, use_container_width=True)
+                st.download_button("⬇️ Download results CSV", data=report.to_csv(index=False),
+                                   file_name=f"identification_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.csv",
+                                   mime="text/csv")
 
         if test_file:
             try:
-                test_img = Image.open(test_file).convert("RGB")
+                test_item = prepare_upload(test_file)
+                test_img = test_item["image"]
                 st.image(test_img, caption="Test Image", width=300)
+                upload_key = f"{test_file.name}:{test_file.size}"
 
                 if st.button("🔍 Identify Cattle", type="primary"):
                     with st.spinner("Processing image and searching..."):
-                        test_feat = embed_image(test_img)
-                        
-                        if test_feat is not None and index.ntotal > 0:
-                            # Normalize test feature
-                            test_feat = test_feat / np.linalg.norm(test_feat, axis=1, keepdims=True)
-                            
-                            # Search in FAISS index
-                            D, I = index.search(test_feat, k)
-                            
-                            st.subheader("🎯 Identification Results")
-                            
-                            # Get IDs from MongoDB in same order as FAISS index
+                        st.session_state.pop("clip_results", None)
+                        if live_vector_count() == 0:
+                            st.error("❌ Failed to process image or empty database")
+                        else:
                             try:
-                                # Load the ordered IDs from MongoDB
-                                faiss_doc = faiss_index_collection.find_one({"_id": "faiss_index"})
-                                if faiss_doc and "ordered_ids" in faiss_doc:
-                                    ids = faiss_doc["ordered_ids"]
-                                    
-                                    # Get details for all IDs
-                                    docs = list(cattle_collection.find(
-                                        {"12_digit_id": {"$in": ids}},
-                                        {"12_digit_id": 1, "cattle_name": 1, "cattle_class": 1, "images": 1}
-                                    ))
-                                    details_map = {doc["12_digit_id"]: doc for doc in docs}
-                                else:
-                                    # Fallback: rebuild index if not found
-                                    rebuild_faiss()
-                                    faiss_doc = faiss_index_collection.find_one({"_id": "faiss_index"})
-                                    if faiss_doc and "ordered_ids" in faiss_doc:
-                                        ids = faiss_doc["ordered_ids"]
-                                        docs = list(cattle_collection.find(
-                                            {"12_digit_id": {"$in": ids}},
-                                            {"12_digit_id": 1, "cattle_name": 1, "cattle_class": 1, "images": 1}
-                                        ))
-                                        details_map = {doc["12_digit_id"]: doc for doc in docs}
-                                    else:
-                                        ids = []
-                                        details_map = {}
-                            except Exception as e:
-                                st.error(f"Error loading cattle IDs: {e}")
-                                ids = []
-                                details_map = {}
+                                # Embedded and searched together with other sessions' requests
+                                hits = identify_scheduler.identify(test_img, test_item["hash"], k)
+                            except SchedulerBusy:
+                                hits = None
+                                st.warning("⚠️ Many identifications are in progress. Please try again in a moment.")
+                            except Exception:
+                                hits = None
+                                st.error("❌ Failed to process image or empty database")
                             
-                            found_match = False
-                            
-                            for rank, (score, idx) in enumerate(zip(D[0], I[0])):
-                                if idx == -1 or idx >= len(ids):
-                                    continue
-                                    
-                                cattle_id = ids[idx]
-                                details = details_map[cattle_id]
-                                
-                                if score >= threshold:
-                                    found_match = True
-                                    with st.container():
-                                        class_info = details.get('cattle_class', details.get('class', 'Unknown'))
-                                        name_info = details.get('cattle_name', details.get('name', 'Unknown'))
-                                        st.success(
-                                            f"✅ **Match {rank+1}** (Confidence: {score:.3f})\n\n"
-                                            f"🆔 **ID:** {cattle_id}\n\n"
-                                            f"🐂 **Class:** {class_info}\n\n"
-                                            f"📛 **Name:** {name_info}"
-                                        )
-                                        if 'images' in details:
-                                            show_images_with_captions(details["images"], title="Reference Images", from_db=True)
-                                        st.divider()
-                                else:
-                                    name_info = details.get('cattle_name', details.get('name', 'Unknown'))
-                                    st.warning(f"❌ Candidate {rank+1}: {name_info} (Low confidence: {score:.3f})")
-                            
-                            if not found_match:
-                                st.error(f"❌ No confident matches found above threshold {threshold:.2f}")
-                                st.info("💡 Try lowering the confidence threshold or register this cattle if it's new.")
+                            if hits is not None:
+                                # Fetch metadata for the hits only
+                                st.session_state["clip_results"] = {
+                                    "upload": upload_key,
+                                    "hits": hits,
+                                    "details": get_cattle_details([cattle_id for cattle_id, _ in hits])
+                                }
+                
+                # Results are kept in session state so reference images can be opened lazily
+                results = st.session_state.get("clip_results")
+                if results and results["upload"] == upload_key:
+                    st.subheader("🎯 Identification Results")
+                    found_match = False
+                    
+                    for rank, (cattle_id, score) in enumerate(results["hits"]):
+                        details = results["details"].get(cattle_id)
+                        if details is None:
+                            continue
+                        
+                        if score >= threshold:
+                            found_match = True
+                            with st.container():
+                                class_info = details.get('cattle_class', details.get('class', 'Unknown'))
+                                name_info = details.get('cattle_name', details.get('name', 'Unknown'))
+                                st.success(
+                                    f"✅ **Match {rank+1}** (Confidence: {score:.3f})\n\n"
+                                    f"🆔 **ID:** {cattle_id}\n\n"
+                                    f"🐂 **Class:** {class_info}\n\n"
+                                    f"📛 **Name:** {name_info}"
+                                )
+                                if st.checkbox("Show reference images", key=f"clip_refs_{rank}_{cattle_id}"):
+                                    show_images_with_captions(get_cattle_images(cattle_id), title="Reference Images", from_db=True, cattle_id=cattle_id, key="identify")
+                                st.divider()
                         else:
-                            st.error("❌ Failed to process image or empty database")
+                            name_info = details.get('cattle_name', details.get('name', 'Unknown'))
+                            st.warning(f"❌ Candidate {rank+1}: {name_info} (Low confidence: {score:.3f})")
+                    
+                    if not found_match:
+                        st.error(f"❌ No confident matches found above threshold {threshold:.2f}")
+                        st.info("💡 Try lowering the confidence threshold or register this cattle if it's new.")
                             
             except Exception as e:
                 st.error(f"❌ Error processing image: {str(e)}")
@@ -657,56 +2252,26 @@ with tabs[1]:
         uploaded_file = st.file_uploader("Upload an Image for YOLO Classification", type=["jpg", "jpeg", "png"], key="yolo_upload")
 
         if uploaded_file is not None:
-            image = Image.open(uploaded_file).convert("RGB")
-            st.image(image, caption="Uploaded Image", use_column_width=True)
+            item = prepare_upload(uploaded_file)
+            st.image(item["image"], caption="Uploaded Image", use_column_width=True)
 
-            # Step 1: ROI detection
-            roi_results = roi_model.predict(image)
-            if not roi_results or len(roi_results[0].boxes) == 0:
+            # Step 1: ROI detection (cached by content hash, so reruns skip YOLO)
+            roi_bbox, roi_conf = detect_roi(item)
+            if roi_bbox is None:
                 st.warning("⚠️ Please upload a proper cow face image (no ROI detected).")
             else:
-                # Get the highest confidence ROI
-                roi_box = max(roi_results[0].boxes, key=lambda b: b.conf)
-                roi_conf = float(roi_box.conf)
-
                 if roi_conf < 0.60:
                     st.warning("⚠️ Please upload a proper cow face image (ROI confidence < 0.60).")
                 else:
                     # Crop ROI region
-                    x1, y1, x2, y2 = map(int, roi_box.xyxy[0].tolist())
-                    roi_crop = image.crop((x1, y1, x2, y2))
-                    st.image(roi_crop, caption=f"Detected ROI (Confidence: {roi_conf:.2f})", use_column_width=True)
+                    st.image(roi_crop(item, roi_bbox), caption=f"Detected ROI (Confidence: {roi_conf:.2f})", use_column_width=True)
 
                     # Step 2: Classification on ROI
-                    results = cls_model.predict(roi_crop)
-                    top_result = results[0].probs
-                    class_id = int(top_result.top1)
-                    confidence = float(top_result.top1conf)
-                    class_name = cls_model.names[class_id]
+                    class_name, confidence = classify_roi(item, roi_bbox)
 
                     if confidence < 0.90:
                         st.error("⚠️ Data not available in DB for reliable classification.")
                     else:
-                        # Store YOLO results in MongoDB
-                        import hashlib
-                        # Read file content BEFORE it's consumed by PIL
-                        uploaded_file.seek(0)  # Reset to beginning first
-                        file_content = uploaded_file.read()
-                        image_id = hashlib.md5(file_content).hexdigest()
-                        uploaded_file.seek(0)  # Reset for later use
-                        
-                        # Save YOLO result to MongoDB
-                        # save_yolo_result(
-                        #     image_id=image_id,
-                        #     roi_conf=roi_conf,
-                        #     class_name=class_name,
-                        #     confidence=confidence,
-                        #     roi_bbox=[x1, y1, x2, y2]
-                        # )
-                        
-                        # st.success(f"✅ Classification Result Saved to MongoDB")
-                        # st.info(f"Class: {class_name} | Confidence: {confidence:.2%}")
-                        
                         # Also show classification results
                         if confidence >= ui_threshold:
                             st.success(f"Predicted Class: **{class_name}** (Confidence: {confidence:.2f})")
@@ -749,13 +2314,16 @@ with tabs[2]:
             st.error("⚠️ Please enter all details and upload at least one image.")
         elif len(cattle_id) != 12 or not cattle_id.isdigit():
             st.error("⚠️ Cattle code must be exactly 12 digits.")
-        elif get_cattle_by_id(cattle_id):
+        elif get_cattle_by_id(cattle_id, {"_id": 1}):
             st.warning("⚠️ This 12-digit code is already registered!")
         else:
             with st.spinner("Processing images and validating cattle ROI..."):
                 try:
                     embeddings = []
                     img_paths = []
+                    img_hashes = []
+                    img_rois = []
+                    clip_imgs = []
                     # No longer need local file storage
                     # All images are stored in MongoDB
                     
@@ -766,20 +2334,19 @@ with tabs[2]:
 
                     # Process each uploaded image with ROI validation
                     for i, file in enumerate(ref_files):
-                        img = Image.open(file).convert("RGB")
+                        # Decoded once; shared by ROI validation and CLIP
+                        item = prepare_upload(file)
+                        img = item["image"]
                         
                         # Apply ROI validation if YOLO model is available
                         has_valid_roi = False
                         roi_confidence = 0.0
+                        roi_bbox = None
                         validation_status = ""
                         
                         if roi_model is not None:
-                            roi_results = roi_model.predict(img)
-                            if roi_results and len(roi_results[0].boxes) > 0:
-                                # Get the highest confidence ROI
-                                roi_box = max(roi_results[0].boxes, key=lambda b: b.conf)
-                                roi_confidence = float(roi_box.conf)
-                                
+                            roi_bbox, roi_confidence = detect_roi(item)
+                            if roi_bbox is not None:
                                 if roi_confidence >= 0.60:
                                     has_valid_roi = True
                                     validation_status = f"✅ Valid (ROI: {roi_confidence:.2f})"
@@ -807,12 +2374,18 @@ with tabs[2]:
                         
                         # Only process embeddings for images with valid ROI
                         if has_valid_roi:
-                            emb = embed_image(img)
-                            
-                            if emb is not None:
-                                embeddings.append(emb)
-                                # Images will be saved to MongoDB
-                                img_paths.append(img)  # Store PIL image directly
+                            # Images will be saved to MongoDB as uploaded (no re-encoding)
+                            img_paths.append(file)
+                            clip_imgs.append(img)
+                            img_hashes.append(item["hash"])
+                            img_rois.append({"roi_bbox": roi_bbox, "roi_confidence": roi_confidence} if roi_bbox else None)
+                    
+                    # Embed all valid images in batched forward passes
+                    feats = embed_images(clip_imgs, hashes=img_hashes) if clip_imgs else None
+                    if feats is not None:
+                        embeddings = [feat.reshape(1, -1) for feat in feats]
+                    else:
+                        img_paths = []
                     
                     # Display validation results with images
                     st.subheader("Image Validation Results")
@@ -854,7 +2427,8 @@ with tabs[2]:
                         avg_embedding = avg_embedding / np.linalg.norm(avg_embedding, axis=1, keepdims=True)
 
                         # Save to MongoDB (only valid images from img_paths)
-                        doc = save_new_cattle_to_db(cattle_id, cattle_name, cattle_class, img_paths, avg_embedding)
+                        doc = save_new_cattle_to_db(cattle_id, cattle_name, cattle_class, img_paths, avg_embedding,
+                                                    image_embeddings=embeddings, image_rois=img_rois)
                         if doc:
                             st.success(f"✅ Successfully registered {cattle_name} ({cattle_class}) with ID {cattle_id}")
                             # Display uploaded images from DB
@@ -863,22 +2437,9 @@ with tabs[2]:
                             
                             # Update FAISS index immediately with new embedding
                             if avg_embedding is not None:
-                                # Add to existing index
-                                index.add(avg_embedding / np.linalg.norm(avg_embedding, axis=1, keepdims=True))
-                                
-                                # Update ordered IDs list in MongoDB
                                 try:
-                                    # Get current ordered IDs from MongoDB
-                                    faiss_doc = faiss_index_collection.find_one({"_id": "faiss_index"})
-                                    if faiss_doc and "ordered_ids" in faiss_doc:
-                                        ordered_ids = faiss_doc["ordered_ids"]
-                                    else:
-                                        ordered_ids = []
-                                    
-                                    ordered_ids.append(cattle_id)
-                                    
-                                    # Save updated index and IDs to MongoDB
-                                    save_faiss_to_mongodb(index, ordered_ids)
+                                    # Add to the shared index keyed by cattle ID
+                                    faiss_upsert(cattle_id, avg_embedding)
                                 except:
                                     # If there's an issue, rebuild entirely
                                     rebuild_faiss()
@@ -897,44 +2458,49 @@ with tabs[3]:
     with col1:
         q_id = st.text_input("Filter by ID (partial or full)", key="browse_id")
     with col2:
-        q_name = st.text_input("Filter by Name (partial, case-insensitive)", key="browse_name")
+        q_name = st.text_input("Filter by Name (starts with, case-insensitive)", key="browse_name")
     with col3:
         limit = st.number_input("Limit", min_value=1, max_value=500, value=50, step=1, key="browse_limit")
 
     if st.button("Search", key="browse_search"):
-            docs = list_cattle_from_db(filter_id=q_id.strip() or None, filter_name=q_name.strip() or None, limit=int(limit))
-            if not docs:
-                st.info("No matching records found.")
-            else:
-                st.write(f"Found {len(docs)} records (showing up to {limit})")
-                table_rows = []
-                for d in docs:
-                    table_rows.append({
-                        "12_digit_id": d.get("12_digit_id"),
-                        "cattle_name": d.get("cattle_name"),
-                        "cattle_class": d.get("cattle_class"),
-                        "created_at": d.get("created_at"),
-                        "n_images": len(d.get("images", []))
-                    })
-                st.dataframe(pd.DataFrame(table_rows))
+        # Lightweight rows with a server-side image count; no image data is fetched
+        docs, _ = list_cattle_page(cattle_filter(q_id.strip() or None, q_name.strip() or None), page_size=int(limit))
+        # Only the table rows are kept between reruns; exports are built on request
+        st.session_state["browse_results"] = [{
+            "12_digit_id": d.get("12_digit_id"),
+            "cattle_name": d.get("cattle_name"),
+            "cattle_class": d.get("cattle_class"),
+            "created_at": d.get("created_at"),
+            "n_images": d["image_count"]
+        } for d in docs]
 
-                ids = [d["12_digit_id"] for d in docs]
-                selected = st.multiselect("Select specific IDs", options=ids)
-
-                if selected:
-                    download_docs = [get_cattle_by_id(s) for s in selected if get_cattle_by_id(s)]
-                else:
-                    download_docs = docs
+    table_rows = st.session_state.get("browse_results")
+    if table_rows is not None:
+        if not table_rows:
+            st.info("No matching records found.")
+        else:
+            st.write(f"Found {len(table_rows)} records (showing up to {limit})")
+            st.dataframe(pd.DataFrame(table_rows))
 
-                csv_bytes = create_metadata_csv_bytes(download_docs)
-                zip_bytes = create_images_zip_bytes(download_docs)
+            ids = [row["12_digit_id"] for row in table_rows]
+            selected = st.multiselect("Select specific IDs", options=ids)
+            download_ids = selected or ids
+            stamp = datetime.utcnow().strftime('%Y%m%d_%H%M%S')
 
-                st.download_button("⬇️ Download metadata CSV", data=csv_bytes,
-                                   file_name=f"cattle_metadata_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.csv",
-                                   mime="text/csv")
-                st.download_button("⬇️ Download images ZIP", data=zip_bytes,
-                                   file_name=f"cattle_images_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.zip",
-                                   mime="application/zip")
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("📄 Prepare metadata CSV", key="browse_prepare_csv"):
+                    with export_metadata_csv(download_ids) as csv_file:
+                        st.download_button("⬇️ Download metadata CSV", data=csv_file.read(),
+                                           file_name=f"cattle_metadata_{stamp}.csv",
+                                           mime="text/csv")
+            with col2:
+                if st.button("📦 Prepare images ZIP", key="browse_prepare_zip"):
+                    with st.spinner("Building ZIP..."):
+                        with export_images_zip(download_ids) as zip_file:
+                            st.download_button("⬇️ Download images ZIP", data=zip_file.read(),
+                                               file_name=f"cattle_images_{stamp}.zip",
+                                               mime="application/zip")
 
 # ================== TAB: Quick Lookup ==================
 with tabs[4]:
@@ -942,22 +2508,182 @@ with tabs[4]:
     lookup_id = st.text_input("Enter exact 12-digit ID to view", key="lookup_id")
     if st.button("Lookup", key="lookup_button"):
         if not lookup_id:
+            st.session_state.pop("lookup_result", None)
             st.error("Enter an ID to lookup.")
         else:
-            # Get from MongoDB
-            doc = get_cattle_by_id(lookup_id.strip())
-            
-            if not doc:
-                st.warning("No cattle found with that ID.")
-            else:
-                name = doc.get('cattle_name', doc.get('name', 'Unknown'))
-                class_info = doc.get('cattle_class', doc.get('class', 'Unknown'))
-                st.write(f"**{lookup_id} — {name} ({class_info})**")
-                if 'created_at' in doc:
-                    st.write(f"Created at: {doc['created_at']}")
+            # Kept in session state so widgets below (full-size images) survive their reruns
+            st.session_state["lookup_result"] = lookup_id.strip()
+    
+    looked_up = st.session_state.get("lookup_result")
+    if looked_up:
+        # Get from MongoDB
+        doc = get_cattle_by_id(looked_up, WITHOUT_ORIGINALS)
+        
+        if not doc:
+            st.warning("No cattle found with that ID.")
+        else:
+            name = doc.get('cattle_name', doc.get('name', 'Unknown'))
+            class_info = doc.get('cattle_class', doc.get('class', 'Unknown'))
+            st.write(f"**{looked_up} — {name} ({class_info})**")
+            if 'created_at' in doc:
+                st.write(f"Created at: {doc['created_at']}")
 
-                if 'images' in doc:
-                    show_images_with_captions(doc["images"], title="Reference Images", from_db=True)
+            if 'images' in doc:
+                show_images_with_captions(doc["images"], title="Reference Images", from_db=True, cattle_id=doc["12_digit_id"], key="lookup")
+
+# -----------------------------------------------------------------------------
+# Management record editor (rendered only for opened records)
+# -----------------------------------------------------------------------------
+@st.fragment
+def render_management_record(cattle_id: str):
+    """Edit, image and delete tabs of one record; its widgets rerun only this fragment"""
+    doc = get_cattle_by_id(cattle_id, {"images": 0})
+    if doc is None:
+        st.info("This record no longer exists.")
+        return
+    name = doc["cattle_name"]
+    class_info = doc.get("cattle_class", "Unknown")
+    
+    # Tab layout for better organization
+    edit_tabs = st.tabs(["📋 Details", "🖼️ Images", "🗑️ Delete"])
+    
+    with edit_tabs[0]:
+        st.subheader("Edit Details")
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            new_name = st.text_input(
+                "Cattle Name", 
+                value=name, 
+                key=f"mongo_name_{cattle_id}"
+            )
+        with col2:
+            new_class = st.text_input(
+                "Cattle Class", 
+                value=class_info, 
+                key=f"mongo_class_{cattle_id}"
+            )
+        
+        if st.button(f"💾 Save Details", key=f"save_mongo_{cattle_id}"):
+            if new_name and new_class:
+                updates = {
+                    "cattle_name": new_name,
+                    "cattle_class": new_class
+                }
+                if update_cattle_in_db(cattle_id, updates):
+                    # Full rerun so the record's label in the list shows the new details
+                    st.success("✅ Details updated successfully")
+                    st.rerun()
+                else:
+                    st.error("❌ Failed to update details")
+            else:
+                st.error("❌ Name and class cannot be empty")
+        
+        st.divider()
+        st.write(f"**ID:** {cattle_id}")
+        if "created_at" in doc:
+            st.write(f"**Created:** {doc['created_at']}")
+    
+    with edit_tabs[1]:
+        st.subheader("Manage Images")
+        
+        # Show existing images with remove option (thumbnails of this record only)
+        current_images = get_cattle_images(cattle_id)
+        if current_images:
+            st.write(f"**Current Images ({len(current_images)}):**")
+            cols = st.columns(min(3, len(current_images)))
+            for idx, img_data in enumerate(current_images):
+                with cols[idx % 3]:
+                    if img_data.get("filename"):
+                        try:
+                            thumb = display_thumbnail(cattle_id, img_data)
+                            if thumb:
+                                st.image(thumb, caption=img_data.get("filename", f"Image {idx+1}"), use_column_width=True)
+                            else:
+                                st.error(f"❌ Empty image data: {img_data.get('filename', f'Image {idx+1}')}")
+                                continue
+                        except Exception as e:
+                            st.error(f"❌ Invalid image: {img_data.get('filename', f'Image {idx+1}')} - {str(e)[:50]}")
+                            continue
+                        if st.button(f"🗑️ Remove", key=f"remove_img_{cattle_id}_{idx}"):
+                            if delete_cattle_image_from_db(cattle_id, img_data["filename"]):
+                                refresh_cattle_in_faiss(cattle_id)
+                                st.success("✅ Image removed")
+                                st.rerun(scope="fragment")
+                            else:
+                                st.error("❌ Failed to remove image")
+            if st.checkbox("Show full-size images", key=f"originals_mgmt_{cattle_id}"):
+                for img_data, data in display_originals(cattle_id):
+                    if data:
+                        st.image(data, caption=img_data.get("filename"))
+        else:
+            st.info("No images available")
+        
+        # Add new images
+        st.divider()
+        st.write("**Add New Images:**")
+        new_images = st.file_uploader(
+            "Upload additional images", 
+            type=["jpg","jpeg","png"], 
+            accept_multiple_files=True,
+            key=f"add_images_{cattle_id}"
+        )
+        
+        if new_images:
+            # Validate new images with YOLO
+            with st.spinner("Validating new images..."):
+                valid_images = []
+                valid_items = []
+                valid_rois = []
+                invalid_count = 0
+                
+                for img_file in new_images:
+                    # Decoded once; shared by ROI validation and CLIP
+                    item = prepare_upload(img_file)
+                    if roi_model:
+                        roi_bbox, roi_conf = detect_roi(item)
+                        if roi_bbox is not None and roi_conf >= 0.60:
+                            valid_images.append(img_file)
+                            valid_items.append(item)
+                            valid_rois.append({"roi_bbox": roi_bbox, "roi_confidence": roi_conf})
+                        else:
+                            invalid_count += 1
+                    else:
+                        valid_images.append(img_file)
+                        valid_items.append(item)
+                        valid_rois.append(None)
+                
+                if invalid_count > 0:
+                    st.warning(f"⚠️ {invalid_count} image(s) failed validation (ROI confidence < 0.60)")
+                
+                if valid_images and st.button(f"➕ Add {len(valid_images)} Valid Image(s)", key=f"confirm_add_{cattle_id}"):
+                    with st.spinner("Adding images..."):
+                        # Embed only the new images; the stored running sum is updated incrementally
+                        feats = embed_images([item["image"] for item in valid_items],
+                                             hashes=[item["hash"] for item in valid_items])
+                        new_embeddings = list(feats) if feats is not None else [None] * len(valid_images)
+                        if add_cattle_images_to_db(cattle_id, valid_images, new_embeddings, new_rois=valid_rois):
+                            if any(emb is not None for emb in new_embeddings):
+                                refresh_cattle_in_faiss(cattle_id)
+                            
+                            st.success(f"✅ Added {len(valid_images)} image(s) successfully")
+                            st.rerun(scope="fragment")
+                        else:
+                            st.error("❌ Failed to add images")
+    
+    with edit_tabs[2]:
+        st.subheader("Delete Cattle Record")
+        st.warning("⚠️ This action cannot be undone!")
+        st.write(f"This will permanently delete cattle **{name}** (ID: {cattle_id}) and all associated data.")
+        
+        if st.button(f"🗑️ Delete Permanently", key=f"delete_mongo_{cattle_id}", type="secondary"):
+            try:
+                delete_cattle_from_db([cattle_id])
+                st.success("✅ Deleted from MongoDB successfully")
+                faiss_remove([cattle_id])
+                st.rerun()
+            except Exception as e:
+                st.error(f"❌ Error deleting cattle: {str(e)}")
 
 # ================== TAB: Management ==================
 with tabs[5]:
@@ -966,7 +2692,7 @@ with tabs[5]:
     # Get total cattle count from MongoDB
     total_cattle = 0
     try:
-        total_cattle = cattle_collection.count_documents({})
+        total_cattle = get_herd_stats()["records"]
         st.info(f"Managing {total_cattle} cattle records in MongoDB.")
     except Exception as e:
         st.error(f"MongoDB connection error: {e}")
@@ -979,174 +2705,19 @@ with tabs[5]:
         
         # MongoDB cattle management
         # Search in MongoDB
-        if search_term:
-            docs = list_cattle_from_db(filter_id=search_term, filter_name=search_term, limit=100)
-        else:
-            docs = list_cattle_from_db(limit=100)
+        page_size = st.select_slider("Records per page", options=[10, 20, 50, 100], value=20, key="mgmt_page_size")
+        # ID, name or class prefix, each answered by an index
+        docs = paginated_cattle("mgmt_page", search_cattle_filter(search_term), page_size)
         
         st.caption(f"Showing {len(docs)} cattle from MongoDB")
         
         for doc in docs:
-                cattle_id = doc["12_digit_id"]
-                name = doc["cattle_name"]
-                class_info = doc.get("cattle_class", "Unknown")
-                
-                with st.expander(f"🆔 {cattle_id} - {name} ({class_info})"):
-                    # Tab layout for better organization
-                    edit_tabs = st.tabs(["📋 Details", "🖼️ Images", "🗑️ Delete"])
-                    
-                    with edit_tabs[0]:
-                        st.subheader("Edit Details")
-                        col1, col2 = st.columns(2)
-                        
-                        with col1:
-                            new_name = st.text_input(
-                                "Cattle Name", 
-                                value=name, 
-                                key=f"mongo_name_{cattle_id}"
-                            )
-                        with col2:
-                            new_class = st.text_input(
-                                "Cattle Class", 
-                                value=class_info, 
-                                key=f"mongo_class_{cattle_id}"
-                            )
-                        
-                        if st.button(f"💾 Save Details", key=f"save_mongo_{cattle_id}"):
-                            if new_name and new_class:
-                                updates = {
-                                    "cattle_name": new_name,
-                                    "cattle_class": new_class
-                                }
-                                if update_cattle_in_db(cattle_id, updates):
-                                    st.success("✅ Details updated successfully")
-                                    st.rerun()
-                                else:
-                                    st.error("❌ Failed to update details")
-                            else:
-                                st.error("❌ Name and class cannot be empty")
-                        
-                        st.divider()
-                        st.write(f"**ID:** {cattle_id}")
-                        if "created_at" in doc:
-                            st.write(f"**Created:** {doc['created_at']}")
-                    
-                    with edit_tabs[1]:
-                        st.subheader("Manage Images")
-                        
-                        # Show existing images with remove option
-                        current_images = doc.get("images", [])
-                        if current_images:
-                            st.write(f"**Current Images ({len(current_images)}):**")
-                            cols = st.columns(min(3, len(current_images)))
-                            for idx, img_data in enumerate(current_images):
-                                with cols[idx % 3]:
-                                    if img_data.get("b64"):
-                                        try:
-                                            img_bytes = base64.b64decode(img_data["b64"])
-                                            if len(img_bytes) > 0:
-                                                img = Image.open(io.BytesIO(img_bytes))
-                                                st.image(img, caption=img_data.get("filename", f"Image {idx+1}"), use_column_width=True)
-                                            else:
-                                                st.error(f"❌ Empty image data: {img_data.get('filename', f'Image {idx+1}')}")
-                                                continue
-                                        except Exception as e:
-                                            st.error(f"❌ Invalid image: {img_data.get('filename', f'Image {idx+1}')} - {str(e)[:50]}")
-                                            continue
-                                        if st.button(f"🗑️ Remove", key=f"remove_img_{cattle_id}_{idx}"):
-                                            if delete_cattle_image_from_db(cattle_id, img_data["filename"]):
-                                                st.success("✅ Image removed")
-                                                st.rerun()
-                                            else:
-                                                st.error("❌ Failed to remove image")
-                        else:
-                            st.info("No images available")
-                        
-                        # Add new images
-                        st.divider()
-                        st.write("**Add New Images:**")
-                        new_images = st.file_uploader(
-                            "Upload additional images", 
-                            type=["jpg","jpeg","png"], 
-                            accept_multiple_files=True,
-                            key=f"add_images_{cattle_id}"
-                        )
-                        
-                        if new_images:
-                            # Validate new images with YOLO
-                            with st.spinner("Validating new images..."):
-                                valid_images = []
-                                invalid_count = 0
-                                
-                                for img_file in new_images:
-                                    if roi_model:
-                                        img = Image.open(img_file).convert("RGB")
-                                        roi_results = roi_model.predict(img)
-                                        if roi_results and len(roi_results[0].boxes) > 0:
-                                            roi_box = max(roi_results[0].boxes, key=lambda b: b.conf)
-                                            roi_conf = float(roi_box.conf)
-                                            if roi_conf >= 0.60:
-                                                valid_images.append(img_file)
-                                            else:
-                                                invalid_count += 1
-                                        else:
-                                            invalid_count += 1
-                                    else:
-                                        valid_images.append(img_file)
-                                
-                                if invalid_count > 0:
-                                    st.warning(f"⚠️ {invalid_count} image(s) failed validation (ROI confidence < 0.60)")
-                                
-                                if valid_images and st.button(f"➕ Add {len(valid_images)} Valid Image(s)", key=f"confirm_add_{cattle_id}"):
-                                    with st.spinner("Adding images..."):
-                                        if add_cattle_images_to_db(cattle_id, valid_images):
-                                            # Update embeddings if needed
-                                            all_images = []
-                                            updated_doc = get_cattle_by_id(cattle_id)
-                                            if updated_doc and "images" in updated_doc:
-                                                for img_data in updated_doc["images"]:
-                                                    if img_data.get("b64"):
-                                                        try:
-                                                            img_bytes = base64.b64decode(img_data["b64"])
-                                                            if len(img_bytes) > 0:
-                                                                img = Image.open(io.BytesIO(img_bytes))
-                                                                all_images.append(img)
-                                                        except Exception as e:
-                                                            st.warning(f"Skipping corrupted image: {img_data.get('filename', 'unknown')}")
-                                                            continue
-                                            
-                                            if all_images:
-                                                # Re-calculate embeddings for all images
-                                                embeddings = []
-                                                for img in all_images:
-                                                    emb = embed_image(img)
-                                                    if emb is not None:
-                                                        embeddings.append(emb)
-                                                
-                                                if embeddings:
-                                                    avg_embedding = np.mean(np.vstack(embeddings), axis=0, keepdims=True)
-                                                    avg_embedding = avg_embedding / np.linalg.norm(avg_embedding, axis=1, keepdims=True)
-                                                    update_cattle_in_db(cattle_id, {"embedding": avg_embedding.flatten().tolist()})
-                                                    rebuild_faiss()
-                                            
-                                            st.success(f"✅ Added {len(valid_images)} image(s) successfully")
-                                            st.rerun()
-                                        else:
-                                            st.error("❌ Failed to add images")
-                    
-                    with edit_tabs[2]:
-                        st.subheader("Delete Cattle Record")
-                        st.warning("⚠️ This action cannot be undone!")
-                        st.write(f"This will permanently delete cattle **{name}** (ID: {cattle_id}) and all associated data.")
-                        
-                        if st.button(f"🗑️ Delete Permanently", key=f"delete_mongo_{cattle_id}", type="secondary"):
-                            try:
-                                cattle_collection.delete_one({"12_digit_id": cattle_id})
-                                st.success("✅ Deleted from MongoDB successfully")
-                                rebuild_faiss()
-                                st.rerun()
-                            except Exception as e:
-                                st.error(f"❌ Error deleting cattle: {str(e)}")
+            cattle_id = doc["12_digit_id"]
+            label = f"🆔 {cattle_id} - {doc['cattle_name']} ({doc.get('cattle_class', 'Unknown')}) · {doc['image_count']} image(s)"
+            # A closed record costs one toggle; its editor and images load only when opened
+            if st.toggle(label, key=f"mgmt_open_{cattle_id}"):
+                with st.container(border=True):
+                    render_management_record(cattle_id)
 
 # ================== TAB: Database Viewer ==================
 with tabs[6]:
@@ -1159,13 +2730,10 @@ with tabs[6]:
     col1, col2, col3, col4 = st.columns(4)
     
     try:
-        total_records = cattle_collection.count_documents({})
-        with_embeddings = cattle_collection.count_documents({"embedding": {"$ne": None}})
-        total_images = 0
-        
-        # Calculate total images
-        for doc in cattle_collection.find({}, {"images": 1}):
-            total_images += len(doc.get("images", []))
+        herd_stats = get_herd_stats()
+        total_records = herd_stats["records"]
+        with_embeddings = herd_stats["with_embeddings"]
+        total_images = herd_stats["images"]
         
         avg_images = total_images / total_records if total_records > 0 else 0
         
@@ -1179,257 +2747,355 @@ with tabs[6]:
             st.metric("Avg Images/Cattle", f"{avg_images:.1f}")
     except Exception as e:
         st.error(f"Error fetching statistics: {e}")
+    
+    st.divider()
+    
+    # View options
+    view_tabs = st.tabs(["📊 Table View", "📄 Raw Data", "📈 Analytics", "🔧 Database Tools"])
+    
+    with view_tabs[0]:
+        st.subheader("Table View")
         
-        st.divider()
-        
-        # View options
-        view_tabs = st.tabs(["📊 Table View", "📄 Raw Data", "📈 Analytics", "🔧 Database Tools"])
+        # Pagination
+        items_per_page = st.select_slider("Items per page", options=[5, 10, 20, 50, 100], value=10)
         
-        with view_tabs[0]:
-            st.subheader("Table View")
+        try:
+            # Only the current page, without image data
+            page_docs = paginated_cattle("table_page", page_size=items_per_page)
             
-            # Pagination
-            items_per_page = st.select_slider("Items per page", options=[5, 10, 20, 50, 100], value=10)
+            if page_docs:
+                # Create table data
+                table_data = []
+                embedded_ids = get_embedded_ids([doc["12_digit_id"] for doc in page_docs])
+                for doc in page_docs:
+                    table_data.append({
+                        "ID": doc["12_digit_id"],
+                        "Name": doc["cattle_name"],
+                        "Class": doc.get("cattle_class", "Unknown"),
+                        "Images": doc["image_count"],
+                        "Has Embedding": "✅" if doc["12_digit_id"] in embedded_ids else "❌",
+                        "Created": doc.get("created_at", "Unknown")[:10] if doc.get("created_at") else "Unknown"
+                    })
+                
+                st.dataframe(table_data, use_container_width=True)
+                st.caption(f"Showing {len(page_docs)} of {get_herd_stats()['records']} records")
+            else:
+                st.info("No records found in database")
+                
+        except Exception as e:
+            st.error(f"Error loading table: {e}")
+    
+    with view_tabs[1]:
+        st.subheader("Raw Database Records")
+        
+        # Record selector
+        try:
+            all_ids = [doc["12_digit_id"] for doc in cattle_collection.find({}, {"12_digit_id": 1})]
             
-            try:
-                # Get all documents for table view
-                all_docs = list(cattle_collection.find().sort("created_at", -1))
+            if all_ids:
+                selected_id = st.selectbox("Select a record to view", all_ids)
+                
+                if selected_id:
+                    doc = cattle_collection.find_one({"12_digit_id": selected_id}, {"images.thumb": 0})
+                    if doc:
+                        # Remove large binary data for display
+                        display_doc = doc.copy()
+                        if "_id" in display_doc:
+                            display_doc["_id"] = str(display_doc["_id"])
+                        
+                        # Summarize images without showing base64
+                        if "images" in display_doc:
+                            image_summary = []
+                            for img in display_doc["images"]:
+                                image_summary.append({
+                                    "filename": img.get("filename", "Unknown"),
+                                    "hash": img.get("hash"),
+                                    "size": img.get("size", len(img.get("b64", "")))
+                                })
+                            display_doc["images"] = image_summary
+                        
+                        # Summarize stored embeddings
+                        emb_doc = embedding_collection.find_one({"_id": selected_id}, {"sum": 0})
+                        if emb_doc:
+                            display_doc["embedding"] = {
+                                "vector": f"Vector[{emb_doc.get('dim', embedding_dim)}] ({emb_doc.get('dtype')})" if emb_doc.get("vector") else None,
+                                "image_vectors": [entry["filename"] for entry in emb_doc.get("images", [])],
+                                "model": emb_doc.get("model"),
+                                "updated_at": emb_doc.get("updated_at")
+                            }
+                        
+                        st.json(display_doc)
+                        
+                        # Option to view full record
+                        if st.checkbox("Show full record with base64 data", key=f"full_{selected_id}"):
+                            st.warning("⚠️ Large amount of data below")
+                            st.text(str(doc))
+            else:
+                st.info("No records in database")
                 
-                if all_docs:
-                    # Create table data
-                    table_data = []
-                    for doc in all_docs[:items_per_page]:
-                        table_data.append({
+        except Exception as e:
+            st.error(f"Error viewing records: {e}")
+    
+    with view_tabs[2]:
+        st.subheader("Database Analytics")
+        
+        try:
+            # Class distribution
+            herd_stats = get_herd_stats()
+            class_dist = herd_stats["classes"]
+            
+            if class_dist:
+                st.write("**Cattle Class Distribution:**")
+                for class_name, count in sorted(class_dist.items(), key=lambda x: x[1], reverse=True):
+                    st.write(f"- {class_name}: {count} cattle")
+            
+            st.divider()
+            
+            # Image statistics
+            image_counts = herd_stats["image_counts"]
+            
+            if image_counts:
+                st.write("**Image Statistics:**")
+                st.write(f"- Min images per cattle: {min(image_counts)}")
+                st.write(f"- Max images per cattle: {max(image_counts)}")
+                st.write(f"- Average images: {herd_stats['images'] / herd_stats['records']:.2f}")
+            
+            st.divider()
+            
+            # Embedding coverage
+            total_recs = herd_stats["records"]
+            with_emb = herd_stats["with_embeddings"]
+            without_emb = total_recs - with_emb
+            
+            st.write("**Embedding Coverage:**")
+            if total_recs > 0:
+                st.write(f"- With embeddings: {with_emb} ({with_emb/total_recs*100:.1f}%)")
+                st.write(f"- Without embeddings: {without_emb} ({without_emb/total_recs*100:.1f}%)")
+            else:
+                st.write("- No records in database")
+            
+        except Exception as e:
+            st.error(f"Error generating analytics: {e}")
+    
+    with view_tabs[3]:
+        st.subheader("Database Tools")
+        
+        col1, col2 = st.columns(2)
+        
+        with col1:
+            st.write("**Export Data**")
+            if st.button("📥 Export All Records as JSON"):
+                try:
+                    all_docs = list(cattle_collection.find({}, {"images.thumb": 0}))
+                    # Convert ObjectId to string for JSON serialization
+                    for doc in all_docs:
+                        if "_id" in doc:
+                            doc["_id"] = str(doc["_id"])
+                    
+                    json_data = json.dumps(all_docs, indent=2)
+                    st.download_button(
+                        label="💾 Download JSON",
+                        data=json_data,
+                        file_name=f"cattle_database_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
+                        mime="application/json"
+                    )
+                    st.success(f"✅ Prepared {len(all_docs)} records for download")
+                except Exception as e:
+                    st.error(f"Error exporting data: {e}")
+            
+            if st.button("📥 Export Summary CSV"):
+                try:
+                    import pandas as pd
+                    
+                    summary_data = []
+                    embedded_ids = get_embedded_ids()
+                    for doc in cattle_collection.find({}, METADATA_ONLY):
+                        summary_data.append({
                             "ID": doc["12_digit_id"],
                             "Name": doc["cattle_name"],
                             "Class": doc.get("cattle_class", "Unknown"),
                             "Images": len(doc.get("images", [])),
-                            "Has Embedding": "✅" if doc.get("embedding") else "❌",
-                            "Created": doc.get("created_at", "Unknown")[:10] if doc.get("created_at") else "Unknown"
+                            "Has_Embedding": doc["12_digit_id"] in embedded_ids,
+                            "Created": doc.get("created_at", "")
                         })
                     
-                    st.dataframe(table_data, use_container_width=True)
+                    df = pd.DataFrame(summary_data)
+                    summary_csv = df.to_csv(index=False)
                     
-                    if len(all_docs) > items_per_page:
-                        st.caption(f"Showing {items_per_page} of {len(all_docs)} records")
-                else:
-                    st.info("No records found in database")
-                    
-            except Exception as e:
-                st.error(f"Error loading table: {e}")
+                    st.download_button(
+                        label="💾 Download CSV",
+                        data=summary_csv,
+                        file_name=f"cattle_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
+                        mime="text/csv"
+                    )
+                    st.success(f"✅ Prepared summary of {len(summary_data)} records")
+                except Exception as e:
+                    st.error(f"Error creating CSV: {e}")
         
-        with view_tabs[1]:
-            st.subheader("Raw Database Records")
+        with col2:
+            st.write("**Database Maintenance**")
             
-            # Record selector
-            try:
-                all_ids = [doc["12_digit_id"] for doc in cattle_collection.find({}, {"12_digit_id": 1})]
-                
-                if all_ids:
-                    selected_id = st.selectbox("Select a record to view", all_ids)
-                    
-                    if selected_id:
-                        doc = cattle_collection.find_one({"12_digit_id": selected_id})
-                        if doc:
-                            # Remove large binary data for display
-                            display_doc = doc.copy()
-                            if "_id" in display_doc:
-                                display_doc["_id"] = str(display_doc["_id"])
-                            
-                            # Summarize images without showing base64
-                            if "images" in display_doc:
-                                image_summary = []
-                                for img in display_doc["images"]:
-                                    image_summary.append({
-                                        "filename": img.get("filename", "Unknown"),
-                                        "size": len(img.get("b64", "")) if "b64" in img else 0
-                                    })
-                                display_doc["images"] = image_summary
-                            
-                            # Summarize embedding
-                            if "embedding" in display_doc and display_doc["embedding"]:
-                                display_doc["embedding"] = f"Vector[{len(display_doc['embedding'])}]"
-                            
-                            st.json(display_doc)
-                            
-                            # Option to view full record
-                            if st.checkbox("Show full record with base64 data", key=f"full_{selected_id}"):
-                                st.warning("⚠️ Large amount of data below")
-                                st.text(str(doc))
+            # FAISS index backend and vector encoding
+            current_config = faiss_store.config
+            st.caption(
+                f"FAISS index: {current_config.get('index_mode', 'flat')}/{current_config.get('encoding', 'flat')} "
+                f"(requested: {current_config.get('requested_mode', 'auto')}/{current_config.get('requested_encoding', 'flat')}, "
+                f"{live_vector_count()} vectors, params: {current_config.get('search_params') or '-'})"
+            )
+            index_stats = current_config.get("stats") or {}
+            if index_stats.get("bytes"):
+                st.caption(
+                    f"Index size: {index_stats['bytes'] / 1e6:.2f} MB "
+                    f"(float32 vectors: {index_stats.get('exact_bytes', 0) / 1e6:.2f} MB), "
+                    f"recall@{RECALL_K} vs exact: {index_stats.get(f'recall_at_{RECALL_K}', '-')}"
+                )
+            requested_mode = st.selectbox(
+                "Index backend",
+                FAISS_INDEX_MODES,
+                index=FAISS_INDEX_MODES.index(current_config.get("requested_mode", "auto")),
+                help="auto: exact (flat) for small herds, IVF from 10k and HNSW from 100k animals",
+                key="faiss_index_mode"
+            )
+            requested_encoding = st.selectbox(
+                "Vector encoding",
+                FAISS_ENCODINGS,
+                index=FAISS_ENCODINGS.index(current_config.get("requested_encoding", "flat")),
+                help="flat: float32; sqfp16: 2x smaller; sq8: 4x smaller; pq: 16x smaller (lower recall)",
+                key="faiss_encoding"
+            )
+            if st.button("🧭 Rebuild FAISS Index"):
+                with st.spinner("Training and rebuilding FAISS index..."):
+                    if rebuild_faiss(mode=requested_mode, encoding=requested_encoding):
+                        rebuilt = faiss_store.config
+                        st.success(
+                            f"✅ Rebuilt {rebuilt['index_mode']}/{rebuilt['encoding']} index with {live_vector_count()} vectors "
+                            f"({rebuilt['stats']['bytes'] / 1e6:.2f} MB, "
+                            f"recall@{RECALL_K}: {rebuilt['stats'].get(f'recall_at_{RECALL_K}', '-')})"
+                        )
+            
+            if st.button("🔍 Audit Indexes & Queries"):
+                with st.spinner("Checking indexes and explaining queries..."):
+                    index_report = ensure_indexes(db)
+                    audit_rows = audit_queries()
+                if index_report["created"]:
+                    st.info(f"Created missing indexes: {', '.join(index_report['created'])}")
+                for error in index_report["errors"]:
+                    st.error(f"❌ Could not create index {error}")
+                if index_report["extra"]:
+                    st.caption(f"Undeclared indexes (kept): {', '.join(index_report['extra'])}")
+                slow = [row for row in audit_rows if row["Issues"]]
+                if slow:
+                    st.warning(f"⚠️ {len(slow)} of {len(audit_rows)} query shapes need attention")
                 else:
-                    st.info("No records in database")
-                    
-            except Exception as e:
-                st.error(f"Error viewing records: {e}")
-        
-        with view_tabs[2]:
-            st.subheader("Database Analytics")
+                    st.success(f"✅ All {len(audit_rows)} query shapes use indexes")
+                st.dataframe(audit_rows, use_container_width=True)
             
-            try:
-                # Class distribution
-                class_dist = {}
-                for doc in cattle_collection.find({}, {"cattle_class": 1}):
-                    cattle_class = doc.get("cattle_class", "Unknown")
-                    class_dist[cattle_class] = class_dist.get(cattle_class, 0) + 1
-                
-                if class_dist:
-                    st.write("**Cattle Class Distribution:**")
-                    for class_name, count in sorted(class_dist.items(), key=lambda x: x[1], reverse=True):
-                        st.write(f"- {class_name}: {count} cattle")
-                
-                st.divider()
-                
-                # Image statistics
-                image_counts = []
-                for doc in cattle_collection.find({}, {"images": 1}):
-                    image_counts.append(len(doc.get("images", [])))
-                
-                if image_counts:
-                    st.write("**Image Statistics:**")
-                    st.write(f"- Min images per cattle: {min(image_counts)}")
-                    st.write(f"- Max images per cattle: {max(image_counts)}")
-                    st.write(f"- Average images: {sum(image_counts)/len(image_counts):.2f}")
-                
-                st.divider()
-                
-                # Embedding coverage
-                total_recs = cattle_collection.count_documents({})
-                with_emb = cattle_collection.count_documents({"embedding": {"$ne": None}})
-                without_emb = total_recs - with_emb
-                
-                st.write("**Embedding Coverage:**")
-                if total_recs > 0:
-                    st.write(f"- With embeddings: {with_emb} ({with_emb/total_recs*100:.1f}%)")
-                    st.write(f"- Without embeddings: {without_emb} ({without_emb/total_recs*100:.1f}%)")
+            if st.button("📊 Reconcile Statistics"):
+                drift = reconcile_herd_stats()
+                if drift:
+                    st.warning(f"⚠️ Corrected drift in: {', '.join(drift)}")
+                    st.json({field: {"stored": stored, "actual": actual} for field, (stored, actual) in drift.items()})
                 else:
-                    st.write("- No records in database")
-                
-            except Exception as e:
-                st.error(f"Error generating analytics: {e}")
-        
-        with view_tabs[3]:
-            st.subheader("Database Tools")
+                    st.success("✅ Statistics were already accurate")
+            st.caption(f"Statistics last reconciled: {get_herd_stats()['reconciled_at'] or 'never'}")
             
-            col1, col2 = st.columns(2)
+            if st.button("🖼️ Generate Missing Thumbnails"):
+                thumb_progress = st.progress(0.0)
+                created = backfill_thumbnails(progress=thumb_progress.progress)
+                st.success(f"✅ Generated {created} thumbnail(s)")
             
-            with col1:
-                st.write("**Export Data**")
-                if st.button("📥 Export All Records as JSON"):
-                    try:
-                        all_docs = list(cattle_collection.find())
-                        # Convert ObjectId to string for JSON serialization
-                        for doc in all_docs:
-                            if "_id" in doc:
-                                doc["_id"] = str(doc["_id"])
-                        
-                        json_data = json.dumps(all_docs, indent=2)
-                        st.download_button(
-                            label="💾 Download JSON",
-                            data=json_data,
-                            file_name=f"cattle_database_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json",
-                            mime="application/json"
-                        )
-                        st.success(f"✅ Prepared {len(all_docs)} records for download")
-                    except Exception as e:
-                        st.error(f"Error exporting data: {e}")
-                
-                if st.button("📥 Export Summary CSV"):
-                    try:
-                        import pandas as pd
-                        
-                        summary_data = []
-                        for doc in cattle_collection.find():
-                            summary_data.append({
-                                "ID": doc["12_digit_id"],
-                                "Name": doc["cattle_name"],
-                                "Class": doc.get("cattle_class", "Unknown"),
-                                "Images": len(doc.get("images", [])),
-                                "Has_Embedding": bool(doc.get("embedding")),
-                                "Created": doc.get("created_at", "")
-                            })
-                        
-                        df = pd.DataFrame(summary_data)
-                        csv = df.to_csv(index=False)
-                        
-                        st.download_button(
-                            label="💾 Download CSV",
-                            data=csv,
-                            file_name=f"cattle_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.csv",
-                            mime="text/csv"
-                        )
-                        st.success(f"✅ Prepared summary of {len(summary_data)} records")
-                    except Exception as e:
-                        st.error(f"Error creating CSV: {e}")
+            st.caption(
+                f"Display image cache: {len(display_cache)} image(s), "
+                f"{display_cache.bytes / 1024 / 1024:.1f}/{display_cache.max_bytes / 1024 / 1024:.0f} MB "
+                f"({display_cache.hits} hits, {display_cache.misses} misses)"
+            )
+            scheduler_stats = identify_scheduler.stats
+            st.caption(
+                f"Identify scheduler: {scheduler_stats['requests']} request(s) in {scheduler_stats['batches']} batch(es), "
+                f"{scheduler_stats['degraded']} degraded, {scheduler_stats['rejected']} rejected"
+            )
             
-            with col2:
-                st.write("**Database Maintenance**")
-                
-                if st.button("🔄 Rebuild All Embeddings"):
-                    if st.checkbox("I understand this will regenerate all embeddings", key="confirm_rebuild"):
-                        with st.spinner("Rebuilding all embeddings..."):
-                            updated_count = 0
-                            for doc in cattle_collection.find():
-                                if "images" in doc and doc["images"]:
-                                    images = []
-                                    for img_data in doc["images"]:
-                                        if img_data.get("b64"):
-                                            try:
-                                                img_bytes = base64.b64decode(img_data["b64"])
-                                                if len(img_bytes) > 0:
-                                                    img = Image.open(io.BytesIO(img_bytes))
-                                                    images.append(img)
-                                            except Exception as e:
-                                                st.warning(f"Skipping corrupted image in record {doc['12_digit_id']}")
-                                                continue
-                                    
-                                    if images:
-                                        # Calculate embeddings for all images
-                                        embeddings = []
-                                        for img in images:
-                                            emb = embed_image(img)
-                                            if emb is not None:
-                                                embeddings.append(emb)
-                                        
-                                        if embeddings:
-                                            # Calculate average embedding
-                                            avg_embedding = np.mean(np.vstack(embeddings), axis=0, keepdims=True)
-                                            avg_embedding = avg_embedding / np.linalg.norm(avg_embedding, axis=1, keepdims=True)
-                                            
-                                            cattle_collection.update_one(
-                                                {"_id": doc["_id"]},
-                                                {"$set": {"embedding": avg_embedding.flatten().tolist()}}
-                                            )
-                                            updated_count += 1
-                            
-                            rebuild_faiss()
-                            st.success(f"✅ Updated {updated_count} records with new embeddings")
+            st.markdown("**Re-embed Images**")
+            st.caption(
+                f"Embedding cache: {len(embedding_lru)}/{embedding_lru.max_items} in memory "
+                f"({embedding_lru.hits} hits, {embedding_lru.misses} misses), "
+                f"{embedding_cache_collection.estimated_document_count()} stored"
+            )
+            reembed_state = reembed_job.get_state()
+            reembed_running = reembed_runner.running()
+            if reembed_state:
+                status = reembed_state.get("status")
+                if status == "running" and not reembed_active(reembed_state):
+                    # No heartbeat from the process that ran the job; its checkpoint can be resumed
+                    status = "interrupted"
+                total = reembed_state.get("total") or 0
+                processed = reembed_state.get("processed", 0)
+                st.progress(min(processed / total, 1.0) if total else 0.0)
+                st.caption(
+                    f"Last run ({reembed_state.get('mode')}): {status} - {processed}/{total} records, "
+                    f"{reembed_state.get('updated', 0)} re-embedded ({reembed_state.get('cached_images', 0)} images from cache), "
+                    f"{reembed_state.get('failed_images', 0)} unreadable images"
+                    + (f" - error: {reembed_state['error']}" if reembed_state.get("error") else "")
+                )
+            
+            reembed_mode = st.selectbox(
+                "Re-embed mode", REEMBED_MODES, key="reembed_mode",
+                help="'incremental' only re-embeds records whose images changed since they were embedded"
+            )
+            reembed_cols = st.columns(4)
+            with reembed_cols[0]:
+                # A run may also be going in another instance of the app
+                if st.button("🔄 Rebuild Embeddings", disabled=reembed_running or reembed_active(reembed_state)):
+                    reembed_runner.start(reembed_mode)
+                    st.rerun()
+            with reembed_cols[1]:
+                can_resume = reembed_resumable(reembed_state)
+                if st.button("⏯️ Resume", disabled=reembed_running or not can_resume):
+                    reembed_runner.start(resume=True)
+                    st.rerun()
+            with reembed_cols[2]:
+                if st.button("⏹️ Stop", disabled=not reembed_running):
+                    reembed_runner.stop()
+                    st.info("Stopping after the current chunk")
+            with reembed_cols[3]:
+                if st.button("🔃 Refresh Status"):
+                    st.rerun()
+            
+            if st.button("🧹 Remove Records Without Images"):
+                if st.checkbox("I understand this will delete records", key="confirm_delete_no_images"):
+                    no_images = {"$or": [{"images": []}, {"images": {"$exists": False}}]}
+                    removed_ids = [d["12_digit_id"] for d in cattle_collection.find(no_images, {"12_digit_id": 1}) if "12_digit_id" in d]
+                    deleted_count = delete_cattle_from_db(removed_ids)
+                    st.success(f"✅ Deleted {deleted_count} records without images")
+                    faiss_remove(removed_ids)
+                    st.rerun()
+            
+            if st.button("🔍 Check Database Integrity"):
+                issues = []
+                referenced = set()
+                for doc in cattle_collection.find({}, METADATA_ONLY):
+                    referenced.update(img["hash"] for img in doc.get("images", []) if img.get("hash"))
+                    # Check for missing fields
+                    if "12_digit_id" not in doc:
+                        issues.append(f"Document {doc.get('_id')} missing 12_digit_id")
+                    if "cattle_name" not in doc:
+                        issues.append(f"Document {doc.get('12_digit_id', 'unknown')} missing cattle_name")
+                    
+                    # Check ID format
+                    if "12_digit_id" in doc and (len(doc["12_digit_id"]) != 12 or not doc["12_digit_id"].isdigit()):
+                        issues.append(f"Invalid ID format: {doc['12_digit_id']}")
                 
-                if st.button("🧹 Remove Records Without Images"):
-                    if st.checkbox("I understand this will delete records", key="confirm_delete_no_images"):
-                        result = cattle_collection.delete_many({"$or": [{"images": []}, {"images": {"$exists": False}}]})
-                        st.success(f"✅ Deleted {result.deleted_count} records without images")
-                        rebuild_faiss()
-                        st.rerun()
+                # Check image references
+                stored = {d["_id"] for d in image_blob_collection.find({"_id": {"$in": list(referenced)}}, {"_id": 1})}
+                for image_hash in referenced - stored:
+                    issues.append(f"Missing stored image {image_hash[:12]}…")
                 
-                if st.button("🔍 Check Database Integrity"):
-                    issues = []
-                    for doc in cattle_collection.find():
-                        # Check for missing fields
-                        if "12_digit_id" not in doc:
-                            issues.append(f"Document {doc.get('_id')} missing 12_digit_id")
-                        if "cattle_name" not in doc:
-                            issues.append(f"Document {doc.get('12_digit_id', 'unknown')} missing cattle_name")
-                        
-                        # Check ID format
-                        if "12_digit_id" in doc and (len(doc["12_digit_id"]) != 12 or not doc["12_digit_id"].isdigit()):
-                            issues.append(f"Invalid ID format: {doc['12_digit_id']}")
-                    
-                    if issues:
-                        st.warning(f"⚠️ Found {len(issues)} issues:")
-                        for issue in issues[:10]:  # Show first 10 issues
-                            st.write(f"- {issue}")
-                        if len(issues) > 10:
-                            st.write(f"... and {len(issues) - 10} more")
-                    else:
-                        st.success("✅ Database integrity check passed!")
+                if issues:
+                    st.warning(f"⚠️ Found {len(issues)} issues:")
+                    for issue in issues[:10]:  # Show first 10 issues
+                        st.write(f"- {issue}")
+                    if len(issues) > 10:
+                        st.write(f"... and {len(issues) - 10} more")
+                else:
+                    st.success("✅ Database integrity check passed!")
 
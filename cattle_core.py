@@ -0,0 +1,584 @@
+"""Helpers and MongoDB document layouts shared by the Streamlit app (app.py) and the
+HTTP service (service.py).
+
+Everything here is free of Streamlit: both front ends build the documents they store
+and the FAISS index updates they publish with these functions, so the two writers
+cannot drift apart. The re-embed job runs on a synchronous (pymongo) database handle
+passed in by the caller.
+"""
+import base64
+import hashlib
+import io
+import os
+import re
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+from PIL import Image, ImageOps
+try:
+    import faiss
+except ImportError:
+    faiss = None
+try:
+    from pymongo import ReplaceOne
+    from pymongo.errors import DuplicateKeyError
+except ImportError:
+    ReplaceOne = None
+    DuplicateKeyError = None
+
+# -----------------------------------------------------------------------------
+# Configuration
+# -----------------------------------------------------------------------------
+CLIP_MODEL_NAME = "ViT-B/16"
+# Storage dtype of packed embedding vectors: "float16" or "float32"
+EMBEDDING_DTYPE = os.environ.get("EMBEDDING_DTYPE", "float16")
+ROI_MODEL_PATH = "./models/roi_best_600.pt"   # ROI detection model new
+CLS_MODEL_PATH = "./models/best_25_train8.pt"  # Classification model
+# Longest side of the decoded working image shared by ROI detection, classification and CLIP
+PROCESSING_MAX_SIDE = 1280
+# Stored display thumbnails (base64 JPEG next to each original)
+THUMBNAIL_SIDE = 240
+THUMBNAIL_QUALITY = 80
+# Compression of the persisted index blob: "zlib" or "none"
+FAISS_COMPRESSION = os.environ.get("FAISS_COMPRESSION", "zlib").lower()
+# Single-animal edits are appended to a delta log on the pointer document; the
+# full index is re-published (compacted) only once this many have accumulated
+FAISS_MAX_DELTAS = int(os.environ.get("FAISS_MAX_DELTAS", 256))
+# Backends without removal (HNSW, IVF) hide replaced rows instead; rebuild past this share of hidden rows
+FAISS_MAX_TOMBSTONE_RATIO = 0.1
+HERD_STATS_ID = "herd"
+
+# -----------------------------------------------------------------------------
+# Images
+# -----------------------------------------------------------------------------
+def content_hash(raw: bytes):
+    """SHA-256 hex digest of raw image bytes"""
+    return hashlib.sha256(raw).hexdigest()
+
+def decode_image(raw: bytes, max_side=None):
+    """Decode image bytes once, applying EXIF orientation, into an RGB image.
+
+    With ``max_side`` large JPEGs are decoded at reduced scale (draft mode) and
+    downscaled so the longest side is at most ``max_side``. Returns the image and
+    the factor mapping its pixel coordinates back to the original image.
+    """
+    img = Image.open(io.BytesIO(raw))
+    orig_side = max(img.size)
+    if max_side and orig_side > max_side:
+        img.draft("RGB", (max_side, max_side))
+    img = ImageOps.exif_transpose(img).convert("RGB")
+    if max_side and max(img.size) > max_side:
+        img.thumbnail((max_side, max_side), Image.BILINEAR)
+    return img, orig_side / max(img.size)
+
+def make_thumbnail(raw: bytes):
+    """Base64 JPEG thumbnail of image bytes, longest side THUMBNAIL_SIDE"""
+    img, _ = decode_image(raw, THUMBNAIL_SIDE * 2)
+    img.thumbnail((THUMBNAIL_SIDE, THUMBNAIL_SIDE), Image.LANCZOS)
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=THUMBNAIL_QUALITY, optimize=True)
+    return base64.b64encode(buf.getvalue()).decode("utf-8")
+
+def model_file_version(path: str):
+    """Short content hash of a weights file; cached YOLO results are only reused for the same weights"""
+    try:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        return digest.hexdigest()[:16]
+    except OSError:
+        return os.path.basename(path)
+
+# -----------------------------------------------------------------------------
+# Document layouts
+# -----------------------------------------------------------------------------
+# image_blobs: {_id: sha256 of the bytes, data: raw bytes, size, refcount, created_at}
+def image_blob_update(raw: bytes):
+    """Upsert update storing image bytes, or taking another reference to identical stored bytes"""
+    return {
+        "$setOnInsert": {"data": raw, "size": len(raw), "created_at": datetime.utcnow().isoformat()},
+        "$inc": {"refcount": 1}
+    }
+
+def image_entry(filename: str, image_hash: str, size: int, thumb: str):
+    """Image entry of a cattle document: blob reference, size and thumbnail"""
+    return {"filename": filename, "hash": image_hash, "size": size, "thumb": thumb}
+
+# Normalized copies of searchable fields: {source field: search field}
+SEARCH_FIELDS = {"cattle_name": "name_lc", "cattle_class": "class_lc"}
+
+def normalize_search(text):
+    """Lowercase with collapsed whitespace, as stored in the search fields"""
+    return " ".join(str(text or "").split()).lower()
+
+def search_fields(values: dict):
+    """Search field values for the searchable fields present in ``values``"""
+    return {SEARCH_FIELDS[field]: normalize_search(value) for field, value in values.items() if field in SEARCH_FIELDS}
+
+def prefix_regex(prefix: str):
+    """Anchored, case-sensitive regex; MongoDB answers it with an index range scan"""
+    return {"$regex": f"^{re.escape(prefix)}"}
+
+def cattle_filter(filter_id=None, filter_name=None):
+    """MongoDB query for the optional ID prefix / name prefix filters (both must match)"""
+    q = {}
+    if filter_id:
+        q["12_digit_id"] = prefix_regex(filter_id)
+    if filter_name:
+        q["name_lc"] = prefix_regex(normalize_search(filter_name))
+    return q
+
+def search_cattle_filter(term: str):
+    """MongoDB query matching records whose ID, name or class starts with ``term``"""
+    term = normalize_search(term)
+    if not term:
+        return {}
+    clauses = [{"name_lc": prefix_regex(term)}, {"class_lc": prefix_regex(term)}]
+    if term.isdigit():
+        clauses.append({"12_digit_id": prefix_regex(term)})
+    return {"$or": clauses}
+
+def cattle_doc(cattle_id: str, cattle_name: str, cattle_class: str, images, created_at: str):
+    """cattle_images document of a newly registered animal"""
+    return {
+        "12_digit_id": cattle_id,
+        "cattle_name": cattle_name,
+        "cattle_class": cattle_class,
+        **search_fields({"cattle_name": cattle_name, "cattle_class": cattle_class}),
+        "images": images,
+        "created_at": created_at,
+        "images_updated_at": created_at
+    }
+
+# yolo_results: one document per image content hash, tagged with the weights versions
+def yolo_result_doc(image_id: str, roi_model: str, roi_confidence: float, roi_bbox):
+    """yolo_results document of an ROI detection"""
+    return {
+        "image_id": image_id,
+        "roi_model": roi_model,
+        "roi_confidence": roi_confidence,
+        "roi_bbox": roi_bbox,
+        "timestamp": datetime.utcnow().isoformat()
+    }
+
+def classification_fields(cls_model: str, class_name: str, confidence: float):
+    """Classification fields added to a yolo_results document"""
+    return {"cls_model": cls_model, "class_name": class_name, "classification_confidence": confidence}
+
+# embedding_cache: {_id: "<model>:<hash>", hash, model, dtype, vector, created_at}
+def embedding_cache_key(image_hash: str):
+    """Embedding cache key: the same image embeds differently under another CLIP model"""
+    return f"{CLIP_MODEL_NAME}:{image_hash}"
+
+def embedding_cache_doc(image_hash: str, vec):
+    """embedding_cache document of one image embedding"""
+    return {"hash": image_hash, "model": CLIP_MODEL_NAME, "dtype": EMBEDDING_DTYPE,
+            "vector": pack_vector(vec), "created_at": datetime.utcnow().isoformat()}
+
+# cattle_embeddings: one slim document per animal, keyed by 12-digit ID:
+#   vector: normalized per-animal embedding, sum/count: running sum of the
+#   per-image embeddings (float32), images: [{filename, vector}], plus the
+#   storage dtype and the CLIP model that produced the vectors.
+def pack_vector(vec, dtype=None):
+    """Pack a vector as raw bytes (stored as BinData)"""
+    return np.asarray(vec, dtype=dtype or EMBEDDING_DTYPE).reshape(-1).tobytes()
+
+def unpack_vector(data, dtype):
+    """Unpack stored bytes into a float32 vector"""
+    return np.frombuffer(data, dtype=dtype).astype(np.float32)
+
+def embedding_fields(embedding_sum, embedding_count: int):
+    """Per-animal embedding fields from the running sum of its per-image embeddings"""
+    if embedding_sum is None or embedding_count <= 0:
+        return {"vector": None, "sum": None, "count": 0}
+    embedding_sum = np.asarray(embedding_sum, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(embedding_sum)
+    return {
+        # Normalized sum == normalized mean of the (unit) image embeddings
+        "vector": pack_vector(embedding_sum / norm) if norm > 0 else None,
+        "sum": pack_vector(embedding_sum, np.float32),
+        "count": int(embedding_count)
+    }
+
+def embedding_doc(image_vectors, dim: int):
+    """Build the embeddings document of one animal from its (filename, vector) pairs"""
+    vectors = [np.asarray(vec, dtype=np.float32).reshape(-1) for _, vec in image_vectors]
+    doc = {
+        "dtype": EMBEDDING_DTYPE,
+        "dim": dim,
+        "model": CLIP_MODEL_NAME,
+        "images": [{"filename": filename, "vector": pack_vector(vec)} for (filename, _), vec in zip(image_vectors, vectors)],
+        "updated_at": datetime.utcnow().isoformat()
+    }
+    doc.update(embedding_fields(np.sum(vectors, axis=0) if vectors else None, len(vectors)))
+    return doc
+
+def averaged_embedding_doc(vector, dim: int):
+    """Embeddings document holding only an averaged vector (image vectors are backfilled on first edit)"""
+    return {"vector": pack_vector(vector), "sum": None, "count": 0, "images": [],
+            "dtype": EMBEDDING_DTYPE, "dim": dim, "model": CLIP_MODEL_NAME,
+            "updated_at": datetime.utcnow().isoformat()}
+
+def vector_change(before, vector):
+    """Change (-1, 0 or 1) in the number of animals with a vector when ``before`` (stored document or None) gets ``vector``"""
+    return int(vector is not None) - int(before is not None and before.get("vector") is not None)
+
+# herd_stats: a single document, updated with $inc by every register/update/delete:
+#   {_id: "herd", records, images, with_embeddings,
+#    classes: {class: records}, image_counts: {"<images per record>": records}}
+def stats_key(name):
+    """Encode a class name as a MongoDB field name ('.' and '$' are not allowed)"""
+    return (str(name) or "Unknown").replace(".", "\uff0e").replace("$", "\uff04")
+
+def stats_name(key: str):
+    """Decode a field name written by stats_key"""
+    return key.replace("\uff0e", ".").replace("\uff04", "$")
+
+def herd_stats_update(records=0, images=0, with_embeddings=0, classes=None, image_counts=None):
+    """$inc update applying deltas to the herd statistics (None if nothing changes); ``classes``/``image_counts`` map keys to deltas"""
+    inc = {"records": records, "images": images, "with_embeddings": with_embeddings}
+    for name, delta in (classes or {}).items():
+        inc[f"classes.{stats_key(name)}"] = inc.get(f"classes.{stats_key(name)}", 0) + delta
+    for count, delta in (image_counts or {}).items():
+        inc[f"image_counts.{count}"] = inc.get(f"image_counts.{count}", 0) + delta
+    inc = {field: delta for field, delta in inc.items() if delta}
+    if not inc:
+        return None
+    return {"$inc": inc, "$set": {"updated_at": datetime.utcnow().isoformat()}}
+
+# -----------------------------------------------------------------------------
+# FAISS index (faiss_index pointer document + faiss_blobs GridFS files)
+# -----------------------------------------------------------------------------
+# {_id: "faiss_index", file_id, checksum, compression, size, index_config, version,
+#  deltas: [{label, vector}], delta_count, updated_at}
+# Rows are keyed by the numeric 12-digit cattle ID; a delta with vector None drops the row.
+def default_faiss_config(requested_mode="auto", requested_encoding="flat"):
+    """Index config used until one is built or loaded"""
+    return {"requested_mode": requested_mode, "index_mode": "flat",
+            "requested_encoding": requested_encoding, "encoding": "flat", "search_params": {}}
+
+def faiss_id(cattle_id: str):
+    """FAISS ID for a cattle ID (the 12-digit code as an integer), None if not a valid code"""
+    if isinstance(cattle_id, str) and len(cattle_id) == 12 and cattle_id.isdigit():
+        return int(cattle_id)
+    return None
+
+def cattle_id_from_faiss(label):
+    """Cattle ID for a FAISS ID"""
+    return f"{int(label):012d}"
+
+def encode_faiss_index(index):
+    """Serialize an index for storage; returns (payload, checksum, compression, serialized size)"""
+    index_bytes = faiss.serialize_index(index).tobytes()
+    compression = "zlib" if FAISS_COMPRESSION == "zlib" else "none"
+    payload = zlib.compress(index_bytes) if compression == "zlib" else index_bytes
+    return payload, hashlib.sha256(index_bytes).hexdigest(), compression, len(index_bytes)
+
+def decode_faiss_index(doc, payload):
+    """Decompress, verify and deserialize the index of a pointer document (None for legacy positional indexes)"""
+    index_bytes = zlib.decompress(payload) if doc.get("compression") == "zlib" else payload
+    if doc.get("checksum") and hashlib.sha256(index_bytes).hexdigest() != doc["checksum"]:
+        raise ValueError(f"checksum mismatch for FAISS index version {doc.get('version')}")
+    index = faiss.deserialize_index(np.frombuffer(index_bytes, dtype=np.uint8))
+    if not isinstance(index, faiss.IndexIDMap2):
+        return None
+    apply_search_params(index, (doc.get("index_config") or {}).get("search_params"))
+    return index
+
+def faiss_pointer_update(file_id, checksum: str, compression: str, size: int, config: dict, version: str):
+    """Update publishing a stored index file as the new version (the delta log starts over)"""
+    return {
+        "$set": {
+            "file_id": file_id,
+            "checksum": checksum,
+            "compression": compression,
+            "size": size,
+            "index_config": config,
+            "version": version,
+            "deltas": [],
+            "delta_count": 0,
+            "updated_at": datetime.now()
+        },
+        # Inline blob and positional IDs from older versions
+        "$unset": {"index_data": "", "ordered_ids": ""}
+    }
+
+def faiss_pointer_query(expected=None):
+    """Pointer document filter; with ``expected`` = (version, applied deltas) only that exact state matches"""
+    query = {"_id": "faiss_index"}
+    if expected is not None:
+        # Pointers written before the delta log have no delta_count
+        query.update(version=expected[0], delta_count=expected[1] or {"$in": [0, None]})
+    return query
+
+def faiss_deltas_projection(start: int, count: int):
+    """Projection of delta log entries ``start``..``start + count`` (without inline legacy blobs)"""
+    return {"deltas": {"$slice": [start, max(1, count)]}, "index_data": 0}
+
+def faiss_delta(label: int, vector=None):
+    """Delta log entry setting (or with ``vector`` None, dropping) one label's row"""
+    if vector is not None:
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        vector = pack_vector(vector / np.linalg.norm(vector), np.float32)
+    return {"label": int(label), "vector": vector}
+
+def apply_search_params(index, search_params):
+    """Apply persisted search parameters (nprobe/efSearch) to a loaded index"""
+    params = faiss.ParameterSpace()
+    for name, value in (search_params or {}).items():
+        params.set_index_parameter(index, name, value)
+
+def supports_remove(index):
+    """Whether rows can be removed from an ID-mapped index in place.
+
+    Only flat-code backends keep their row order on removal; HNSW cannot remove and
+    IVF reorders its lists, which breaks the ID map.
+    """
+    return isinstance(faiss.downcast_index(index.index), faiss.IndexFlatCodes)
+
+def apply_faiss_delta(index, config, delta):
+    """Apply one delta log entry to an ID-mapped index.
+
+    Labels not in the index are added without a removal. On backends without removal
+    (supports_remove) the old row's ID is overwritten with -1, which search skips, and
+    the tombstone is counted in ``config``.
+    """
+    labels = np.array([delta["label"]], dtype=np.int64)
+    id_map = faiss.vector_to_array(index.id_map)
+    present = id_map == delta["label"]
+    if present.any():
+        if supports_remove(index):
+            index.remove_ids(labels)
+        else:
+            id_map[present] = -1
+            faiss.copy_array_to_vector(id_map, index.id_map)
+            index.construct_rev_map()
+            config["tombstones"] = config.get("tombstones", 0) + int(present.sum())
+    if delta.get("vector") is not None:
+        index.add_with_ids(unpack_vector(delta["vector"], np.float32).reshape(1, -1), labels)
+
+def live_vectors(index, config):
+    """Number of searchable rows of an index (tombstones excluded)"""
+    return index.ntotal - config.get("tombstones", 0)
+
+def search_index(index, config, queries, k: int):
+    """Search an ID-mapped index with a matrix of queries, returning (cattle_id, score) pairs per query"""
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    if index.ntotal == 0:
+        return [[] for _ in range(len(queries))]
+    # Tombstoned rows come back as label -1; fetch a few extra so k live hits remain
+    extra = min(config.get("tombstones", 0), k)
+    D, I = index.search(queries, min(k + extra, index.ntotal))
+    return [
+        [(cattle_id_from_faiss(label), float(score)) for score, label in zip(scores, labels) if label >= 0][:k]
+        for scores, labels in zip(D, I)
+    ]
+
+# -----------------------------------------------------------------------------
+# Re-embed job (checkpoint document in the jobs collection)
+# -----------------------------------------------------------------------------
+# {_id: "reembed", status, mode, model, last_id, processed, total, updated,
+#  cached_images, failed_images, started_at, heartbeat, finished_at, error}
+REEMBED_JOB_ID = "reembed"
+REEMBED_CHUNK_SIZE = 64
+# "full" re-embeds every record, "incremental" only records whose images changed since they were embedded
+REEMBED_MODES = ["full", "incremental"]
+# Runs checkpoint after every chunk; a running job without a heartbeat for this long lost its process
+REEMBED_STALE_SECONDS = int(os.environ.get("REEMBED_STALE_SECONDS", 600))
+
+def reembed_active(state):
+    """Whether a job checkpoint belongs to a run that is still going (in any process)"""
+    if not state or state.get("status") != "running" or not state.get("heartbeat"):
+        return False
+    age = datetime.utcnow() - datetime.fromisoformat(state["heartbeat"])
+    return age < timedelta(seconds=REEMBED_STALE_SECONDS)
+
+def reembed_resumable(state):
+    """Whether a job checkpoint can be resumed: stopped, failed, or running without a recent heartbeat"""
+    return bool(state) and state.get("status") in ("running", "stopped", "failed") and not reembed_active(state)
+
+class ReembedJob:
+    """Re-embed stored images chunk by chunk, ordered by ID.
+
+    Images of a chunk are decoded by a thread pool, embedded in batched calls and
+    written with one bulk write. Progress is checkpointed after every chunk, so a
+    resumed run continues after the last completed ID. Subclasses provide the model
+    (``decode``/``encode``) and may put caches in front of the lookups.
+    """
+
+    def __init__(self, db, embedding_dim: int, workers=4, chunk_size=REEMBED_CHUNK_SIZE):
+        self.cattle = db["cattle_images"]
+        self.embeddings = db["cattle_embeddings"]
+        self.embedding_cache = db["embedding_cache"]
+        self.image_blobs = db["image_blobs"]
+        self.jobs = db["jobs"]
+        self.embedding_dim = embedding_dim
+        self.workers = workers
+        self.chunk_size = chunk_size
+
+    def decode(self, raw: bytes):
+        """Model input for raw image bytes (None if unreadable)"""
+        raise NotImplementedError
+
+    def encode(self, inputs):
+        """Normalized embeddings of decoded model inputs, one row each"""
+        raise NotImplementedError
+
+    def cached_embeddings(self, image_hashes):
+        """{hash: vector} of the stored embedding cache hits"""
+        cursor = self.embedding_cache.find(
+            {"_id": {"$in": [embedding_cache_key(h) for h in set(image_hashes)]}}, {"hash": 1, "vector": 1, "dtype": 1}
+        )
+        return {doc["hash"]: unpack_vector(doc["vector"], doc.get("dtype", EMBEDDING_DTYPE)) for doc in cursor}
+
+    def put_cached_embeddings(self, hash_vectors):
+        """Store {hash: vector} in the embedding cache"""
+        if hash_vectors:
+            self.embedding_cache.bulk_write([
+                ReplaceOne({"_id": embedding_cache_key(h)}, embedding_cache_doc(h, vec), upsert=True)
+                for h, vec in hash_vectors.items()
+            ], ordered=False)
+
+    def get_blobs(self, image_hashes):
+        """Raw bytes of stored images keyed by content hash"""
+        if not image_hashes:
+            return {}
+        cursor = self.image_blobs.find({"_id": {"$in": list(set(image_hashes))}}, {"data": 1})
+        return {doc["_id"]: bytes(doc["data"]) for doc in cursor}
+
+    def finish(self):
+        """Called after a run that wrote embeddings (index rebuild, statistics)"""
+
+    def get_state(self):
+        """Checkpoint document of the last run (None if it never ran)"""
+        return self.jobs.find_one({"_id": REEMBED_JOB_ID})
+
+    def stale_ids(self):
+        """Sorted IDs whose images changed after their embeddings were written, or that have none for the current model"""
+        embedded_at = {doc["_id"]: doc.get("updated_at", "")
+                       for doc in self.embeddings.find({"model": CLIP_MODEL_NAME}, {"updated_at": 1})}
+        stale = []
+        for doc in self.cattle.find({}, {"12_digit_id": 1, "images_updated_at": 1, "created_at": 1}):
+            cattle_id = doc.get("12_digit_id")
+            if not cattle_id:
+                continue
+            # Records saved before image changes were stamped fall back to their creation time
+            changed_at = doc.get("images_updated_at") or doc.get("created_at") or ""
+            if cattle_id not in embedded_at or changed_at > embedded_at[cattle_id]:
+                stale.append(cattle_id)
+        return sorted(stale)
+
+    def run(self, mode="full", resume=False, stop_event=None):
+        """Run (or with ``resume`` continue) a re-embed; returns the final checkpoint.
+
+        Returns None without running while another run (in any process) holds the job.
+        """
+        now = datetime.utcnow().isoformat()
+        previous = self.get_state()
+        if reembed_active(previous):
+            return None
+        if resume and reembed_resumable(previous):
+            state = dict(previous)
+        else:
+            state = {"_id": REEMBED_JOB_ID, "mode": mode, "last_id": "", "processed": 0, "updated": 0,
+                     "cached_images": 0, "failed_images": 0, "started_at": now}
+        state.update(status="running", model=CLIP_MODEL_NAME, error=None, heartbeat=now)
+
+        query = {"12_digit_id": {"$gt": state["last_id"]}}
+        if state["mode"] == "incremental":
+            query["12_digit_id"]["$in"] = self.stale_ids()
+        state["total"] = state["processed"] + self.cattle.count_documents(query)
+        # Claim the job: only one of several processes starting at once gets to replace what it read
+        claim = {"_id": REEMBED_JOB_ID}
+        if previous is not None:
+            claim["heartbeat"] = previous.get("heartbeat")
+        try:
+            result = self.jobs.replace_one(claim, state, upsert=previous is None)
+        except DuplicateKeyError:
+            return None
+        if previous is not None and result.matched_count == 0:
+            return None
+
+        def checkpoint(**fields):
+            state.update(fields, heartbeat=datetime.utcnow().isoformat())
+            self.jobs.update_one({"_id": REEMBED_JOB_ID}, {"$set": {k: v for k, v in state.items() if k != "_id"}})
+
+        try:
+            cursor = self.cattle.find(
+                query, {"12_digit_id": 1, "images.filename": 1, "images.hash": 1, "images.b64": 1}
+            ).sort("12_digit_id", 1).batch_size(self.chunk_size)
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                chunk = []
+                for doc in cursor:
+                    chunk.append(doc)
+                    if len(chunk) < self.chunk_size:
+                        continue
+                    if stop_event is not None and stop_event.is_set():
+                        checkpoint(status="stopped")
+                        return state
+                    self.run_chunk(chunk, pool, state)
+                    checkpoint()
+                    chunk = []
+                if chunk:
+                    self.run_chunk(chunk, pool, state)
+                    checkpoint()
+
+            if state["updated"]:
+                self.finish()
+            checkpoint(status="done", finished_at=datetime.utcnow().isoformat())
+        except Exception as e:
+            checkpoint(status="failed", error=str(e))
+        return state
+
+    def run_chunk(self, docs, pool, state):
+        """Decode, embed and bulk-write the embeddings of one chunk of cattle documents.
+
+        Images already in the embedding cache are neither fetched, decoded nor embedded.
+        """
+        entries = [(doc["12_digit_id"], img_data.get("filename"), img_data)
+                   for doc in docs for img_data in doc.get("images", []) if img_data.get("hash") or img_data.get("b64")]
+        # Referenced images are known by hash; records not yet migrated carry their bytes inline
+        raws, hashes = {}, []
+        for _, _, img_data in entries:
+            image_hash = img_data.get("hash")
+            if not image_hash:
+                try:
+                    raw = base64.b64decode(img_data["b64"])
+                except Exception:
+                    raw = None
+                image_hash = content_hash(raw) if raw else None
+                if image_hash:
+                    raws[image_hash] = raw
+            hashes.append(image_hash)
+        vectors = self.cached_embeddings([h for h in hashes if h])
+        cached_count = sum(1 for h in hashes if h in vectors)
+
+        # One representative per unseen hash: duplicates within the chunk are embedded once
+        todo = list({h: i for i, h in reversed(list(enumerate(hashes))) if h and h not in vectors}.values())
+        raws.update(self.get_blobs([hashes[i] for i in todo if hashes[i] not in raws]))
+        inputs = list(pool.map(self.decode, [raws.get(hashes[i]) for i in todo]))
+        decoded = [(i, item) for i, item in zip(todo, inputs) if item is not None]
+        if decoded:
+            feats = self.encode([item for _, item in decoded])
+            new_vectors = {hashes[i]: feat for (i, _), feat in zip(decoded, feats)}
+            self.put_cached_embeddings(new_vectors)
+            vectors.update(new_vectors)
+
+        image_vectors = {}
+        for (cattle_id, filename, _), image_hash in zip(entries, hashes):
+            if image_hash in vectors:
+                image_vectors.setdefault(cattle_id, []).append((filename, vectors[image_hash]))
+        ops = [ReplaceOne({"_id": cattle_id}, embedding_doc(pairs, self.embedding_dim), upsert=True)
+               for cattle_id, pairs in image_vectors.items()]
+        if ops:
+            self.embeddings.bulk_write(ops, ordered=False)
+
+        state["last_id"] = docs[-1]["12_digit_id"]
+        state["processed"] += len(docs)
+        state["updated"] += len(ops)
+        state["cached_images"] += cached_count
+        # Images without a vector now: unreadable inline data, missing blobs or failed decodes (every duplicate)
+        state["failed_images"] += sum(1 for h in hashes if h not in vectors)
@@ -0,0 +1,462 @@
+"""Headless HTTP API for cattle identification and registration.
+
+Runs next to the Streamlit app (app.py) on the same MongoDB database, model weights
+and published FAISS index, without Streamlit's per-rerun script execution:
+
+    uvicorn service:app --host 0.0.0.0 --port 8000
+
+Documents written here (cattle_images, image_blobs, cattle_embeddings, embedding_cache,
+yolo_results, herd_stats, faiss_index) are built with the same cattle_core helpers as
+app.py. Registrations reach the FAISS index through its delta log; rebuilds (tombstones,
+backend switches) are left to app.py, which applies them on its next run.
+
+``create_app(db=..., models=..., index=...)`` accepts any Motor-compatible database
+(a local mongod, or mongomock_motor), any object with the ``Models`` methods and an
+``IndexState`` replacement (the default one keeps index files in GridFS), so the
+endpoints can be exercised without the real weights or server.
+"""
+import asyncio
+import os
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+from typing import List, Optional
+
+import numpy as np
+from fastapi import FastAPI, File, Form, HTTPException, Query, UploadFile
+from starlette.concurrency import run_in_threadpool
+
+from cattle_core import (
+    CLIP_MODEL_NAME, EMBEDDING_DTYPE, ROI_MODEL_PATH, CLS_MODEL_PATH, PROCESSING_MAX_SIDE, FAISS_MAX_DELTAS, HERD_STATS_ID,
+    content_hash, decode_image, make_thumbnail, model_file_version,
+    image_blob_update, image_entry, search_cattle_filter, cattle_doc, yolo_result_doc, classification_fields,
+    embedding_cache_key, embedding_cache_doc, unpack_vector, embedding_doc, herd_stats_update,
+    default_faiss_config, faiss_id, encode_faiss_index, decode_faiss_index, faiss_pointer_update,
+    faiss_pointer_query, faiss_deltas_projection, faiss_delta, apply_faiss_delta, live_vectors, search_index
+)
+
+# -----------------------------------------------------------------------------
+# Configuration (model names, paths and storage settings are in cattle_core)
+# -----------------------------------------------------------------------------
+DB_NAME = "cattle_db"
+# Registration accepts only images whose ROI is detected at least this confidently
+ROI_MIN_CONFIDENCE = 0.60
+IDENTIFY_THRESHOLD = 0.75
+# Uploads are read in chunks and rejected past this size
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 20 * 1024 * 1024))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+# How often the published FAISS index version is checked for changes by the app
+INDEX_SYNC_SECONDS = float(os.environ.get("INDEX_SYNC_SECONDS", 5))
+
+# -----------------------------------------------------------------------------
+# Helpers
+# -----------------------------------------------------------------------------
+async def read_upload(upload: UploadFile):
+    """Read a multipart upload chunk by chunk, rejecting it once it exceeds MAX_UPLOAD_BYTES"""
+    chunks, size = [], 0
+    while True:
+        chunk = await upload.read(UPLOAD_CHUNK_SIZE)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(413, f"{upload.filename} is larger than {MAX_UPLOAD_BYTES} bytes")
+        chunks.append(chunk)
+    return b"".join(chunks)
+
+# -----------------------------------------------------------------------------
+# Models (loaded once per process)
+# -----------------------------------------------------------------------------
+class Models:
+    """CLIP, ROI and classification models; calls are serialized because they share one device"""
+    def __init__(self):
+        import torch
+        import clip
+        self.torch = torch
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.clip_model, self.preprocess = clip.load(CLIP_MODEL_NAME, device=self.device)
+        self.embedding_dim = self.clip_model.visual.output_dim
+        try:
+            from ultralytics import YOLO
+            self.roi_model, self.cls_model = YOLO(ROI_MODEL_PATH), YOLO(CLS_MODEL_PATH)
+        except Exception:
+            self.roi_model, self.cls_model = None, None
+        self.roi_version = model_file_version(ROI_MODEL_PATH)
+        self.cls_version = model_file_version(CLS_MODEL_PATH)
+        self.lock = threading.Lock()
+
+    def embed(self, images):
+        """Normalized CLIP embeddings of RGB images, one row per image, in one forward pass"""
+        if not images:
+            return np.empty((0, self.embedding_dim), dtype=np.float32)
+        with self.lock, self.torch.inference_mode():
+            batch = self.torch.stack([self.preprocess(img) for img in images]).to(self.device)
+            feat = self.clip_model.encode_image(batch)
+            feat = feat / feat.norm(dim=-1, keepdim=True)
+        return feat.float().cpu().numpy()
+
+    def detect_roi(self, image, scale=1.0):
+        """Highest-confidence ROI as ([x1, y1, x2, y2] in original pixels, confidence), or (None, 0.0)"""
+        if self.roi_model is None:
+            return None, 0.0
+        with self.lock:
+            results = self.roi_model.predict(image, verbose=False)
+        if not results or len(results[0].boxes) == 0:
+            return None, 0.0
+        box = max(results[0].boxes, key=lambda b: b.conf)
+        return [int(round(v * scale)) for v in box.xyxy[0].tolist()], float(box.conf)
+
+    def classify(self, crop):
+        """(class name, confidence) of an ROI crop, or (None, 0.0) without a classification model"""
+        if self.cls_model is None:
+            return None, 0.0
+        with self.lock:
+            probs = self.cls_model.predict(crop, verbose=False)[0].probs
+        return self.cls_model.names[int(probs.top1)], float(probs.top1conf)
+
+# -----------------------------------------------------------------------------
+# Shared FAISS index (the version published by app.py or this service)
+# -----------------------------------------------------------------------------
+class IndexState:
+    """The published FAISS index with its delta log applied, replaced copy-on-write so searches never wait for writers.
+
+    Index files are only touched through read_blob/write_blob/delete_blob/delete_blobs_before
+    (GridFS here), so another store can stand in for it.
+    """
+    def __init__(self, db, embedding_dim: int):
+        import faiss
+        self.faiss = faiss
+        self.db = db
+        self.embedding_dim = embedding_dim
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(embedding_dim))
+        self.config = default_faiss_config()
+        # Published version loaded (None until one is) and how many of its delta log entries are applied
+        self.version = None
+        self.applied = 0
+        self.checked_at = 0.0
+        # Serializes reloads and publishes of this process
+        self.write_lock = asyncio.Lock()
+
+    def bucket(self):
+        from motor.motor_asyncio import AsyncIOMotorGridFSBucket
+        return AsyncIOMotorGridFSBucket(self.db, bucket_name="faiss_blobs")
+
+    async def read_blob(self, file_id):
+        stream = await self.bucket().open_download_stream(file_id)
+        return await stream.read()
+
+    async def write_blob(self, filename: str, payload: bytes):
+        return await self.bucket().upload_from_stream(filename, payload)
+
+    async def delete_blob(self, file_id):
+        await self.bucket().delete(file_id)
+
+    async def delete_blobs_before(self, file_id):
+        """Delete index files uploaded before ``file_id``; newer ones may be another writer's, not yet published"""
+        kept = await self.db["faiss_blobs.files"].find_one({"_id": file_id}, {"uploadDate": 1})
+        if kept is None:
+            return
+        bucket = self.bucket()
+        async for old in bucket.find({"uploadDate": {"$lt": kept["uploadDate"]}}):
+            await bucket.delete(old._id)
+
+    async def sync(self, force=False):
+        """Load a newly published version and apply new delta log entries (checked at most every INDEX_SYNC_SECONDS)"""
+        if not force and time.monotonic() - self.checked_at < INDEX_SYNC_SECONDS:
+            return
+        self.checked_at = time.monotonic()
+        pointer = self.db["faiss_index"]
+        doc = await pointer.find_one({"_id": "faiss_index"}, {"version": 1, "delta_count": 1, "file_id": 1})
+        # Nothing published yet, or only an inline index of an older app version: app.py builds one
+        if not doc or doc.get("file_id") is None:
+            return
+        version, delta_count = doc.get("version"), doc.get("delta_count", 0)
+        if (version, delta_count) == (self.version, self.applied):
+            return
+        async with self.write_lock:
+            if (version, delta_count) == (self.version, self.applied):
+                return
+            index, config, applied = self.index, self.config, self.applied
+            if version != self.version:
+                full = await pointer.find_one({"_id": "faiss_index", "version": version}, {"deltas": 0, "index_data": 0})
+                if full is None:
+                    # Replaced meanwhile: picked up by the next sync
+                    return
+                index = await run_in_threadpool(decode_faiss_index, full, await self.read_blob(full["file_id"]))
+                if index is None:
+                    return
+                config, applied = {**default_faiss_config(), **(full.get("index_config") or {})}, 0
+            log = await pointer.find_one({"_id": "faiss_index", "version": version},
+                                         faiss_deltas_projection(applied, delta_count - applied))
+            deltas = (log or {}).get("deltas", [])
+            if deltas:
+                if index is self.index:
+                    index, config = self.faiss.clone_index(index), dict(config)
+                def apply():
+                    for delta in deltas:
+                        apply_faiss_delta(index, config, delta)
+                await run_in_threadpool(apply)
+            self.index, self.config, self.version, self.applied = index, config, version, applied + len(deltas)
+
+    def search(self, queries, k: int):
+        """(cattle_id, score) pairs per query row"""
+        return search_index(self.index, self.config, queries, k)
+
+    async def upsert(self, cattle_id: str, vector):
+        """Add or replace one animal's vector through the delta log; False unless a published version is loaded.
+
+        Without one, app.py builds the index from the stored embeddings (this animal's included).
+        """
+        await self.sync(force=True)
+        if self.version is None:
+            return False
+        result = await self.db["faiss_index"].update_one(
+            {"_id": "faiss_index", "file_id": {"$exists": True}},
+            {"$push": {"deltas": faiss_delta(faiss_id(cattle_id), vector)}, "$inc": {"delta_count": 1}}
+        )
+        if result.matched_count == 0:
+            return False
+        await self.sync(force=True)
+        if self.applied >= FAISS_MAX_DELTAS:
+            await self.compact()
+        return True
+
+    async def compact(self):
+        """Publish the index with its applied deltas folded in as a new version; False if another writer got there first"""
+        async with self.write_lock:
+            index, config, expected = self.index, self.config, (self.version, self.applied)
+            payload, checksum, compression, size = await run_in_threadpool(encode_faiss_index, index)
+            version = uuid.uuid4().hex
+            file_id = await self.write_blob(f"faiss_index_{version}", payload)
+            previous = await self.db["faiss_index"].find_one_and_update(
+                faiss_pointer_query(expected),
+                faiss_pointer_update(file_id, checksum, compression, size, config, version),
+                projection={"file_id": 1}
+            )
+            if previous is None:
+                await self.delete_blob(file_id)
+                return False
+            if previous.get("file_id") is not None:
+                await self.delete_blobs_before(previous["file_id"])
+            self.version, self.applied = version, 0
+            return True
+
+# -----------------------------------------------------------------------------
+# Service
+# -----------------------------------------------------------------------------
+def create_app(db=None, models=None, index=None):
+    """Build the ASGI app; ``db``, ``models`` and ``index`` default to MONGODB_URI, the real weights and the published index"""
+    state = {}
+
+    @asynccontextmanager
+    async def lifespan(app):
+        database = db
+        if database is None:
+            from motor.motor_asyncio import AsyncIOMotorClient
+            mongodb_uri = os.environ.get("MONGODB_URI")
+            if not mongodb_uri:
+                raise RuntimeError("MONGODB_URI is not configured")
+            database = AsyncIOMotorClient(mongodb_uri, serverSelectionTimeoutMS=20000)[DB_NAME]
+        state["db"] = database
+        state["models"] = models or await run_in_threadpool(Models)
+        state["index"] = index or IndexState(database, state["models"].embedding_dim)
+        await state["index"].sync(force=True)
+        yield
+
+    app = FastAPI(title="Cattle Identification Service", lifespan=lifespan)
+
+    # -------------------------------------------------------------------------
+    async def prepare(uploads):
+        """Read and decode uploads; returns prepared items and the names that could not be decoded"""
+        items, failed = [], []
+        for upload in uploads:
+            raw = await read_upload(upload)
+            try:
+                image, scale = await run_in_threadpool(decode_image, raw, PROCESSING_MAX_SIDE)
+            except Exception:
+                failed.append(upload.filename)
+                continue
+            items.append({"name": upload.filename, "raw": raw, "hash": content_hash(raw), "image": image, "scale": scale})
+        return items, failed
+
+    async def embed(items):
+        """Embeddings of prepared items, served from the embedding cache where possible"""
+        db, models = state["db"], state["models"]
+        keys = [embedding_cache_key(item["hash"]) for item in items]
+        cached = {}
+        async for doc in db["embedding_cache"].find({"_id": {"$in": keys}}, {"vector": 1, "dtype": 1}):
+            cached[doc["_id"]] = unpack_vector(doc["vector"], doc.get("dtype", EMBEDDING_DTYPE))
+        todo = [i for i, key in enumerate(keys) if key not in cached]
+        feats = np.empty((len(items), models.embedding_dim), dtype=np.float32)
+        for i, key in enumerate(keys):
+            if key in cached:
+                feats[i] = cached[key]
+        if todo:
+            feats[todo] = await run_in_threadpool(models.embed, [items[i]["image"] for i in todo])
+            for i in todo:
+                await db["embedding_cache"].replace_one(
+                    {"_id": keys[i]}, embedding_cache_doc(items[i]["hash"], feats[i]), upsert=True)
+        return feats
+
+    async def detect_roi(item):
+        """ROI of a prepared item, cached in yolo_results like the app"""
+        db, models = state["db"], state["models"]
+        cached = await db["yolo_results"].find_one({"image_id": item["hash"], "roi_model": models.roi_version})
+        if cached:
+            return cached.get("roi_bbox"), cached.get("roi_confidence", 0.0), cached
+        roi_bbox, roi_conf = await run_in_threadpool(models.detect_roi, item["image"], item["scale"])
+        doc = yolo_result_doc(item["hash"], models.roi_version, roi_conf, roi_bbox)
+        await db["yolo_results"].replace_one({"image_id": item["hash"]}, doc, upsert=True)
+        return roi_bbox, roi_conf, doc
+
+    async def classify(item, roi_bbox, cached):
+        """Class of a prepared item's ROI, cached in yolo_results like the app"""
+        db, models = state["db"], state["models"]
+        if cached.get("cls_model") == models.cls_version and cached.get("class_name") is not None:
+            return cached["class_name"], cached.get("classification_confidence", 0.0)
+        crop = item["image"].crop(tuple(int(round(v / item["scale"])) for v in roi_bbox))
+        class_name, confidence = await run_in_threadpool(models.classify, crop)
+        if class_name is not None:
+            await db["yolo_results"].update_one(
+                {"image_id": item["hash"]}, {"$set": classification_fields(models.cls_version, class_name, confidence)})
+        return class_name, confidence
+
+    # -------------------------------------------------------------------------
+    @app.get("/health")
+    async def health():
+        index = state["index"]
+        return {"status": "ok", "index_version": index.version, "indexed": live_vectors(index.index, index.config)}
+
+    @app.post("/identify")
+    async def identify(files: List[UploadFile] = File(...), k: int = Form(1, ge=1, le=10),
+                       threshold: float = Form(IDENTIFY_THRESHOLD, ge=0.0, le=1.0)):
+        """Top-k registered animals for each uploaded image"""
+        await state["index"].sync()
+        items, failed = await prepare(files)
+        hits = state["index"].search(await embed(items), k) if items else []
+        ids = {cattle_id for image_hits in hits for cattle_id, _ in image_hits}
+        details = {}
+        async for doc in state["db"]["cattle_images"].find(
+                {"12_digit_id": {"$in": list(ids)}}, {"_id": 0, "12_digit_id": 1, "cattle_name": 1, "cattle_class": 1}):
+            details[doc["12_digit_id"]] = doc
+        return {
+            "results": [{
+                "image": item["name"],
+                "matches": [{
+                    "cattle_id": cattle_id,
+                    "cattle_name": details.get(cattle_id, {}).get("cattle_name"),
+                    "cattle_class": details.get(cattle_id, {}).get("cattle_class"),
+                    "score": score,
+                    "match": score >= threshold
+                } for cattle_id, score in image_hits]
+            } for item, image_hits in zip(items, hits)],
+            "failed": failed
+        }
+
+    @app.post("/classify")
+    async def classify_images(files: List[UploadFile] = File(...)):
+        """ROI detection and breed classification of each uploaded image"""
+        items, failed = await prepare(files)
+        results = []
+        for item in items:
+            roi_bbox, roi_conf, cached = await detect_roi(item)
+            result = {"image": item["name"], "roi_bbox": roi_bbox, "roi_confidence": roi_conf,
+                      "class_name": None, "confidence": 0.0}
+            if roi_bbox is not None and roi_conf >= ROI_MIN_CONFIDENCE:
+                result["class_name"], result["confidence"] = await classify(item, roi_bbox, cached)
+            results.append(result)
+        return {"results": results, "failed": failed}
+
+    @app.post("/register", status_code=201)
+    async def register(cattle_id: str = Form(...), cattle_name: str = Form(...),
+                       cattle_class: Optional[str] = Form(None), files: List[UploadFile] = File(...)):
+        """Register a new animal from images with a valid ROI; the class is predicted when omitted"""
+        db = state["db"]
+        if faiss_id(cattle_id) is None:
+            raise HTTPException(422, "Cattle code must be exactly 12 digits")
+        if await db["cattle_images"].find_one({"12_digit_id": cattle_id}, {"_id": 1}):
+            raise HTTPException(409, "This 12-digit code is already registered")
+
+        items, failed = await prepare(files)
+        valid, rois, rejected = [], [], []
+        for item in items:
+            if state["models"].roi_model is None:
+                valid.append(item)
+                rois.append(None)
+                continue
+            roi_bbox, roi_conf, cached = await detect_roi(item)
+            if roi_bbox is not None and roi_conf >= ROI_MIN_CONFIDENCE:
+                valid.append(item)
+                rois.append({"roi_bbox": roi_bbox, "roi_confidence": roi_conf})
+                if not cattle_class:
+                    cattle_class, _ = await classify(item, roi_bbox, cached)
+            else:
+                rejected.append(item["name"])
+        if not valid:
+            raise HTTPException(422, {"message": "No valid images", "rejected": rejected, "failed": failed})
+        cattle_class = cattle_class or "Unknown"
+
+        feats = await embed(valid)
+        created_at = datetime.utcnow().isoformat()
+        entries, hashes = [], []
+        for i, item in enumerate(valid, start=1):
+            ext = os.path.splitext(item["name"] or "")[1] or ".jpg"
+            # Thumbnail first: an undecodable upload raises before a blob reference is taken
+            thumb = await run_in_threadpool(make_thumbnail, item["raw"])
+            await db["image_blobs"].update_one({"_id": item["hash"]}, image_blob_update(item["raw"]), upsert=True)
+            hashes.append(item["hash"])
+            entry = image_entry(f"{cattle_id}_{i}{ext}", item["hash"], len(item["raw"]), thumb)
+            entry.update(rois[i - 1] or {})
+            entries.append(entry)
+
+        try:
+            await db["cattle_images"].insert_one(cattle_doc(cattle_id, cattle_name, cattle_class, entries, created_at))
+        except Exception as e:
+            # Duplicate registration raced past the check above: drop the references taken
+            for image_hash in hashes:
+                await db["image_blobs"].update_one({"_id": image_hash}, {"$inc": {"refcount": -1}})
+            await db["image_blobs"].delete_many({"_id": {"$in": hashes}, "refcount": {"$lte": 0}})
+            raise HTTPException(409, f"Could not save registration: {e}")
+
+        await db["cattle_embeddings"].replace_one(
+            {"_id": cattle_id},
+            embedding_doc([(entry["filename"], feat) for entry, feat in zip(entries, feats)], int(feats.shape[1])),
+            upsert=True
+        )
+        await db["herd_stats"].update_one({"_id": HERD_STATS_ID}, herd_stats_update(
+            records=1, images=len(entries), with_embeddings=1,
+            classes={cattle_class: 1}, image_counts={len(entries): 1}
+        ), upsert=True)
+
+        indexed = await state["index"].upsert(cattle_id, feats.sum(axis=0))
+        return {"cattle_id": cattle_id, "cattle_name": cattle_name, "cattle_class": cattle_class,
+                "images": [entry["filename"] for entry in entries], "rejected": rejected, "failed": failed,
+                "indexed": indexed}
+
+    @app.get("/cattle/{cattle_id}")
+    async def lookup(cattle_id: str):
+        """Metadata of one registered animal (image references, no image data)"""
+        db = state["db"]
+        doc = await db["cattle_images"].find_one(
+            {"12_digit_id": cattle_id},
+            {"_id": 0, "images.b64": 0, "images.thumb": 0, "name_lc": 0, "class_lc": 0}
+        )
+        if doc is None:
+            raise HTTPException(404, "Cattle not found")
+        doc["has_embedding"] = await db["cattle_embeddings"].count_documents(
+            {"_id": cattle_id, "vector": {"$ne": None}}, limit=1) > 0
+        return doc
+
+    @app.get("/cattle")
+    async def search(q: str = Query("", max_length=100), limit: int = Query(20, ge=1, le=100)):
+        """Animals whose ID, name or class starts with ``q`` (newest first)"""
+        cursor = state["db"]["cattle_images"].find(
+            search_cattle_filter(q), {"_id": 0, "12_digit_id": 1, "cattle_name": 1, "cattle_class": 1, "created_at": 1}
+        ).sort([("created_at", -1), ("_id", -1)]).limit(limit)
+        return {"results": [doc async for doc in cursor]}
+
+    return app
+
+app = create_app()
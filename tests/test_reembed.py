@@ -0,0 +1,129 @@
+"""Re-embed job against an in-memory MongoDB with a stub model."""
+import base64
+import io
+from datetime import datetime, timedelta
+
+import mongomock
+import numpy as np
+import pytest
+from PIL import Image
+
+from cattle_core import (
+    CLIP_MODEL_NAME, REEMBED_JOB_ID, REEMBED_STALE_SECONDS, ReembedJob, cattle_doc, content_hash, decode_image, image_blob_update,
+    image_entry, unpack_vector
+)
+
+EMBEDDING_DIM = 16
+COLORS = {"red": (200, 30, 30), "green": (30, 200, 30), "blue": (30, 30, 200)}
+
+
+class StubReembedJob(ReembedJob):
+    """Re-embed job whose embedding is determined by the dominant color channel"""
+    finished = 0
+
+    def decode(self, raw):
+        try:
+            return np.asarray(decode_image(raw)[0])
+        except Exception:
+            return None
+
+    def encode(self, inputs):
+        feats = np.zeros((len(inputs), EMBEDDING_DIM), dtype=np.float32)
+        for row, pixels in zip(feats, inputs):
+            row[int(np.argmax(pixels.reshape(-1, 3).mean(axis=0)))] = 1.0
+        return feats
+
+    def finish(self):
+        self.finished += 1
+
+
+def image_bytes(color):
+    buf = io.BytesIO()
+    Image.new("RGB", (32, 24), COLORS[color]).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def add_cattle(db, cattle_id, images):
+    """Register a record; ``images`` are colors (stored as blobs), ("inline", color) or raw bytes"""
+    entries = []
+    for i, image in enumerate(images):
+        filename = f"{cattle_id}_{i + 1}.png"
+        if isinstance(image, tuple):
+            entries.append({"filename": filename, "b64": base64.b64encode(image_bytes(image[1])).decode()})
+            continue
+        raw = image if isinstance(image, bytes) else image_bytes(image)
+        db["image_blobs"].update_one({"_id": content_hash(raw)}, image_blob_update(raw), upsert=True)
+        entries.append(image_entry(filename, content_hash(raw), len(raw), ""))
+    db["cattle_images"].insert_one(cattle_doc(cattle_id, "Cow", "Gir", entries, "2024-01-01T00:00:00"))
+
+
+@pytest.fixture
+def db():
+    return mongomock.MongoClient()["cattle_db"]
+
+
+def test_full_run_writes_per_animal_embeddings(db):
+    add_cattle(db, "000000000001", ["red", "red", "blue"])
+    add_cattle(db, "000000000002", [("inline", "green")])
+    add_cattle(db, "000000000003", [b"not an image"])
+    job = StubReembedJob(db, EMBEDDING_DIM, workers=2, chunk_size=2)
+
+    state = job.run()
+    assert state["status"] == "done"
+    assert (state["processed"], state["total"], state["updated"]) == (3, 3, 2)
+    # The duplicate red image is embedded once and is not a failure
+    assert (state["cached_images"], state["failed_images"]) == (0, 1)
+    assert job.finished == 1
+    assert db["jobs"].find_one({"_id": REEMBED_JOB_ID})["last_id"] == "000000000003"
+
+    doc = db["cattle_embeddings"].find_one({"_id": "000000000001"})
+    assert (doc["count"], doc["dim"], doc["model"]) == (3, EMBEDDING_DIM, CLIP_MODEL_NAME)
+    assert [img["filename"] for img in doc["images"]] == ["000000000001_1.png", "000000000001_2.png", "000000000001_3.png"]
+    vector = unpack_vector(doc["vector"], doc["dtype"])
+    assert vector[0] > vector[2] > 0
+    inline = db["cattle_embeddings"].find_one({"_id": "000000000002"})
+    assert np.argmax(unpack_vector(inline["vector"], inline["dtype"])) == 1
+    assert db["cattle_embeddings"].find_one({"_id": "000000000003"}) is None
+
+    # A second run is served from the embedding cache
+    assert job.run()["cached_images"] == 4
+
+
+def test_resume_continues_after_the_checkpoint(db):
+    for i in range(1, 5):
+        add_cattle(db, f"00000000000{i}", ["red"])
+    db["jobs"].insert_one({"_id": REEMBED_JOB_ID, "status": "stopped", "mode": "full", "last_id": "000000000002",
+                           "processed": 2, "updated": 2, "cached_images": 0, "failed_images": 0})
+    state = StubReembedJob(db, EMBEDDING_DIM).run(resume=True)
+    assert state["status"] == "done"
+    assert (state["processed"], state["total"], state["updated"]) == (4, 4, 4)
+    assert sorted(doc["_id"] for doc in db["cattle_embeddings"].find()) == ["000000000003", "000000000004"]
+
+
+def test_incremental_run_only_embeds_stale_records(db):
+    add_cattle(db, "000000000001", ["red"])
+    add_cattle(db, "000000000002", ["green"])
+    job = StubReembedJob(db, EMBEDDING_DIM)
+    job.run()
+    db["cattle_images"].update_one({"12_digit_id": "000000000002"}, {"$set": {"images_updated_at": "9999"}})
+
+    assert job.stale_ids() == ["000000000002"]
+    state = job.run(mode="incremental")
+    assert (state["processed"], state["updated"]) == (1, 1)
+
+
+def test_run_held_by_another_process_is_not_resumable(db):
+    add_cattle(db, "000000000001", ["red"])
+    recent = datetime.utcnow().isoformat()
+    db["jobs"].insert_one({"_id": REEMBED_JOB_ID, "status": "running", "mode": "full", "last_id": "",
+                           "processed": 0, "updated": 0, "cached_images": 0, "failed_images": 0, "heartbeat": recent})
+    job = StubReembedJob(db, EMBEDDING_DIM)
+    assert job.run(resume=True) is None
+    assert job.run() is None
+    assert db["cattle_embeddings"].count_documents({}) == 0
+
+    # Without a heartbeat for too long the run is considered interrupted
+    stale = (datetime.utcnow() - timedelta(seconds=REEMBED_STALE_SECONDS + 1)).isoformat()
+    db["jobs"].update_one({"_id": REEMBED_JOB_ID}, {"$set": {"heartbeat": stale}})
+    assert job.run(resume=True)["status"] == "done"
+    assert db["cattle_embeddings"].count_documents({}) == 1
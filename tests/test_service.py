@@ -0,0 +1,198 @@
+"""End-to-end tests of the HTTP service on an in-memory MongoDB, stub models and an in-memory index store."""
+import asyncio
+import io
+
+import faiss
+import numpy as np
+import pytest
+from bson import ObjectId
+from fastapi.testclient import TestClient
+from mongomock_motor import AsyncMongoMockClient
+from PIL import Image
+
+from cattle_core import encode_faiss_index, faiss_pointer_update
+from service import IndexState, create_app
+
+EMBEDDING_DIM = 16
+COLORS = {"red": (200, 30, 30), "green": (30, 200, 30), "blue": (30, 30, 200)}
+
+
+class StubModels:
+    """Models stand-in: the embedding is determined by the dominant color channel, no ROI model"""
+    embedding_dim = EMBEDDING_DIM
+    roi_model = None
+    cls_model = None
+    roi_version = "roi-test"
+    cls_version = "cls-test"
+
+    def embed(self, images):
+        feats = np.zeros((len(images), EMBEDDING_DIM), dtype=np.float32)
+        for row, img in zip(feats, images):
+            row[int(np.argmax(np.asarray(img).reshape(-1, 3).mean(axis=0)))] = 1.0
+        return feats
+
+    def detect_roi(self, image, scale=1.0):
+        return None, 0.0
+
+    def classify(self, crop):
+        return None, 0.0
+
+
+class MemoryIndexState(IndexState):
+    """IndexState keeping index files in a dict instead of GridFS"""
+    def __init__(self, db, embedding_dim):
+        super().__init__(db, embedding_dim)
+        self.blobs = {}
+
+    async def read_blob(self, file_id):
+        return self.blobs[file_id]
+
+    async def write_blob(self, filename, payload):
+        file_id = ObjectId()
+        self.blobs[file_id] = payload
+        return file_id
+
+    async def delete_blob(self, file_id):
+        self.blobs.pop(file_id, None)
+
+    async def delete_blobs_before(self, file_id):
+        pass
+
+
+def image_bytes(color, size=(64, 48)):
+    buf = io.BytesIO()
+    Image.new("RGB", size, COLORS[color]).save(buf, format="PNG")
+    return buf.getvalue()
+
+
+def publish_empty_index(db, state, index=None):
+    """Publish an index the way app.py does, so the service has a version to append deltas to"""
+    index = index if index is not None else faiss.IndexIDMap2(faiss.IndexFlatIP(EMBEDDING_DIM))
+    payload, checksum, compression, size = encode_faiss_index(index)
+    file_id = ObjectId()
+    state.blobs[file_id] = payload
+    config = {"requested_mode": "auto", "index_mode": "flat", "requested_encoding": "flat",
+              "encoding": "flat", "search_params": {}}
+    asyncio.run(db["faiss_index"].update_one(
+        {"_id": "faiss_index"}, faiss_pointer_update(file_id, checksum, compression, size, config, "v1"), upsert=True))
+
+
+@pytest.fixture
+def db():
+    return AsyncMongoMockClient()["cattle_db"]
+
+
+@pytest.fixture
+def state(db):
+    return MemoryIndexState(db, EMBEDDING_DIM)
+
+
+def make_client(db, state):
+    return TestClient(create_app(db=db, models=StubModels(), index=state))
+
+
+def register(client, cattle_id, name, colors, cattle_class="Gir"):
+    files = [("files", (f"{color}_{i}.png", image_bytes(color, (64 + i, 48)), "image/png"))
+             for i, color in enumerate(colors)]
+    return client.post("/register", data={"cattle_id": cattle_id, "cattle_name": name, "cattle_class": cattle_class},
+                       files=files)
+
+
+def test_register_identify_and_lookup(db, state):
+    publish_empty_index(db, state)
+    with make_client(db, state) as client:
+        response = register(client, "000000000001", "Lakshmi", ["red", "red"])
+        assert response.status_code == 201
+        assert response.json()["indexed"] is True
+        assert register(client, "000000000002", "Ganga", ["green"]).json()["indexed"] is True
+
+        response = client.post("/identify", files=[("files", ("query.png", image_bytes("red", (80, 60)), "image/png"))],
+                               data={"k": 2})
+        assert response.status_code == 200
+        matches = response.json()["results"][0]["matches"]
+        assert matches[0]["cattle_id"] == "000000000001"
+        assert matches[0]["cattle_name"] == "Lakshmi"
+        assert matches[0]["match"] is True
+
+        response = client.get("/cattle/000000000001")
+        assert response.status_code == 200
+        record = response.json()
+        assert record["has_embedding"] is True
+        assert [img["filename"] for img in record["images"]] == ["000000000001_1.png", "000000000001_2.png"]
+        assert "thumb" not in record["images"][0]
+        assert client.get("/cattle/000000000099").status_code == 404
+
+        results = client.get("/cattle", params={"q": "lak"}).json()["results"]
+        assert [doc["12_digit_id"] for doc in results] == ["000000000001"]
+        assert len(client.get("/cattle").json()["results"]) == 2
+
+    stats = asyncio.run(db["herd_stats"].find_one({"_id": "herd"}))
+    assert (stats["records"], stats["images"], stats["with_embeddings"]) == (2, 3, 2)
+    # The delta log was applied in this process and is kept for other readers
+    pointer = asyncio.run(db["faiss_index"].find_one({"_id": "faiss_index"}))
+    assert pointer["delta_count"] == 2
+
+
+def test_register_rejects_duplicate_and_invalid_ids(db, state):
+    publish_empty_index(db, state)
+    with make_client(db, state) as client:
+        assert register(client, "000000000001", "Lakshmi", ["red"]).status_code == 201
+        assert register(client, "000000000001", "Again", ["red"]).status_code == 409
+        assert register(client, "12345", "Short", ["red"]).status_code == 422
+
+
+def test_register_without_published_index_is_not_indexed(db, state):
+    with make_client(db, state) as client:
+        response = register(client, "000000000001", "Lakshmi", ["red"])
+        assert response.status_code == 201
+        assert response.json()["indexed"] is False
+        # No index holding only this animal was published
+        assert asyncio.run(db["faiss_index"].find_one({"_id": "faiss_index"})) is None
+        assert client.get("/cattle/000000000001").json()["has_embedding"] is True
+
+
+def test_hnsw_updates_use_tombstones(db, state):
+    publish_empty_index(db, state, faiss.IndexIDMap2(faiss.IndexHNSWFlat(EMBEDDING_DIM, 8, faiss.METRIC_INNER_PRODUCT)))
+    red, blue = np.eye(EMBEDDING_DIM, dtype=np.float32)[[0, 2]]
+
+    async def scenario():
+        assert await state.upsert("000000000001", red)
+        assert await state.upsert("000000000001", blue)
+        return state.search(blue[None], 5)[0], state.search(red[None], 5)[0]
+
+    blue_hits, red_hits = asyncio.run(scenario())
+    assert state.config["tombstones"] == 1
+    assert blue_hits[0] == ("000000000001", pytest.approx(1.0))
+    # The replaced vector no longer surfaces under its old label
+    assert all(score < 0.5 for _, score in red_hits)
+
+    # Another process replaying the log ends up with the same index
+    replica = MemoryIndexState(db, EMBEDDING_DIM)
+    replica.blobs = state.blobs
+    asyncio.run(replica.sync(force=True))
+    assert replica.applied == 2
+    assert replica.config["tombstones"] == 1
+    assert replica.search(blue[None], 1)[0][0][0] == "000000000001"
+
+
+def test_long_delta_log_is_compacted(db, state, monkeypatch):
+    monkeypatch.setattr("service.FAISS_MAX_DELTAS", 2)
+    publish_empty_index(db, state)
+    vectors = np.eye(EMBEDDING_DIM, dtype=np.float32)
+
+    async def scenario():
+        for i in range(3):
+            assert await state.upsert(f"00000000000{i + 1}", vectors[i])
+
+    asyncio.run(scenario())
+    pointer = asyncio.run(db["faiss_index"].find_one({"_id": "faiss_index"}))
+    assert pointer["version"] != "v1"
+    assert pointer["delta_count"] == 1
+    assert (state.version, state.applied) == (pointer["version"], 1)
+
+    # A fresh reader loads the compacted version and the one entry logged after it
+    replica = MemoryIndexState(db, EMBEDDING_DIM)
+    replica.blobs = state.blobs
+    asyncio.run(replica.sync(force=True))
+    assert replica.index.ntotal == 3
+    assert replica.search(vectors[2][None], 1)[0][0][0] == "000000000003"